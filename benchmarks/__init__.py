@@ -0,0 +1,50 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmarks for pyAffy (using airspeed velocity).
+
+The benchmarks do not require any downloads. They run on synthetic CDF and
+CEL files, which are generated deterministically (see `generators`). The
+size of the arrays and the number of threads can be set using environment
+variables:
+
+* ``PYAFFY_BENCH_ARRAY_SIZE``: The number of rows (and columns) of the
+  arrays. [712, as for the HG-U133A array]
+* ``PYAFFY_BENCH_THREADS``: The number of threads (``n_jobs``). [1]
+
+To run the benchmarks for the current commit, and to compare two commits::
+
+    $ asv run
+    $ asv continuous master HEAD
+
+To run the benchmarks once in the current environment (without building
+pyAffy in a separate environment)::
+
+    $ asv run --python=same --quick
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+
+from .generators import ARRAY_SIZES
+
+ARRAY_SIZE = int(os.environ.get('PYAFFY_BENCH_ARRAY_SIZE',
+                                ARRAY_SIZES['HG-U133A']))
+
+NUM_THREADS = int(os.environ.get('PYAFFY_BENCH_THREADS', 1))
@@ -0,0 +1,95 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmarks for parsing CDF and CEL files."""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import timeit
+
+from pyaffy.cdfparser import parse_cdf
+from pyaffy.celparser import parse_cel
+
+from . import ARRAY_SIZE
+from .generators import CEL_FORMATS, generate_intensities, write_cel, \
+        write_cdf
+
+
+def _throughput(func, path):
+    """Returns the throughput of a parser (in MB of file data per second)."""
+    t0 = timeit.default_timer()
+    func(path)
+    t = timeit.default_timer() - t0
+    return os.path.getsize(path) / t / 1e6
+
+
+class CDFParsing(object):
+    """Parsing of a GC3.0 CDF file (without using the cache)."""
+    timeout = 600
+
+    def setup_cache(self):
+        path = os.path.abspath('synthetic.cdf')
+        write_cdf(path, ARRAY_SIZE, ARRAY_SIZE)
+        return path
+
+    def _parse(self, path):
+        parse_cdf(path, use_cache = False)
+
+    def time_parse_cdf(self, path):
+        self._parse(path)
+
+    def peakmem_parse_cdf(self, path):
+        self._parse(path)
+
+    def track_parse_cdf_throughput(self, path):
+        return _throughput(self._parse, path)
+    track_parse_cdf_throughput.unit = 'MB/s'
+
+
+class CELParsing(object):
+    """Parsing of CEL files in each format (plain and gzip'ed)."""
+    params = [CEL_FORMATS, [False, True]]
+    param_names = ['format', 'compressed']
+    timeout = 600
+
+    def setup_cache(self):
+        y = generate_intensities(ARRAY_SIZE, ARRAY_SIZE)
+        paths = {}
+        for fmt in CEL_FORMATS:
+            for compressed in [False, True]:
+                path = os.path.abspath('synthetic_%s.CEL' % fmt)
+                if compressed:
+                    path += '.gz'
+                write_cel(path, fmt, ARRAY_SIZE, ARRAY_SIZE, y,
+                          compressed = compressed)
+                paths[(fmt, compressed)] = path
+        return paths
+
+    def _parse(self, path):
+        parse_cel(path, use_cache = False)
+
+    def time_parse_cel(self, paths, fmt, compressed):
+        self._parse(paths[(fmt, compressed)])
+
+    def peakmem_parse_cel(self, paths, fmt, compressed):
+        self._parse(paths[(fmt, compressed)])
+
+    def track_parse_cel_throughput(self, paths, fmt, compressed):
+        return _throughput(self._parse, paths[(fmt, compressed)])
+    track_parse_cel_throughput.unit = 'MB/s'
@@ -0,0 +1,86 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmarks for the individual RMA processing steps."""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+
+import numpy as np
+
+from pyaffy.background import rma_bg_correct
+from pyaffy.normalize import quantile_normalize
+from pyaffy.medpolish import medpolish_batch
+
+from . import ARRAY_SIZE, NUM_THREADS
+from .generators import cdf_gc3, generate_intensities
+
+SAMPLE_COUNTS = [2, 8, 32]
+
+
+class Preprocessing(object):
+    """Background correction, quantile normalization and median polish.
+
+    The data are the PM probe intensities of a synthetic data set.
+    """
+    params = [SAMPLE_COUNTS]
+    param_names = ['num_samples']
+    # the data are modified in-place, so each call requires a fresh copy
+    number = 1
+    repeat = 5
+    timeout = 600
+
+    def setup_cache(self):
+        _, probesets = cdf_gc3(ARRAY_SIZE, ARRAY_SIZE)
+        pm_sel = np.concatenate([pm for _, pm in probesets])
+        offsets = np.zeros(len(probesets) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum([len(pm) for _, pm in probesets])
+        Y = np.empty((pm_sel.size, max(SAMPLE_COUNTS)), dtype = np.float32)
+        for j in range(Y.shape[1]):
+            Y[:,j] = generate_intensities(ARRAY_SIZE, ARRAY_SIZE,
+                                          sample = j)[pm_sel]
+        path = os.path.abspath('probes.npz')
+        np.savez(path, Y = Y, offsets = offsets)
+        return path
+
+    def setup(self, path, num_samples):
+        with np.load(path) as data:
+            self.Y = np.ascontiguousarray(data['Y'][:,:num_samples])
+            self.offsets = data['offsets']
+        self.L = np.log2(self.Y)
+
+    def time_bg_correct(self, path, num_samples):
+        rma_bg_correct(self.Y, num_threads = NUM_THREADS)
+
+    def peakmem_bg_correct(self, path, num_samples):
+        rma_bg_correct(self.Y, num_threads = NUM_THREADS)
+
+    def time_quantile_normalize(self, path, num_samples):
+        quantile_normalize(self.Y, num_threads = NUM_THREADS)
+
+    def peakmem_quantile_normalize(self, path, num_samples):
+        quantile_normalize(self.Y, num_threads = NUM_THREADS)
+
+    def time_medpolish(self, path, num_samples):
+        medpolish_batch(self.L, self.offsets, copy = False,
+                        num_threads = NUM_THREADS)
+
+    def peakmem_medpolish(self, path, num_samples):
+        medpolish_batch(self.L, self.offsets, copy = False,
+                        num_threads = NUM_THREADS)
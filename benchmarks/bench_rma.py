@@ -0,0 +1,92 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""End-to-end benchmarks for `pyaffy.rma`."""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import timeit
+from collections import OrderedDict
+
+from pyaffy import rma
+from pyaffy import cache
+from pyaffy.cdfparser import parse_cdf
+
+from . import ARRAY_SIZE, NUM_THREADS
+from .generators import CEL_FORMATS, generate_intensities, write_cel, \
+        write_cdf
+
+SAMPLE_COUNTS = [2, 8, 32]
+
+
+class RMA(object):
+    """RMA of a synthetic data set.
+
+    The CEL files cycle through all formats, both plain and gzip'ed. The CDF
+    file is loaded from the cache (as in repeated analyses).
+    """
+    params = [SAMPLE_COUNTS]
+    param_names = ['num_samples']
+    number = 1
+    repeat = 3
+    timeout = 1800
+
+    def setup_cache(self):
+        cdf_file = os.path.abspath('synthetic.cdf')
+        write_cdf(cdf_file, ARRAY_SIZE, ARRAY_SIZE)
+
+        cel_files = []
+        for j in range(max(SAMPLE_COUNTS)):
+            fmt = CEL_FORMATS[j % len(CEL_FORMATS)]
+            compressed = (j // len(CEL_FORMATS)) % 2 == 1
+            path = os.path.abspath('sample_%02d.CEL' % j)
+            if compressed:
+                path += '.gz'
+            y = generate_intensities(ARRAY_SIZE, ARRAY_SIZE, sample = j)
+            write_cel(path, fmt, ARRAY_SIZE, ARRAY_SIZE, y,
+                      compressed = compressed)
+            cel_files.append(path)
+
+        cache_dir = os.path.abspath('cache')
+        cache.set_cache_dir(cache_dir)
+        parse_cdf(cdf_file)
+        return cdf_file, cel_files, cache_dir
+
+    def setup(self, data, num_samples):
+        cdf_file, cel_files, cache_dir = data
+        cache.set_cache_dir(cache_dir)
+        self.cdf_file = cdf_file
+        self.sample_cel_files = OrderedDict(
+            ('Sample %d' % (j + 1), path)
+            for j, path in enumerate(cel_files[:num_samples]))
+
+    def _rma(self):
+        rma(self.cdf_file, self.sample_cel_files, n_jobs = NUM_THREADS)
+
+    def time_rma(self, data, num_samples):
+        self._rma()
+
+    def peakmem_rma(self, data, num_samples):
+        self._rma()
+
+    def track_rma_throughput(self, data, num_samples):
+        t0 = timeit.default_timer()
+        self._rma()
+        return num_samples / (timeit.default_timer() - t0)
+    track_rma_throughput.unit = 'samples/s'
@@ -0,0 +1,403 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Deterministic generators for synthetic CDF and CEL files.
+
+The generated files follow the formats written by Affymetrix software:
+
+* CDF files in GC3.0 format (plain-text), with one block of PM/MM probe
+  pairs per probeset (unit).
+* CEL files in Version 3 (plain-text), Version 4 (binary, little-endian),
+  and Command Console (binary, big-endian) format.
+
+All files can optionally be gzip'ed. The same arguments always produce the
+same files.
+
+The intensities are simulated as ``2**(mu + a_i + s_j + e_ij) + b_ij``,
+with a fixed affinity ``a_i`` for each cell, a scaling factor ``s_j`` for
+each sample, noise ``e_ij``, and a normally distributed background
+``b_ij``. They are rounded to one decimal, as in Version 3 CEL files.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import io
+import gzip
+import struct
+
+import numpy as np
+
+# the number of rows/columns of some real arrays
+ARRAY_SIZES = {
+    'HG-U133A': 712,
+    'HG-U133_Plus_2': 1164,
+}
+
+CEL_FORMATS = ['v3', 'v4', 'cc']
+
+V4_CELL_DTYPE = np.dtype([
+    ('intensity', '<f4'),
+    ('stdev', '<f4'),
+    ('pixels', '<i2'),
+])
+
+
+def _write(path, data, compressed):
+    if compressed:
+        # fixed modification time, so that the files are reproducible
+        with io.open(path, 'wb') as raw:
+            with gzip.GzipFile(fileobj = raw, mode = 'wb', mtime = 0) as fh:
+                fh.write(data)
+    else:
+        with io.open(path, 'wb') as fh:
+            fh.write(data)
+
+
+def generate_intensities(num_rows, num_cols, sample = 0, seed = 0):
+    """Generates the intensities of a synthetic array.
+
+    Parameters
+    ----------
+    num_rows: int
+        The number of rows of the array.
+    num_cols: int
+        The number of columns of the array.
+    sample: int, optional
+        The index of the sample. Intensities of different samples share the
+        same cell affinities. [0]
+    seed: int, optional
+        The seed of the data set. [0]
+
+    Returns
+    -------
+    np.ndarray (ndim = 1, dtype = np.float32)
+        The intensities of all cells.
+    """
+    n = num_rows * num_cols
+    affinity = np.random.RandomState(seed).normal(0, 1.0, n)
+    rng = np.random.RandomState([seed, sample + 1])
+    scale = rng.normal(0, 0.2)
+    y = np.exp2(7.0 + affinity + scale + rng.normal(0, 0.3, n))
+    y += rng.normal(100.0, 15.0, n)
+    y = np.round(np.maximum(y, 1.0), 1)
+    return y.astype(np.float32)
+
+
+def cel_v3(num_rows, num_cols, y, newline = '\r\n'):
+    """Returns the contents of a Version 3 CEL file (as bytes)."""
+    n = num_rows * num_cols
+    i = np.arange(n)
+    x, r = i % num_cols, i // num_cols
+    lines = ['[CEL]', 'Version=3', '',
+             '[HEADER]',
+             'Cols=%d' % num_cols, 'Rows=%d' % num_rows,
+             'TotalX=%d' % num_cols, 'TotalY=%d' % num_rows,
+             'OffsetX=0', 'OffsetY=0',
+             'GridCornerUL=217 224', 'GridCornerUR=8279 216',
+             'GridCornerLR=8286 8278', 'GridCornerLL=224 8286',
+             'Axis-invertX=0', 'AxisInvertY=0', 'swapXY=0',
+             'DatHeader=[0..46124]  SYNTHETIC:CLS=%d RWS=%d XIN=3  YIN=3  '
+             'VE=17        2.0 01/01/16 00:00:00       \x14  \x14 '
+             'SYNTHETIC.1sq \x14  \x14  \x14  \x14  \x14 6 \x14 3.500000 '
+             '\x14 0.7000 \x14 3' % (num_cols, num_rows),
+             'Algorithm=Percentile',
+             'AlgorithmParameters=Percentile:75;CellMargin:2;'
+             'OutlierHigh:1.500;OutlierLow:1.004',
+             '',
+             '[INTENSITY]',
+             'NumberCells=%d' % n,
+             'CellHeader=X\tY\tMEAN\tSTDV\tNPIXELS']
+    cells = ['%3d\t%3d\t%.1f\t%.1f\t%3d' % t for t in
+             zip(x.tolist(), r.tolist(), y.tolist(),
+                 (y / 10.0).tolist(), [16] * n)]
+    lines.extend(cells)
+    lines += ['',
+              '[MASKS]', 'NumberCells=0', 'CellHeader=X\tY', '',
+              '[OUTLIERS]', 'NumberCells=0', 'CellHeader=X\tY', '',
+              '[MODIFIED]', 'NumberCells=0', 'CellHeader=X\tY\tORIGMEAN', '']
+    return (newline.join(lines) + newline).encode('iso-8859-1')
+
+
+def _coords(cells, byte_order):
+    """Returns the (x, y) coordinates of cells as 16-bit integers."""
+    return np.array(cells, dtype = byte_order + 'i2').reshape(-1, 2)
+
+
+def cel_v4(num_rows, num_cols, y, masked = None, outliers = None):
+    """Returns the contents of a Version 4 CEL file (as bytes).
+
+    `masked` and `outliers` are lists of the (x, y) coordinates of masked
+    and outlier cells (see `write_cel`).
+    """
+    n = num_rows * num_cols
+    masked = _coords(masked or [], '<')
+    outliers = _coords(outliers or [], '<')
+
+    def string(s):
+        b = s.encode('iso-8859-1')
+        return struct.pack('<i', len(b)) + b
+
+    header = ('Cols=%d\nRows=%d\nTotalX=%d\nTotalY=%d\nOffsetX=0\n'
+              'OffsetY=0\nGridCornerUL=217 224\nGridCornerUR=8279 216\n'
+              'GridCornerLR=8286 8278\nGridCornerLL=224 8286\n'
+              'Axis-invertX=0\nAxisInvertY=0\nswapXY=0\n'
+              'DatHeader=[0..46124]  SYNTHETIC:CLS=%d RWS=%d XIN=3  YIN=3  '
+              'VE=17        2.0 01/01/16 00:00:00\n'
+              'Algorithm=Percentile\n'
+              'AlgorithmParameters=Percentile:75;CellMargin:2\n'
+              %(num_cols, num_rows, num_cols, num_rows, num_cols, num_rows))
+    cells = np.empty(n, dtype = V4_CELL_DTYPE)
+    cells['intensity'] = y
+    cells['stdev'] = y / 10.0
+    cells['pixels'] = 16
+
+    out = io.BytesIO()
+    out.write(struct.pack('<iiiii', 64, 4, num_cols, num_rows, n))
+    out.write(string(header))
+    out.write(string('Percentile'))
+    out.write(string('Percentile:75;CellMargin:2;OutlierHigh:1.500;'
+                     'OutlierLow:1.004'))
+    # cell margin, outliers, masked cells, sub-grids
+    out.write(struct.pack('<iIIi', 2, len(outliers), len(masked), 0))
+    out.write(cells.tobytes())
+    out.write(masked.tobytes())
+    out.write(outliers.tobytes())
+    return out.getvalue()
+
+
+def _cc_wstring(s):
+    return struct.pack('>i', len(s)) + s.encode('utf-16-be')
+
+
+def _cc_param(name, value, mime_type):
+    if mime_type == 'text/plain':
+        raw = value.encode('utf-16-be')
+    elif mime_type == 'text/x-calvin-integer-32':
+        raw = struct.pack('>i', value)
+    elif mime_type == 'text/x-calvin-float':
+        raw = struct.pack('>f', value)
+    else:
+        raw = value.encode('ascii')
+    return _cc_wstring(name) + struct.pack('>i', len(raw)) + raw + \
+            _cc_wstring(mime_type)
+
+
+def cel_cc(num_rows, num_cols, y, masked = None, outliers = None,
+           padding = 0):
+    """Returns the contents of a Command Console CEL file (as bytes).
+
+    `masked` and `outliers` are lists of the (x, y) coordinates of masked
+    and outlier cells (see `write_cel`). `padding` unused bytes are inserted
+    after each data set, which readers have to skip using the stored
+    position of the next data set.
+    """
+    n = num_rows * num_cols
+    masked = _coords(masked or [], '>')
+    outliers = _coords(outliers or [], '>')
+    params = [
+        ('affymetrix-array-type', 'SYNTHETIC', 'text/plain'),
+        ('affymetrix-cel-rows', num_rows, 'text/x-calvin-integer-32'),
+        ('affymetrix-cel-cols', num_cols, 'text/x-calvin-integer-32'),
+        ('affymetrix-algorithm-name', 'Feature Extraction Cell Generation',
+         'text/plain'),
+    ]
+    type_id = b'affymetrix-calvin-intensity'
+    file_id = b'00000000-0000-0000-0000-000000000000'
+    data_header = struct.pack('>i', len(type_id)) + type_id + \
+            struct.pack('>i', len(file_id)) + file_id + \
+            _cc_wstring('2016-01-01T00:00:00Z') + _cc_wstring('en-US') + \
+            struct.pack('>i', len(params)) + \
+            b''.join(_cc_param(*p) for p in params) + \
+            struct.pack('>i', 0)  # no parent headers
+
+    datasets = [
+        ('Intensity', [('Intensity', 6, 4)], y.astype('>f4').tobytes(), n),
+        ('StdDev', [('StdDev', 6, 4)], (y / 10.0).astype('>f4').tobytes(),
+         n),
+        ('Pixel', [('Pixel', 2, 2)], np.full(n, 16, '>i2').tobytes(), n),
+        ('Outlier', [('X', 2, 2), ('Y', 2, 2)], outliers.tobytes(),
+         len(outliers)),
+        ('Mask', [('X', 2, 2), ('Y', 2, 2)], masked.tobytes(), len(masked)),
+    ]
+
+    # file header: magic number, version, number of data groups, position
+    data_group_pos = 10 + len(data_header)
+    group_name = _cc_wstring('')
+    pos = data_group_pos + 12 + len(group_name)
+    body = []
+    for name, columns, data, num_cells in datasets:
+        meta = _cc_wstring(name) + struct.pack('>i', 0) + \
+                struct.pack('>I', len(columns))
+        for col_name, col_type, col_size in columns:
+            meta += _cc_wstring(col_name) + struct.pack('>bi', col_type,
+                                                        col_size)
+        meta += struct.pack('>I', num_cells)
+        data_pos = pos + 8 + len(meta)
+        next_pos = data_pos + len(data) + padding
+        body.append(struct.pack('>II', data_pos, next_pos) + meta + data +
+                    b'\xff' * padding)
+        pos = next_pos
+
+    group = struct.pack('>IIi', 0, data_group_pos + 12 + len(group_name),
+                        len(datasets)) + group_name
+    return struct.pack('>BBiI', 59, 1, 1, data_group_pos) + data_header + \
+            group + b''.join(body)
+
+
+def write_cel(path, fmt, num_rows, num_cols, y, compressed = False,
+              masked = None, outliers = None):
+    """Writes a synthetic CEL file.
+
+    Parameters
+    ----------
+    path: str
+        The path of the file.
+    fmt: str
+        The file format ("v3", "v4", or "cc").
+    num_rows: int
+        The number of rows of the array.
+    num_cols: int
+        The number of columns of the array.
+    y: np.ndarray (ndim = 1, dtype = np.float32)
+        The intensities (see `generate_intensities`).
+    compressed: bool, optional
+        Whether to gzip the file. [False]
+    masked: list of (int, int), optional
+        The (x, y) coordinates of the masked cells (Version 4 and Command
+        Console format only). [None]
+    outliers: list of (int, int), optional
+        The (x, y) coordinates of the outlier cells (Version 4 and Command
+        Console format only). [None]
+    """
+    assert fmt in CEL_FORMATS
+    assert y.shape == (num_rows * num_cols,)
+    assert fmt != 'v3' or not (masked or outliers)
+
+    if fmt == 'v3':
+        data = cel_v3(num_rows, num_cols, y)
+    elif fmt == 'v4':
+        data = cel_v4(num_rows, num_cols, y, masked = masked,
+                      outliers = outliers)
+    else:
+        data = cel_cc(num_rows, num_cols, y, masked = masked,
+                      outliers = outliers)
+    _write(path, data, compressed)
+
+
+def cdf_gc3(num_rows, num_cols, num_probesets = None, num_probes = 11,
+            seed = 0, newline = '\r\n', probe_type = 'pm'):
+    """Returns the contents of a GC3.0 CDF file (as bytes).
+
+    Each probeset consists of `num_probes` PM/MM probe pairs at random
+    positions of the array.
+
+    Returns
+    -------
+    data: bytes
+        The contents of the file.
+    probesets: list of (str, list of int)
+        The name and the probe indices of each probeset (of the PM probes, or
+        of the MM probes if `probe_type` is "mm").
+    """
+    assert probe_type in ['pm', 'mm']
+    num_cells = num_rows * num_cols
+    if num_probesets is None:
+        # use about 80% of the cells
+        num_probesets = int(0.8 * num_cells / (2 * num_probes))
+    assert 2 * num_probes * num_probesets <= num_cells
+
+    rng = np.random.RandomState(seed)
+    positions = rng.permutation(num_cells)[:(2 * num_probes * num_probesets)]
+    positions = positions.reshape(num_probesets, num_probes, 2)
+    gene_ids = rng.choice(100000, num_probesets, replace = False)
+
+    lines = ['[CDF]', 'Version=GC3.0', '',
+             '[Chip]', 'Name=SYNTHETIC', 'Rows=%d' % num_rows,
+             'Cols=%d' % num_cols, 'NumberOfUnits=%d' % num_probesets,
+             'MaxUnit=%d' % (num_probesets + 1000),
+             'NumQCUnits=0', 'ChipReference=', '']
+    cell_header = 'CellHeader=X\tY\tPROBE\tFEAT\tQUAL\tEXPOS\tPOS\tCBASE\t' \
+            'PBASE\tTBASE\tATOM\tINDEX\tCODONIND\tCODON\tREGIONTYPE\tREGION'
+
+    probesets = []
+    for u in range(num_probesets):
+        name = '%d_at' % (gene_ids[u] + 1)
+        unit = u + 1000
+        lines += ['[Unit%d]' % unit, 'Name=NONE', 'Direction=1',
+                  'NumAtoms=%d' % num_probes,
+                  'NumCells=%d' % (2 * num_probes),
+                  'UnitNumber=%d' % unit, 'UnitType=3', 'NumberBlocks=1', '',
+                  '[Unit%d_Block1]' % unit, 'Name=%s' % name,
+                  'BlockNumber=1', 'NumAtoms=%d' % num_probes,
+                  'NumCells=%d' % (2 * num_probes),
+                  'StartPosition=0', 'StopPosition=%d' % (num_probes - 1),
+                  cell_header]
+        probes = []
+        c = 0
+        for a in range(num_probes):
+            # the PM probe, followed by its MM probe
+            for k, pbase in enumerate(['T', 'A']):
+                idx = int(positions[u, a, k])
+                x, y = idx % num_rows, idx // num_rows
+                lines.append('Cell%d=%d\t%d\tN\tcontrol\t%s\t%d\t13\tA\t%s\t'
+                             'A\t%d\t%d\t-1\t-1\t99\t '
+                             %(c + 1, x, y, name, a, pbase, a, idx))
+                c += 1
+                if k == (0 if probe_type == 'pm' else 1):
+                    probes.append(idx)
+        lines.append('')
+        probesets.append((name, probes))
+
+    return (newline.join(lines) + newline).encode('ascii'), probesets
+
+
+def write_cdf(path, num_rows, num_cols, num_probesets = None,
+              num_probes = 11, seed = 0, compressed = False,
+              probe_type = 'pm'):
+    """Writes a synthetic GC3.0 CDF file.
+
+    Parameters
+    ----------
+    path: str
+        The path of the file.
+    num_rows: int
+        The number of rows of the array.
+    num_cols: int
+        The number of columns of the array.
+    num_probesets: int or None, optional
+        The number of probesets. If None, about 80% of all cells are used.
+        [None]
+    num_probes: int, optional
+        The number of PM/MM probe pairs per probeset. [11]
+    seed: int, optional
+        The seed for generating the probe positions. [0]
+    compressed: bool, optional
+        Whether to gzip the file. [False]
+    probe_type: str, optional
+        The type of the probe indices to return ("pm" or "mm"). ["pm"]
+
+    Returns
+    -------
+    list of (str, list of int)
+        The name and the probe indices of each probeset.
+    """
+    data, probesets = cdf_gc3(num_rows, num_cols,
+                              num_probesets = num_probesets,
+                              num_probes = num_probes, seed = seed,
+                              probe_type = probe_type)
+    _write(path, data, compressed)
+    return probesets
@@ -17,7 +17,8 @@
 import pkg_resources
 
 from .process import rma
+from .frozen import FrozenRMA
 
 __version__ = pkg_resources.require('pyaffy')[0].version
 
-__all__ = ['rma']
+__all__ = ['rma', 'FrozenRMA']
@@ -0,0 +1,287 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+#cython: profile=False, wraparound=False, boundscheck=False, cdivision=True
+
+"""RMA background correction."""
+
+cimport cython
+from cython.parallel cimport prange, threadid
+from libc.math cimport floor, ceil, pow, exp, log, log1p, erf, erfc, \
+        fabs, isnan, NAN, M_SQRT1_2, M_PI
+
+import logging
+import multiprocessing
+
+import numpy as np
+cimport numpy as np
+
+from .quickselect cimport select_float, pairwise_sum_double
+
+np.import_array()
+
+logger = logging.getLogger(__name__)
+
+# the fixed value of alpha (the rate of the exponential signal distribution)
+ALPHA = 0.03
+
+# log(sqrt(2*pi)), calculated as done by SciPy
+cdef double NORM_PDF_LOGC = float(np.log(np.sqrt(2 * np.pi)))
+
+
+cdef inline double ndtr(double a) nogil:
+    """The standard normal CDF (as implemented in the Cephes library)."""
+    cdef double x = a * M_SQRT1_2
+    cdef double z = fabs(x)
+    cdef double y
+    if z < M_SQRT1_2:
+        y = 0.5 + 0.5 * erf(x)
+    else:
+        y = 0.5 * erfc(z)
+        if x > 0:
+            y = 1.0 - y
+    return y
+
+
+cdef inline double log_ndtr(double a) nogil:
+    """The log of the standard normal CDF (as implemented in SciPy)."""
+    cdef double log_lhs, last_total, rhs, numerator, denom_factor, denom_cons
+    cdef double sign
+    cdef int i
+    if a > 6:
+        return -ndtr(-a)
+    if a > -20:
+        return log(ndtr(a))
+
+    # asymptotic series for large negative values
+    log_lhs = -0.5 * a * a - log(-a) - 0.5 * log(2 * M_PI)
+    last_total = 0.0
+    rhs = 1.0
+    numerator = 1.0
+    denom_factor = 1.0
+    denom_cons = 1.0 / (a * a)
+    sign = 1.0
+    i = 0
+    while fabs(last_total - rhs) > 2.220446049250313e-16:
+        i += 1
+        last_total = rhs
+        sign = -sign
+        denom_factor *= denom_cons
+        numerator *= 2 * i - 1
+        rhs += sign * numerator * denom_factor
+    return log_lhs + log(rhs)
+
+
+cdef int estimate_params(float* y, Py_ssize_t m, float* sel, double* work,
+        double* mu, double* sigma) nogil:
+    """Estimates the RMA background parameters mu and sigma.
+
+    `y` contains the `m` (non-missing) intensities of one sample. `sel` and
+    `work` must have space for `m` values (`work` for at least 256). Returns 0 on success,
+    and -1 if the parameters cannot be estimated.
+    """
+    cdef Py_ssize_t i, k, prev, num_edges, num_bins, amax, num_low
+    cdef float lower, upper, a, b, d
+    cdef double v, gamma, bin_width, delta
+    cdef int* counts
+    cdef double s
+
+    if m < 2:
+        return -1
+
+    ### estimate mu using simple binning (histogram)
+
+    # the minimum and the 75th percentile (with linear interpolation)
+    lower = y[0]
+    for i in range(m):
+        sel[i] = y[i]
+        if y[i] < lower:
+            lower = y[i]
+    v = (m - 1) * 0.75
+    prev = <Py_ssize_t>floor(v)
+    gamma = v - prev
+    a = select_float(sel, m, prev)
+    if prev + 1 < m:
+        b = sel[prev + 1]
+        for i in range(prev + 2, m):
+            if sel[i] < b:
+                b = sel[i]
+    else:
+        b = a
+    d = b - a
+    if gamma < 0.5:
+        upper = a + d * <float>gamma
+    else:
+        upper = b - d * <float>(1 - gamma)
+
+    # use (approximately) a fixed number of bins, with an integer width
+    bin_width = floor((upper - lower) / <float>100)
+    if bin_width < 1.0:
+        bin_width = 1.0
+    num_edges = <Py_ssize_t>ceil((<double>upper - <double>lower) / bin_width)
+    num_bins = num_edges - 1
+    if num_bins <= 0:
+        return -1
+
+    # the bin edges are those of ``np.arange(lower, upper, bin_width)``: the
+    # second edge is rounded to single precision (like `lower`), and the
+    # edges are spaced by its distance from `lower` (which can differ
+    # slightly from `bin_width`)
+    delta = <double>(<float>(lower + bin_width)) - lower
+
+    counts = <int*>work
+    for k in range(num_bins):
+        counts[k] = 0
+    for i in range(m):
+        # bin k covers the interval [lower + k*delta, lower + (k+1)*delta)
+        k = <Py_ssize_t>floor((<double>y[i] - lower) / delta)
+        if lower + k * delta > y[i]:
+            k -= 1
+        elif lower + (k + 1) * delta <= y[i]:
+            k += 1
+        if k < num_bins:
+            counts[k] += 1
+    amax = 0
+    for k in range(1, num_bins):
+        if counts[k] > counts[amax]:
+            amax = k
+    mu[0] = lower + (amax + 0.5) * bin_width
+
+    ### estimate sigma
+
+    # 1. Select probes with values smaller than mu
+    # 2. Estimate their standard deviation (using mu as the mean)
+    # (the values are summed in their original order, as done by NumPy)
+    num_low = 0
+    for i in range(m):
+        if y[i] < mu[0]:
+            work[num_low] = (y[i] - mu[0]) * (y[i] - mu[0])
+            num_low += 1
+    s = pairwise_sum_double(work, num_low)
+    sigma[0] = pow(s / (num_low - 1), 0.5)
+    # 3. Arbitrarily multiply standard deviation by square root of two
+    sigma[0] *= pow(2.0, 0.5)
+
+    return 0
+
+
+def rma_bg_correct(Y, make_copy = False, num_threads = 0, full_output = False):
+    """RMA background correction.
+
+    The parameters of the normal background distribution are estimated for
+    each sample (column), and the intensities are replaced with the expected
+    signal given the observed intensity. Missing values (NaN) are ignored.
+    Samples are processed in parallel threads.
+
+    Parameters
+    ----------
+    Y: np.ndarray (ndim = 2, dtype = np.float32)
+        The microarray intensity values (on a linear scale), probes-by-samples.
+    make_copy: bool
+        Whether or to make a copy of the data or modify it in-place.
+    num_threads: int, optional
+        The number of threads to use (0 = use all available cores). [0]
+    full_output: bool, optional
+        Whether to also return the parameter estimates. [False]
+
+    Returns
+    -------
+    Y: np.ndarray (ndim = 2, dtype = np.float32)
+        The background-corrected intensities.
+    mu: np.ndarray (dtype = np.float64)
+        The estimated mean of the background distribution of each sample.
+        Only returned if `full_output` is True.
+    sigma: np.ndarray (dtype = np.float64)
+        The estimated standard deviation of the background distribution of
+        each sample. Only returned if `full_output` is True.
+    """
+    assert isinstance(Y, np.ndarray)
+    assert Y.ndim == 2 and Y.dtype == np.float32
+    assert isinstance(make_copy, bool)
+    assert isinstance(num_threads, int)
+    assert isinstance(full_output, bool)
+
+    if make_copy:
+        Y = Y.copy()
+
+    cdef float[:,:] Yv = Y
+    cdef Py_ssize_t p = Y.shape[0]
+    cdef Py_ssize_t n = Y.shape[1]
+    cdef int nt = num_threads
+    if nt <= 0:
+        nt = multiprocessing.cpu_count()
+
+    mu_arr = np.full(n, np.nan, dtype = np.float64)
+    sigma_arr = np.full(n, np.nan, dtype = np.float64)
+    status_arr = np.zeros(n, dtype = np.int32)
+    cdef double[::1] mu = mu_arr
+    cdef double[::1] sigma = sigma_arr
+    cdef int[::1] status = status_arr
+
+    # scratch buffers for each thread (the non-missing intensities of one
+    # sample, a copy of them for the selection algorithm, and values for the
+    # histogram and the variance calculation)
+    cdef float[:,::1] vals = np.empty((nt, max(p, 1)), dtype = np.float32)
+    cdef float[:,::1] sel = np.empty((nt, max(p, 1)), dtype = np.float32)
+    cdef double[:,::1] work = np.empty((nt, max(p, 256)), dtype = np.float64)
+
+    cdef Py_ssize_t i, j, m
+    cdef int tid
+    cdef double s, alpha = ALPHA, x, z
+
+    for j in prange(n, nogil = True, schedule = 'dynamic',
+            num_threads = nt):
+        tid = threadid()
+
+        # find missing data (= NaN)
+        m = 0
+        for i in range(p):
+            if not isnan(Yv[i, j]):
+                vals[tid, m] = Yv[i, j]
+                m = m + 1
+
+        status[j] = estimate_params(&vals[tid, 0], m, &sel[tid, 0],
+                &work[tid, 0], &mu[j], &sigma[j])
+        if status[j] != 0:
+            continue
+
+        ### estimate alpha
+
+        # we simply fix alpha to 0.03
+
+        ### calculate background-corrected intensities
+        s = sigma[j]
+        for i in range(p):
+            if not isnan(Yv[i, j]):
+                x = (Yv[i, j] - mu[j]) - alpha * pow(s, 2.0)
+                z = x / s
+                Yv[i, j] = <float>(x + s * exp((-(z * z) / 2.0 - NORM_PDF_LOGC)
+                        - log_ndtr(z)))
+
+    failed = np.nonzero(status_arr)[0]
+    if failed.size > 0:
+        raise ValueError('Could not estimate background parameters for '
+                         'sample %d (too few distinct values).'
+                         %(failed[0]))
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for j in range(n):
+            logger.debug('Mu: %.2f', mu_arr[j])
+            logger.debug('Sigma: %.2f', sigma_arr[j])
+
+    if full_output:
+        return Y, mu_arr, sigma_arr
+    return Y
@@ -0,0 +1,384 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""On-disk caches for parsed CDF and CEL files.
+
+Cache entries are keyed by the SHA-1 hash of the contents of the source file,
+so renaming or moving a file does not invalidate its entry, while modifying
+it does. The cache directory is determined as follows:
+
+1. The directory set with `set_cache_dir`, if any.
+2. The value of the environment variable ``PYAFFY_CACHE_DIR``, if set.
+3. ``$XDG_CACHE_HOME/pyaffy`` (default: ``~/.cache/pyaffy``).
+
+The cache of CEL file intensities is disabled by default. It can be enabled
+using `enable_cel_cache`, or by setting the environment variable
+``PYAFFY_CEL_CACHE_SIZE`` to the maximum size of the cache (in bytes). When
+the cache grows larger than that, the least recently used entries are
+removed.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+_oldstr = str
+from builtins import *
+
+import os
+import io
+import json
+import shutil
+import hashlib
+import tempfile
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# increase this whenever the format of the cached data changes
+CDF_CACHE_VERSION = 1
+
+# increase this whenever the CEL parsers produce different results
+CEL_CACHE_VERSION = 1
+
+_cache_dir = None
+
+# the maximum size of the CEL cache (False = use the environment variable)
+_cel_cache_size = False
+
+
+def set_cache_dir(path):
+    """Sets the cache directory.
+
+    Parameters
+    ----------
+    path: str or None
+        The path of the cache directory. If None, the default cache directory
+        is used.
+    """
+    global _cache_dir
+    assert path is None or isinstance(path, (str, _oldstr))
+    _cache_dir = path
+
+
+def get_cache_dir():
+    """Returns the cache directory.
+
+    Returns
+    -------
+    str
+        The path of the cache directory (it might not exist yet).
+    """
+    if _cache_dir is not None:
+        return _cache_dir
+    try:
+        return os.environ['PYAFFY_CACHE_DIR']
+    except KeyError:
+        pass
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'pyaffy')
+
+
+def hash_file(path, block_size = 4 * 1024 * 1024):
+    """Calculates the SHA-1 hash of the contents of a file.
+
+    Parameters
+    ----------
+    path: str
+        The path of the file.
+
+    Returns
+    -------
+    str
+        The hex digest of the SHA-1 hash.
+    """
+    h = hashlib.sha1()
+    with io.open(path, 'rb') as fh:
+        while True:
+            block = fh.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def _get_cdf_entry_path(file_hash, probe_type):
+    return os.path.join(get_cache_dir(), 'cdf', '%s_%s_v%d'
+                        %(file_hash, probe_type, CDF_CACHE_VERSION))
+
+
+def load_cdf(file_hash, probe_type):
+    """Loads a parsed CDF file from the cache.
+
+    The probe indices are memory-mapped.
+
+    Parameters
+    ----------
+    file_hash: str
+        The SHA-1 hash of the CDF file (see `hash_file`).
+    probe_type: str
+        The type of probes ("pm", "mm", or "all").
+
+    Returns
+    -------
+    tuple or None
+        The array design name, the number of rows and columns, the probeset
+        names (np.ndarray), the probeset offsets (np.ndarray of type
+        np.int64, with one more element than there are probesets), and the
+        concatenated probe indices (np.ndarray of type np.uint32). If the CDF
+        file is not in the cache, None is returned.
+    """
+    entry = _get_cdf_entry_path(file_hash, probe_type)
+    if not os.path.isdir(entry):
+        return None
+
+    try:
+        with io.open(os.path.join(entry, 'meta.json'), 'r',
+                     encoding='UTF-8') as fh:
+            meta = json.load(fh)
+        names = np.load(os.path.join(entry, 'names.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(entry, 'offsets.npy'), mmap_mode='r')
+        indices = np.load(os.path.join(entry, 'indices.npy'), mmap_mode='r')
+    except (IOError, OSError, ValueError, KeyError) as e:
+        logger.warning('Could not load cached CDF data from "%s": %s',
+                       entry, str(e))
+        return None
+
+    return (meta['name'], meta['rows'], meta['cols'],
+            names, offsets, indices)
+
+
+def store_cdf(file_hash, probe_type, name, num_rows, num_cols,
+              names, offsets, indices):
+    """Stores a parsed CDF file in the cache.
+
+    Errors (e.g., due to a read-only cache directory) are logged, but
+    otherwise ignored.
+
+    Parameters
+    ----------
+    See `load_cdf`.
+
+    Returns
+    -------
+    bool
+        Whether the data was stored successfully.
+    """
+    entry = _get_cdf_entry_path(file_hash, probe_type)
+    parent = os.path.dirname(entry)
+
+    temp_dir = None
+    try:
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        # write to a temporary directory first, and then rename it, so that
+        # concurrent readers never see an incomplete entry
+        temp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=parent)
+        meta = {'name': name, 'rows': num_rows, 'cols': num_cols}
+        with io.open(os.path.join(temp_dir, 'meta.json'), 'w',
+                     encoding='UTF-8') as fh:
+            fh.write(str(json.dumps(meta)))
+        np.save(os.path.join(temp_dir, 'names.npy'),
+                np.asarray(names, dtype=np.str_))
+        np.save(os.path.join(temp_dir, 'offsets.npy'),
+                np.asarray(offsets, dtype=np.int64))
+        np.save(os.path.join(temp_dir, 'indices.npy'),
+                np.asarray(indices, dtype=np.uint32))
+        os.rename(temp_dir, entry)
+        temp_dir = None
+
+    except (IOError, OSError) as e:
+        if os.path.isdir(entry):
+            # another process was faster
+            return True
+        logger.warning('Could not store CDF data in cache directory "%s": %s',
+                       parent, str(e))
+        return False
+
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    logger.debug('Stored CDF data in cache: %s', entry)
+    return True
+
+
+def enable_cel_cache(max_size = 10 * 2**30):
+    """Enables the cache of parsed CEL files.
+
+    Parameters
+    ----------
+    max_size: int, optional
+        The maximum size of the cache (in bytes). [10 GiB]
+    """
+    global _cel_cache_size
+    assert isinstance(max_size, int) and max_size > 0
+    _cel_cache_size = max_size
+
+
+def disable_cel_cache():
+    """Disables the cache of parsed CEL files."""
+    global _cel_cache_size
+    _cel_cache_size = None
+
+
+def get_cel_cache_size():
+    """Returns the maximum size of the cache of parsed CEL files.
+
+    Returns
+    -------
+    int or None
+        The maximum size (in bytes), or None if the cache is disabled.
+    """
+    if _cel_cache_size is not False:
+        return _cel_cache_size
+    try:
+        return int(os.environ['PYAFFY_CEL_CACHE_SIZE'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _get_cel_dir():
+    return os.path.join(get_cache_dir(), 'cel')
+
+
+def _get_cel_entry_path(file_hash):
+    return os.path.join(_get_cel_dir(), '%s_v%d.npy'
+                        %(file_hash, CEL_CACHE_VERSION))
+
+
+def load_cel(file_hash):
+    """Loads the intensities of a parsed CEL file from the cache.
+
+    The intensities are memory-mapped (read-only).
+
+    Parameters
+    ----------
+    file_hash: str
+        The SHA-1 hash of the CEL file (see `hash_file`).
+
+    Returns
+    -------
+    np.ndarray (dtype = np.float32) or None
+        The intensities, or None if the file is not in the cache.
+    """
+    entry = _get_cel_entry_path(file_hash)
+    try:
+        y = np.load(entry, mmap_mode='r')
+        # mark the entry as recently used
+        os.utime(entry, None)
+    except (IOError, OSError, ValueError):
+        return None
+    return y
+
+
+def store_cel(file_hash, y):
+    """Stores the intensities of a parsed CEL file in the cache.
+
+    Afterwards, the least recently used entries are removed until the cache
+    does not exceed its maximum size. Errors are logged, but otherwise
+    ignored.
+
+    Parameters
+    ----------
+    file_hash: str
+        The SHA-1 hash of the CEL file (see `hash_file`).
+    y: np.ndarray
+        The intensities.
+
+    Returns
+    -------
+    bool
+        Whether the data was stored successfully.
+    """
+    max_size = get_cel_cache_size()
+    if max_size is None or y.nbytes > max_size:
+        return False
+
+    entry = _get_cel_entry_path(file_hash)
+    parent = os.path.dirname(entry)
+    temp_path = None
+    try:
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        # write to a temporary file first, and then rename it
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp_', dir=parent)
+        with io.open(fd, 'wb') as fh:
+            np.save(fh, np.asarray(y, dtype=np.float32))
+        os.rename(temp_path, entry)
+        temp_path = None
+    except (IOError, OSError) as e:
+        logger.warning('Could not store CEL data in cache directory "%s": '
+                       '%s', parent, str(e))
+        return False
+    finally:
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    logger.debug('Stored CEL data in cache: %s', entry)
+    evict_cel_cache(max_size)
+    return True
+
+
+def evict_cel_cache(max_size):
+    """Removes the least recently used entries from the CEL cache.
+
+    Parameters
+    ----------
+    max_size: int
+        The maximum size of the cache (in bytes).
+
+    Returns
+    -------
+    int
+        The number of removed entries.
+    """
+    cel_dir = _get_cel_dir()
+    entries = []
+    try:
+        for name in os.listdir(cel_dir):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(cel_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    except OSError:
+        return 0
+
+    total = sum(e[1] for e in entries)
+    num_removed = 0
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+        num_removed += 1
+
+    if num_removed > 0:
+        logger.debug('Removed %d entries from the CEL cache.', num_removed)
+    return num_removed
@@ -20,6 +20,13 @@
 Cython parser for Brainarray CDF files for Affymetrix GeneChip microarrays.
 
 See: http://brainarray.mbni.med.umich.edu/Brainarray/Database/CustomCDF/genomic_curated_CDF.asp
+
+The whole file is read at once (uncompressed files are memory-mapped). The
+offsets of all unit blocks are determined in a single scan for section
+headers, after which the units are parsed in parallel, in two passes: The
+first pass parses the unit headers, which determine the position of each
+unit's probe indices in the (flat) index array, and the second pass parses
+the cell lines.
 """
 
 #from __future__ import (absolute_import, division,
@@ -31,12 +38,9 @@ from __future__ import (absolute_import, division,
 from builtins import str as text
 
 cimport cython
+from cython.parallel cimport prange
 
-from libc.stddef cimport size_t
-from libc.stdlib cimport malloc
-from libc.stdio  cimport FILE, fopen, fread, fclose, fgets, sscanf
-from libc.string cimport strlen, strcmp
-# from libc.math cimport NAN
+from libc.string cimport memchr, memcmp
 
 import numpy as np
 cimport numpy as np
@@ -45,7 +49,12 @@ np.import_array()
 
 import sys
 import logging
-from collections import OrderedDict
+import warnings
+import multiprocessing
+
+from . import cache
+from . import compression
+from .probesets import ProbesetIndex
 
 logger = logging.getLogger(__name__)
 
@@ -54,70 +63,233 @@ cdef enum ProbeType:
     PROBES_MM = 1
     PROBES_ALL = 2
 
-cdef read_line(char* buf, int buf_size, FILE* fp, size_t nl):
-    fgets(buf, buf_size, fp)
-    buf[strlen(buf) - nl] = '\0'
+# the minimum number of bytes per thread when parsing in parallel
+cdef enum:
+    MIN_BYTES_PER_THREAD = 1048576
 
-cdef np.uint32_t[::1] parse_probeset(char* buf, char* gene, int buf_size, size_t nl, FILE* fp, ProbeType probes, int num_rows, int num_cols):
+# the number of whitespace-separated fields preceding the CBASE field in
+# the cell lines (X, Y, PROBE, FEAT, QUAL, EXPOS, POS)
+cdef enum:
+    CBASE_FIELD = 7
 
-    cdef int test
-    cdef int num_pairs
-    cdef int num_probes
-    cdef int i, c, n
-    cdef int result
-    cdef int x, y
+cdef inline bint is_blank(char c) nogil:
+    return c == b' ' or c == b'\t'
 
-    cdef char ref_base, probe_base
+cdef inline bint is_delim(char c) nogil:
+    return c == b' ' or c == b'\t' or c == b'\r' or c == b'\n'
 
-    buf[0] = '\0'
-    while sscanf(buf, "[Unit%*d_Block%d]", &test) <= 0:
-        read_line(buf, buf_size, fp, nl)
-    #assert test > 0
+cdef inline bint is_digit(char c) nogil:
+    return c >= b'0' and c <= b'9'
 
-    read_line(buf, buf_size, fp, nl) # Name=
-    result = sscanf(buf, "Name=%200s", gene)
-    #assert result == 1
+cdef inline bint starts_with(const char* p, const char* end,
+        const char* prefix, Py_ssize_t n) nogil:
+    return end - p >= n and memcmp(p, prefix, n) == 0
 
-    read_line(buf, buf_size, fp, nl) # skip BlockNumber
+cdef inline const char* next_line(const char* p, const char* end) nogil:
+    """Returns the start of the next line (or `end`)."""
+    p = <const char*>memchr(p, b'\n', end - p)
+    if p == NULL:
+        return end
+    return p + 1
 
-    read_line(buf, buf_size, fp, nl)
-    sscanf(buf, "NumAtoms=%d", &num_pairs)
+cdef const char* parse_int(const char* p, const char* end,
+        Py_ssize_t* value) nogil:
+    """Parses a non-negative integer, skipping leading blanks.
 
-    read_line(buf, buf_size, fp, nl)
-    result = sscanf(buf, "NumCells=%d", &num_probes)
-    assert result == 1
-
-    if probes == PROBES_ALL:
-        n = num_probes
-    else:
-        n = num_pairs
-
-    cdef np.uint32_t[::1] ind = np.empty(int(n), dtype = np.uint32)
-
-    read_line(buf, buf_size, fp, nl) # skip StartPosition
-    read_line(buf, buf_size, fp, nl) # skip StopPosition
-    read_line(buf, buf_size, fp, nl) # skip CellHeader
-
-    c = 0
-    for i in range(num_probes):
-        read_line(buf, buf_size, fp, nl)
-        result = sscanf(buf, "Cell%*d=%d %d N control %*s %*d %*d %1c %1c", &x, &y, &ref_base, &probe_base)
-        assert result == 4
-        if (probes == PROBES_ALL) or \
-                (probes == PROBES_PM and ref_base != probe_base) or\
-                (probes == PROBES_MM and ref_base == probe_base):
-            ind[c] = num_rows * y + x
+    Returns a pointer to the first character after the number, or NULL if
+    there is no number.
+    """
+    cdef Py_ssize_t v = 0
+    while p < end and is_blank(p[0]):
+        p += 1
+    if p == end or not is_digit(p[0]):
+        return NULL
+    while p < end and is_digit(p[0]):
+        v = 10 * v + (p[0] - c'0')
+        p += 1
+    value[0] = v
+    return p
+
+cdef Py_ssize_t find_section(const char* data, Py_ssize_t start,
+        Py_ssize_t stop) nogil:
+    """Returns the position of the next section header (or `stop`).
+
+    Section headers are the only lines that start with "[".
+    """
+    cdef const char* p = data + start
+    cdef const char* end = data + stop
+    while p < end:
+        p = <const char*>memchr(p, b'[', end - p)
+        if p == NULL:
+            break
+        if p == data or (p - 1)[0] == b'\n':
+            return p - data
+        p += 1
+    return stop
+
+cdef bint is_block_header(const char* p, const char* end) nogil:
+    """Tests whether a line is a "[UnitN_BlockM]" section header."""
+    if not starts_with(p, end, b'[Unit', 5):
+        return False
+    p += 5
+    while p < end and is_digit(p[0]):
+        p += 1
+    return starts_with(p, end, b'_Block', 6)
+
+cdef Py_ssize_t parse_unit_header(const char* data, Py_ssize_t start,
+        Py_ssize_t stop, Py_ssize_t* name_start, Py_ssize_t* name_len,
+        Py_ssize_t* num_atoms, Py_ssize_t* num_cells) nogil:
+    """Parses the header of a unit block.
+
+    The header ends with the "CellHeader=" line. Returns the position of the
+    first cell line, or -1 if the header is invalid.
+    """
+    cdef const char* p = data + start
+    cdef const char* end = data + stop
+    cdef const char* q
+
+    name_len[0] = -1
+    num_atoms[0] = -1
+    num_cells[0] = -1
+
+    # skip the section header
+    p = next_line(p, end)
+    while p < end:
+        if starts_with(p, end, b'Name=', 5):
+            q = p + 5
+            while q < end and not is_delim(q[0]):
+                q += 1
+            name_start[0] = (p + 5) - data
+            name_len[0] = q - (p + 5)
+        elif starts_with(p, end, b'NumAtoms=', 9):
+            if parse_int(p + 9, end, num_atoms) == NULL:
+                return -1
+        elif starts_with(p, end, b'NumCells=', 9):
+            if parse_int(p + 9, end, num_cells) == NULL:
+                return -1
+        elif starts_with(p, end, b'CellHeader=', 11):
+            if name_len[0] < 0 or num_atoms[0] < 0 or num_cells[0] < 0:
+                return -1
+            return next_line(p, end) - data
+        p = next_line(p, end)
+
+    return -1
+
+cdef Py_ssize_t parse_unit_cells(const char* data, Py_ssize_t start,
+        Py_ssize_t stop, Py_ssize_t num_cells, ProbeType probes,
+        Py_ssize_t num_rows, np.uint32_t* ind, Py_ssize_t max_probes) nogil:
+    """Parses the cell lines of a unit block and stores the selected indices.
+
+    Each line has the form "CellN=X Y PROBE FEAT QUAL EXPOS POS CBASE PBASE
+    ...". Perfect match probes are the probes whose PBASE differs from their
+    CBASE. At most `max_probes` indices are stored. Returns the number of
+    selected probes, or -1 if a line is invalid.
+    """
+    cdef const char* p = data + start
+    cdef const char* end = data + stop
+    cdef const char* line_end
+    cdef Py_ssize_t i, x, y
+    cdef Py_ssize_t c = 0
+    cdef int f
+    cdef char ref_base, probe_base
+    cdef bint select
+
+    for i in range(num_cells):
+        if not starts_with(p, end, b'Cell', 4):
+            return -1
+        line_end = <const char*>memchr(p, b'\n', end - p)
+        if line_end == NULL:
+            line_end = end
+        p = <const char*>memchr(p, b'=', line_end - p)
+        if p == NULL:
+            return -1
+        p = parse_int(p + 1, line_end, &x)
+        if p == NULL:
+            return -1
+        p = parse_int(p, line_end, &y)
+        if p == NULL:
+            return -1
+        # skip the remaining fields before CBASE
+        for f in range(2, CBASE_FIELD):
+            while p < line_end and is_blank(p[0]):
+                p += 1
+            while p < line_end and not is_delim(p[0]):
+                p += 1
+        while p < line_end and is_blank(p[0]):
+            p += 1
+        if p == line_end or is_delim(p[0]):
+            return -1
+        ref_base = p[0]
+        while p < line_end and not is_delim(p[0]):
+            p += 1
+        while p < line_end and is_blank(p[0]):
+            p += 1
+        if p == line_end or is_delim(p[0]):
+            return -1
+        probe_base = p[0]
+
+        select = (probes == PROBES_ALL) or \
+                (probes == PROBES_PM and ref_base != probe_base) or \
+                (probes == PROBES_MM and ref_base == probe_base)
+        if select:
+            if c == max_probes:
+                # more probes than expected
+                return c + 1
+            ind[c] = <np.uint32_t>(num_rows * y + x)
             c += 1
+        p = line_end + 1
+
+    return c
+
+
+def _parse_header(data, path):
+    """Parses the [CDF] and [Chip] sections.
 
-    assert c == n
+    Returns the name of the array type, the number of rows, columns and
+    units, and the position after the [Chip] section.
+    """
+    values = {}
+    size = len(data)
+    pos = 0
+    num_lines = 0
+    while pos < size:
+        line_end = data.find(b'\n', pos)
+        if line_end == -1:
+            line_end = size
+        line = data[pos:line_end].rstrip(b'\r')
+        if num_lines > 0 and line.startswith(b'[') and line != b'[Chip]':
+            break
+        num_lines += 1
+        pos = line_end + 1
+        if num_lines <= 2:
+            expected = [b'[CDF]', b'Version=GC3.0'][num_lines - 1]
+            if line != expected:
+                raise ValueError('Invalid CDF file "%s" (expected "%s" in '
+                                 'line %d).' %(path, expected.decode('ascii'),
+                                               num_lines))
+        elif b'=' in line:
+            key, val = line.split(b'=', 1)
+            values.setdefault(key, val)
+
+    try:
+        name = values[b'Name'].split()[0].decode('iso-8859-1')
+        num_rows = int(values[b'Rows'])
+        num_cols = int(values[b'Cols'])
+        num_units = int(values[b'NumberOfUnits'])
+    except (KeyError, IndexError, ValueError):
+        raise ValueError('Invalid CDF file "%s" (missing or invalid [Chip] '
+                         'section).' %(path))
 
-    return ind
+    return name, num_rows, num_cols, num_units, min(pos, size)
 
 
-def parse_cdf(path, probe_type = 'pm', newline_chars = 2):
+def parse_cdf(path, probe_type = 'pm', newline_chars = None, use_cache = True,
+        num_threads = 1):
     """Front-end for parsing a Brainarray CDF file.
 
-    The function assumes that the CDF file is uncompressed.
+    Compressed files (gzip, bzip2, or xz) are decompressed in memory, and
+    uncompressed files are memory-mapped. Line endings (LF or CRLF) are
+    detected automatically.
 
     See: http://brainarray.mbni.med.umich.edu/Brainarray/Database/CustomCDF/genomic_curated_CDF.asp
 
@@ -126,7 +298,20 @@ def parse_cdf(path, probe_type = 'pm', newline_chars = 2):
     path: str
         The path of the CDF file
     probe_type: str
-        The type of probes to read. Either "pm" (perfect match probes)
+        The type of probes to read. Either "pm" (perfect match probes),
+        "mm" (mismatch probes), or "all".
+    newline_chars: int, optional
+        Deprecated and ignored (a DeprecationWarning is issued if it is
+        specified). Line endings (LF or CRLF) are detected automatically.
+        [None]
+    use_cache: bool, optional
+        Whether to use the on-disk cache of parsed CDF files. If True, the
+        parsed data is looked up in the cache using the hash of the file
+        contents, and stored in the cache after parsing if it was not found.
+        See `pyaffy.cache` for how the cache directory is determined. [True]
+    num_threads: int, optional
+        The number of threads to use for parsing the units (0 = use all
+        available cores). [1]
 
     Returns
     -------
@@ -136,30 +321,24 @@ def parse_cdf(path, probe_type = 'pm', newline_chars = 2):
         The number of rows on the array.
     cols: int
         The number of columns on the array.
-    probeset: collections.OrderedDict
-        The array indices for each probeset (gene). Each key/value-pair in the
-        ordered dictionary corresponds to a probeset (gene). The *key*
-        corresponds to the probeset (gene) ID, e.g., the Entrez ID followed by
-        the string "_at". The *value* is a np.ndarray of type np.uint32 that
-        contains the probe indices for the order in which probe intensities are
-        stored in CEL files (column-first order).
+    probesets: `pyaffy.probesets.ProbesetIndex`
+        The array indices for each probeset (gene), in the order in which the
+        probesets appear in the CDF file. The index can be used like an
+        ordered dictionary: Each *key* corresponds to a probeset (gene) ID,
+        e.g., the Entrez ID followed by the string "_at". The *value* is a
+        np.ndarray of type np.uint32 that contains the probe indices for the
+        order in which probe intensities are stored in CEL files (column-first
+        order).
     """
     assert isinstance(path, (text, str))
     assert isinstance(probe_type, (text, str))
-    assert isinstance(newline_chars, int)
-
-    cdef int buf_size = 1000
-    cdef size_t nl = <size_t>newline_chars
-    cdef char* buf = <char*>malloc(buf_size)
-    cdef char name[201]
-    cdef FILE* fp
+    assert isinstance(use_cache, bool)
+    assert isinstance(num_threads, int)
 
-    cdef int num_rows, num_cols
-    cdef int num_probesets
-    cdef char gene[201]
-    cdef int i, x, y
-
-    cdef np.uint32_t[::1] ind
+    if newline_chars is not None:
+        warnings.warn('The "newline_chars" parameter is deprecated and '
+                      'ignored (line endings are detected automatically).',
+                      DeprecationWarning, stacklevel = 2)
 
     cdef ProbeType probes
     if probe_type == 'all':
@@ -174,58 +353,109 @@ def parse_cdf(path, probe_type = 'pm', newline_chars = 2):
              'Will default to "pm".' %(probe_type))
         )
         probes = PROBES_PM
-
-    probesets = OrderedDict()
-
-    path_bytes = path.encode('UTF-8')
-    cdef char* c_path_bytes = path_bytes
-
-    fp = fopen(c_path_bytes, 'r')
-
-    try:
-        # parsing starts here
-
-        # count rows to get to relevant information in [Chip] section
-        # then count QC sections (each while?)
-
-        # check header
-        read_line(buf, buf_size, fp, nl) # [CDF]
-        assert strcmp(buf, "[CDF]") == 0
-        read_line(buf, buf_size, fp, nl) # Version=GC3.0
-        assert strcmp(buf, "Version=GC3.0") == 0
-
-        read_line(buf, buf_size, fp, nl) # empty
-
-        # read general information
-        read_line(buf, buf_size, fp, nl) # [Chip]
-        assert strcmp(buf, "[Chip]") == 0
-
-        read_line(buf, buf_size, fp, nl) # Name=
-        sscanf(buf, "Name=%200s", name)
-        
-        read_line(buf, buf_size, fp, nl) # Rows=
-        sscanf(buf, "Rows=%d", &num_rows)
-
-        read_line(buf, buf_size, fp, nl) # Cols=
-        sscanf(buf, "Cols=%d", &num_cols)
-
-        read_line(buf, buf_size, fp, nl) # NumberOfUnits=
-        sscanf(buf, "NumberOfUnits=%d", &num_probesets)
-
-        test = []
-        for i in range(num_probesets):
-            #print i,
-            #sys.stdout.flush()
-            ind = parse_probeset(buf, gene, buf_size, nl, fp, probes, num_rows, num_cols)
-            probesets[str(gene)] = np.uint32(ind)
-
-    finally:
-        fclose(fp)
-
-    #print "header information:"
-    #print "name = %s" %(str(name))
-    #print "rows = %d" %(int(num_rows))
-    #print "cols = %d" %(int(num_cols))
-    #print "number of probesets = %d" %(int(num_probesets))
-
-    return text(name), int(num_rows), int(num_cols), probesets
+        probe_type = 'pm'
+
+    if use_cache:
+        file_hash = cache.hash_file(path)
+        cached = cache.load_cdf(file_hash, probe_type)
+        if cached is not None:
+            logger.debug('Loaded CDF data from cache.')
+            cached_name, num_rows, num_cols, names, cached_offsets, \
+                    cached_indices = cached
+            probesets = ProbesetIndex(names, cached_offsets, cached_indices)
+            return text(cached_name), int(num_rows), int(num_cols), probesets
+
+    buf = compression.read_array(path)
+    cdef const unsigned char[::1] view = buf
+    cdef Py_ssize_t size = view.shape[0]
+    cdef const char* data = b''
+    if size > 0:
+        data = <const char*>&view[0]
+
+    # the [CDF] and [Chip] sections are short
+    chip_name, num_rows, num_cols, num_units, header_size = \
+            _parse_header(data[:min(size, 65536)], path)
+    cdef Py_ssize_t rows = num_rows
+    cdef Py_ssize_t data_start = header_size
+
+    # find the unit blocks
+    cdef Py_ssize_t u = 0
+    cdef Py_ssize_t n = num_units
+    cdef Py_ssize_t pos = data_start
+    cdef Py_ssize_t[::1] starts = np.empty(n + 1, dtype = np.intp)
+    with nogil:
+        while u < n:
+            pos = find_section(data, pos, size)
+            if pos == size:
+                break
+            if is_block_header(data + pos, data + size):
+                starts[u] = pos
+                u += 1
+            pos += 1
+        # the last unit ends at the next section header
+        starts[n] = find_section(data, pos, size)
+    if u < n:
+        raise ValueError('Unexpected end of CDF file "%s" (expected %d '
+                         'units, found %d).' %(path, n, u))
+
+    cdef int nt = num_threads
+    if nt <= 0:
+        nt = multiprocessing.cpu_count()
+    nt = max(min(nt, (size - data_start) // MIN_BYTES_PER_THREAD), 1)
+
+    cdef Py_ssize_t[::1] name_start = np.empty(n, dtype = np.intp)
+    cdef Py_ssize_t[::1] name_len = np.empty(n, dtype = np.intp)
+    cdef Py_ssize_t[::1] num_atoms = np.empty(n, dtype = np.intp)
+    cdef Py_ssize_t[::1] num_cells = np.empty(n, dtype = np.intp)
+    cdef Py_ssize_t[::1] cells_start = np.empty(n, dtype = np.intp)
+    offsets_arr = np.zeros(n + 1, dtype = np.int64)
+    cdef np.int64_t[::1] offsets = offsets_arr
+    cdef Py_ssize_t[::1] result = np.empty(n, dtype = np.intp)
+
+    # first pass: parse the unit headers
+    for u in prange(n, nogil = True, schedule = 'guided', num_threads = nt):
+        cells_start[u] = parse_unit_header(data, starts[u], starts[u + 1],
+                &name_start[u], &name_len[u], &num_atoms[u], &num_cells[u])
+        if probes == PROBES_ALL:
+            offsets[u + 1] = num_cells[u]
+        else:
+            offsets[u + 1] = num_atoms[u]
+
+    for u in range(n):
+        if cells_start[u] < 0:
+            raise ValueError('Invalid header of unit %d in CDF file "%s".'
+                             %(u, path))
+    np.cumsum(offsets_arr, out = offsets_arr)
+
+    indices_arr = np.empty(offsets_arr[n], dtype = np.uint32)
+    cdef np.uint32_t[::1] indices = indices_arr
+    cdef np.uint32_t* ind_ptr = NULL
+    if indices.shape[0] > 0:
+        ind_ptr = &indices[0]
+
+    # second pass: parse the cell lines
+    for u in prange(n, nogil = True, schedule = 'guided', num_threads = nt):
+        result[u] = parse_unit_cells(data, cells_start[u], starts[u + 1],
+                num_cells[u], probes, rows, ind_ptr + offsets[u],
+                offsets[u + 1] - offsets[u])
+
+    for u in range(n):
+        if result[u] < 0:
+            raise ValueError('Invalid cell data in unit %d in CDF file "%s".'
+                             %(u, path))
+        elif result[u] != offsets[u + 1] - offsets[u]:
+            raise ValueError('Unexpected number of probes in unit %d in CDF '
+                             'file "%s" (expected %d, found %d).'
+                             %(u, path, offsets[u + 1] - offsets[u],
+                               result[u]))
+
+    names = [data[name_start[u]:name_start[u] + name_len[u]].decode(
+                'iso-8859-1') for u in range(n)]
+    probesets = ProbesetIndex(names, offsets_arr, indices_arr)
+
+    if use_cache:
+        cache.store_cdf(file_hash, probe_type, chip_name, int(num_rows),
+                int(num_cols), probesets.names, probesets.offsets,
+                probesets.indices)
+
+    return chip_name, int(num_rows), int(num_cols), probesets
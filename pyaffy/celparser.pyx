@@ -29,13 +29,17 @@ from builtins import str as text
 from builtins import open
 
 cimport cython
+from cython.parallel cimport prange
 
 from libc.stddef cimport size_t
-from libc.stdlib cimport malloc, atol
+from libc.stdlib cimport malloc, free, atol, strtof
 from libc.stdint cimport int16_t, int32_t, uint32_t
-from libc.stdio  cimport FILE, fopen, fread, fclose, fgets, sscanf
-from libc.string cimport strlen, strcmp
-# from libc.math cimport NAN
+from libc.stdio  cimport FILE, fopen, fread, fclose, fgets, sscanf, ftell, fseek, SEEK_CUR
+from libc.string cimport strlen, strcmp, memcpy, memchr
+from libc.math cimport NAN
+
+cdef extern from "stdio.h":
+    FILE* fmemopen(void* buf, size_t size, const char* mode)
 
 #from libc.string cimport memcpy
 #cdef extern from "stdio.h":
@@ -48,40 +52,31 @@ np.import_array()
 
 import sys
 import os
-import stat
-import subprocess
+import re
 import logging
-import tempfile
-import gzip
+import warnings
 import io
 import struct
-import dateutil
 import codecs
-from collections import OrderedDict
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict, namedtuple
+
 
+from configparser import ConfigParser
 
-from configparser import ConfigParser, ParsingError
+from . import compression
+from . import cache
 
 logger = logging.getLogger(__name__)
 logger.debug('__name__: %s', __name__)
 
-cdef inline float decode_float(void* buf):
-    return (<float*>buf)[0]
-
-cdef inline int16_t decode_int16(void* buf):
-    return (<int16_t*>buf)[0]
-
 cdef inline int32_t decode_int32(void* buf):
     return (<int32_t*>buf)[0]
 
 cdef inline uint32_t decode_uint32(void* buf):
     return (<uint32_t*>buf)[0]
 
-cdef float read_float(void* buf, FILE* fp):
-    fread(buf, 4, 1, fp)
-    cdef float val = decode_float(buf)
-    return val
-
 cdef int read_integer(void* buf, FILE* fp):
     fread(buf, 4, 1, fp)
     cdef int val = <int>decode_int32(buf)
@@ -92,152 +87,471 @@ cdef unsigned int read_DWORD(void* buf, FILE* fp):
     cdef unsigned int val = <unsigned int>decode_uint32(buf)
     return val
 
-cdef int read_short(void* buf, FILE* fp):
-    fread(buf, 2, 1, fp)
-    cdef int val = <int>decode_int16(buf)
-    return val
-
-cdef float[::1] read_cell_intensities(void* buf, FILE* fp, int num_rows, int num_cols):
-    cdef int i, j
-    cdef int pos = 0
-
-    cdef float[::1] y = np.empty(num_rows * num_cols, dtype = np.float32)
-
-    for i in range(num_rows):
-        for j in range(num_cols):
-            y[pos] = read_float(buf, fp) # the intensity
-            read_float(buf, fp) # intensity_std
-            read_short(buf, fp) # pixel_count
-            pos += 1
-
-    return y
-
-cdef char* read_string(void* buf, FILE* fp):
+# the layout of a cell record in Version 4 CEL files (10 bytes per cell)
+V4_CELL_DTYPE = np.dtype([
+    ('intensity', '<f4'),
+    ('stdev', '<f4'),
+    ('pixels', '<i2'),
+])
+
+cdef read_cell_records(FILE* fp, int num_cells):
+    """Reads the records of all cells with a single `fread` call."""
+    cells = np.empty(num_cells, dtype = V4_CELL_DTYPE)
+    cdef void* cells_data = np.PyArray_DATA(cells)
+    cdef size_t num_read
+    with nogil:
+        num_read = fread(cells_data, 10, <size_t>num_cells, fp)
+    if num_read != <size_t>num_cells:
+        raise IOError('Unexpected end of file while reading cell data.')
+    return cells
+
+cdef bytes read_string(void* buf, FILE* fp):
     cdef int num_bytes = read_integer(buf, fp)
     cdef char* string = <char*>malloc(<size_t>(num_bytes + 1))
-    fread(string, <size_t>num_bytes, 1, fp)
-    string[num_bytes] = '\0'
-    return string
+    cdef bytes s
+    try:
+        fread(string, <size_t>num_bytes, 1, fp)
+        string[num_bytes] = '\0'
+        s = string[:num_bytes]
+    finally:
+        free(string)
+    return s
+
+def _is_tag_val_list(s):
+    """Tests if each line of `s` is a "tag=value" entry (or a comment)."""
+    for line in s.splitlines():
+        l = line.strip()
+        # indented lines continue the value of the previous entry
+        if l and not line[0].isspace() and l[0] not in '#;' and '=' not in l:
+            return False
+    return True
 
 cdef read_tag_val(void* buf, FILE* fp):
     """Returns an OrderedDict containing tag-value entries."""
 
     s = read_string(buf, fp).decode('iso-8859-1')
     # s = codecs.decode(read_string(buf, fp), encoding='iso-8859-1')
-    try:
+    # the entries are either "tag=value" lines, or "tag:value" pairs
+    # separated by semicolons (the format is determined beforehand, since a
+    # ParsingError would create a reference cycle between its traceback and
+    # the parser's frames, which keeps all callers' frames alive)
+    if _is_tag_val_list(s):
         C = ConfigParser(interpolation = None, delimiters = ('=',), empty_lines_in_values = False)
         C.optionxform = lambda x: x
         C.read_string(str('[Section]\n') + s)
-    except ParsingError:
+    else:
         C = ConfigParser(interpolation = None, delimiters = (':',), empty_lines_in_values = False)
         C.optionxform = lambda x: x
         C.read_string(str('[Section]\n') + '\n'.join(s.split(';')))
         
     return C['Section']
 
-cdef short[:,::1] read_coords(void* buf, FILE* fp, int num_coords):
+cdef short[:,::1] read_coords(FILE* fp, int num_coords):
     cdef short[:,::1] C = np.empty((num_coords, 2), dtype = np.int16)
-    cdef int i
-    for i in range(num_coords):
-        C[i,0] = read_short(buf, fp)
-        C[i,1] = read_short(buf, fp)
+    cdef size_t num_read
+    if num_coords > 0:
+        with nogil:
+            num_read = fread(&C[0,0], 4, <size_t>num_coords, fp)
+        if num_read != <size_t>num_coords:
+            raise IOError('Unexpected end of file while reading coordinates.')
     return C
 
-cdef void apply_mask(float[::1] y, int num_rows, int num_cols, short [:,::1] coords, int num_coords):
+cdef void apply_mask(float[::1] y, int num_rows, int num_cols, short [:,::1] coords, int num_coords) nogil:
     cdef int i, idx
     for i in range(num_coords):
         idx = num_rows * coords[i,1] + coords[i,0]
-        #y[idx] = NAN
-        y[idx] = float('nan')
-
-def create_gzip_pipe(path):
-
-    tfh = tempfile.NamedTemporaryFile(mode = 'wb', prefix = 'celparser_',
-            delete = False)
-    temp = tfh.name
-    logger.debug('Temp file: %s', temp)
-    tfh.close()
-    os.remove(temp) # delete the temp file
-    os.mkfifo(temp)
-    subproc = subprocess.Popen('gunzip -c "%s" > "%s"' %(path, temp), shell = True)
-    return temp
-
-def parse_celfile_v3(path, compressed = True, newline_chars = 2):
-    """Parser for CEL file data in Version 3 format (plain-text).
+        y[idx] = NAN
 
-    Currently, no support for parsing information on outliers and masked data.
-    """
-    assert isinstance(path, (text, str))
-    assert isinstance(compressed, bool)
-    assert isinstance(newline_chars, int)
-
-    cdef int buf_size = 1000
-    cdef size_t nl = <size_t>newline_chars
-    cdef char* buf = <char*>malloc(buf_size)
-    cdef FILE* fp
+ctypedef fused cell_index_t:
+    np.uint32_t
+    np.int32_t
+    np.int64_t
 
-    cdef int num_cells
-    cdef int i
-    cdef float[::1] y
+cdef inline uint32_t bswap32(uint32_t u) nogil:
+    return (u >> 24) | ((u >> 8) & 0xff00) | ((u << 8) & 0xff0000) | (u << 24)
 
-    final_path = path
-    if compressed:
-        # file is compressed (we assume gzip)
-        # create a named pipe
-        logger.debug('Parsing file: %s', path)
-        final_path = create_gzip_pipe(path)
-
-    path_bytes = final_path.encode('UTF-8')
-    cdef char* c_path_bytes = path_bytes
-    fp = fopen(c_path_bytes, 'r')
-
-    try:
-        # parsing starts here
-
-        # check header information
-        fgets(buf, buf_size, fp)
-        buf[strlen(buf) - nl] = '\0' # remove newline
-        assert strcmp(buf, "[CEL]") == 0
-        fgets(buf, buf_size, fp)
-        buf[strlen(buf) - nl] = '\0' # remove newline
-        assert strcmp(buf, "Version=3") == 0
-
-        # get the number of cells
-        # find NumberCells=...
-        while sscanf(buf, "NumberCells=%d", &num_cells) <= 0:
-            fgets(buf, buf_size, fp)
-            buf[strlen(buf) - nl] = '\0'
-
-        fgets(buf, buf_size, fp) # skip CellHeader line
-
-        # read intensities
-        y = np.empty(num_cells, dtype = np.float32)
-        for i in range(num_cells):
-            fgets(buf, buf_size, fp)
-            # the following works even if rows starts with whitespace(s)
-            sscanf(buf, "%*d %*d %f", &y[i])
+cdef void gather_floats(char* data, Py_ssize_t stride, bint swap,
+        const cell_index_t[::1] index, float[:] out) nogil:
+    """Copies the 4-byte floats at the given positions into `out`.
 
-    finally:
-        fclose(fp)
-        if compressed:
-            os.remove(final_path)
+    The floats are stored `stride` bytes apart (not necessarily aligned),
+    and have to be byte-swapped if `swap` is True.
+    """
+    cdef Py_ssize_t k
+    cdef uint32_t u
+    for k in range(index.shape[0]):
+        memcpy(&u, data + stride * <Py_ssize_t>index[k], 4)
+        if swap:
+            u = bswap32(u)
+        memcpy(&out[k], &u, 4)
+
+cdef void copy_floats(char* data, Py_ssize_t stride, bint swap,
+        float[:] out) nogil:
+    """Copies all 4-byte floats into `out` (see `gather_floats`)."""
+    cdef Py_ssize_t k
+    cdef uint32_t u
+    for k in range(out.shape[0]):
+        memcpy(&u, data + stride * k, 4)
+        if swap:
+            u = bswap32(u)
+        memcpy(&out[k], &u, 4)
+
+def _gather_cells(y, index, out):
+    """Writes the intensities of the selected cells into `out`.
+
+    `y` can be any one-dimensional array (or view) of 4-byte floats, in
+    either byte order and with arbitrary strides (e.g., the intensity field
+    of the cell records of a Version 4 CEL file). If `index` is None, all
+    cells are selected. If `out` is None, a new array is returned.
+    """
+    assert isinstance(y, np.ndarray) and y.ndim == 1
+    assert y.dtype.kind == 'f' and y.dtype.itemsize == 4
+
+    num_cells = y.size
+    if index is not None:
+        index = np.asarray(index)
+        if index.dtype not in (np.uint32, np.int32, np.int64):
+            index = index.astype(np.int64)
+        index = np.ascontiguousarray(index)
+        assert index.ndim == 1
+        if index.size > 0 and \
+                (np.amin(index) < 0 or np.amax(index) >= y.size):
+            raise IndexError('Cell index out of range (the array has %d '
+                             'cells).' %(y.size))
+        num_cells = index.size
+
+    if out is None:
+        out = np.empty(num_cells, dtype = np.float32)
+    else:
+        assert isinstance(out, np.ndarray)
+        if out.dtype != np.float32 or out.shape != (num_cells,):
+            raise ValueError('"out" must be a one-dimensional float32 array '
+                             'with %d elements.' %(num_cells))
+
+    cdef char* data = <char*>np.PyArray_DATA(y)
+    cdef Py_ssize_t stride = y.strides[0]
+    cdef bint swap = not y.dtype.isnative
+    cdef float[:] out_view = out
+    cdef const np.uint32_t[::1] index_u32
+    cdef const np.int32_t[::1] index_i32
+    cdef const np.int64_t[::1] index_i64
+
+    if index is None:
+        with nogil:
+            copy_floats(data, stride, swap, out_view)
+    elif index.dtype == np.uint32:
+        index_u32 = index
+        with nogil:
+            gather_floats(data, stride, swap, index_u32, out_view)
+    elif index.dtype == np.int32:
+        index_i32 = index
+        with nogil:
+            gather_floats(data, stride, swap, index_i32, out_view)
+    else:
+        index_i64 = index
+        with nogil:
+            gather_floats(data, stride, swap, index_i64, out_view)
 
-    return np.float32(y)
+    return out
 
+cdef FILE* open_cel_file(path, bytes data) except NULL:
+    """Opens a CEL file (or its decompressed contents) for reading."""
+    cdef FILE* fp
+    if data is not None:
+        # read from the decompressed data in memory
+        fp = fmemopen(<char*>data, len(data), 'rb')
+    else:
+        path_bytes = path.encode('UTF-8')
+        fp = fopen(path_bytes, 'rb')
+    if fp == NULL:
+        raise IOError('Could not open CEL file "%s".' %(path))
+    return fp
+
+# powers of ten that are exactly representable as single-precision floats
+cdef float POW10_FLOAT[11]
+for _k in range(11):
+    POW10_FLOAT[_k] = 10.0 ** _k
+
+# the minimum number of bytes per thread when parsing in parallel
+cdef enum:
+    MIN_BYTES_PER_THREAD = 1048576
+
+cdef inline bint is_blank(char c) nogil:
+    return c == b' ' or c == b'\t'
+
+cdef inline bint is_delim(char c) nogil:
+    return c == b' ' or c == b'\t' or c == b'\r' or c == b'\n'
+
+cdef inline bint is_digit(char c) nogil:
+    return c >= b'0' and c <= b'9'
+
+cdef int parse_float(const char* p, const char* end, float* value) nogil:
+    """Parses a decimal number, as `strtof` does.
+
+    For numbers with at most seven significant digits and at most ten
+    decimals (such as all intensities written by Affymetrix software), the
+    value is calculated with a single (correctly rounded) floating-point
+    division of two exactly representable numbers. Other numbers are passed
+    to `strtof`. Returns -1 if the field is not a valid number.
+    """
+    cdef const char* q = p
+    cdef bint neg = False
+    cdef np.int64_t m = 0
+    cdef int num_digits = 0
+    cdef int num_decimals = 0
+    cdef char tmp[64]
+    cdef char* tmp_end
+    cdef Py_ssize_t n
+
+    if q < end and (q[0] == b'-' or q[0] == b'+'):
+        neg = (q[0] == b'-')
+        q += 1
+    while q < end and is_digit(q[0]) and num_digits < 18:
+        m = 10 * m + (q[0] - c'0')
+        num_digits += 1
+        q += 1
+    if q < end and q[0] == b'.':
+        q += 1
+        while q < end and is_digit(q[0]) and num_digits < 18:
+            m = 10 * m + (q[0] - c'0')
+            num_digits += 1
+            num_decimals += 1
+            q += 1
+
+    if num_digits > 0 and (q == end or is_delim(q[0])) and \
+            m <= 16777216 and num_decimals <= 10:
+        # fast path
+        value[0] = <float>m / POW10_FLOAT[num_decimals]
+        if neg:
+            value[0] = -value[0]
+        return 0
+
+    # slow path (e.g., for exponents, "nan", or many digits)
+    n = 0
+    while p + n < end and not is_delim(p[n]) and n < 63:
+        tmp[n] = p[n]
+        n += 1
+    tmp[n] = b'\0'
+    value[0] = strtof(tmp, &tmp_end)
+    if n == 0 or tmp_end != tmp + n:
+        return -1
+    return 0
+
+cdef Py_ssize_t parse_cell_lines(const char* data, Py_ssize_t start,
+        Py_ssize_t stop, Py_ssize_t first, Py_ssize_t num_cells,
+        float* y) nogil:
+    """Parses the intensities in the cell lines starting in a byte range.
+
+    Each line contains the X and Y coordinates of a cell, followed by its
+    intensity (and possibly other values), separated by whitespace. The
+    first line in the range is the line of cell `first`. Lines after the
+    line of the last cell are ignored.
+
+    Returns the number of parsed lines, or -(i + 1) if line i is invalid.
+    """
+    cdef const char* p = data + start
+    cdef const char* end = data + stop
+    cdef const char* line_end
+    cdef Py_ssize_t i = first
+    cdef int f
+
+    while p < end and i < num_cells:
+        line_end = <const char*>memchr(p, b'\n', end - p)
+        if line_end == NULL:
+            line_end = end
+        # skip the coordinates
+        for f in range(2):
+            while p < line_end and is_blank(p[0]):
+                p += 1
+            if p == line_end or is_delim(p[0]):
+                return -(i + 1)
+            while p < line_end and not is_delim(p[0]):
+                p += 1
+        while p < line_end and is_blank(p[0]):
+            p += 1
+        if parse_float(p, line_end, &y[i]) != 0:
+            return -(i + 1)
+        i += 1
+        p = line_end + 1
+
+    return i - first
+
+cdef Py_ssize_t count_lines(const char* data, Py_ssize_t start,
+        Py_ssize_t stop) nogil:
+    """Counts the lines that start in a byte range."""
+    cdef const char* p = data + start
+    cdef const char* end = data + stop
+    cdef Py_ssize_t n = 0
+    while p < end:
+        p = <const char*>memchr(p, b'\n', end - p)
+        n += 1
+        if p == NULL:
+            break
+        p += 1
+    return n
+
+def parse_celfile_v3(path, compressed = True, newline_chars = None,
+        index = None, out = None, num_threads = 1):
+    """Parser for CEL file data in Version 3 format (plain-text).
 
-def parse_celfile_v4(path, compressed=True, ignore_outliers=True, ignore_masked=True):
+    Currently, no support for parsing information on outliers and masked data.
+    Compressed files (gzip, bzip2, or xz) are decompressed in memory, and
+    uncompressed files are memory-mapped. Line endings (LF or CRLF) are
+    detected automatically (`newline_chars` is deprecated and ignored, and a
+    DeprecationWarning is issued if it is specified).
+
+    The intensity section can be split into byte ranges that are parsed in
+    parallel, using `num_threads` threads (0 = use all available cores).
+    Each range starts at a line boundary, and the index of its first cell is
+    determined by counting the lines in the preceding ranges. For `index` and
+    `out`, see `parse_cel`.
+    """
+    assert isinstance(path, (text, str))
+    assert isinstance(compressed, bool)
+    assert isinstance(num_threads, int)
+
+    if newline_chars is not None:
+        warnings.warn('The "newline_chars" parameter is deprecated and '
+                      'ignored (line endings are detected automatically).',
+                      DeprecationWarning, stacklevel = 2)
+
+    buf = compression.read_array(path, compressed)
+    cdef const unsigned char[::1] view = buf
+    cdef Py_ssize_t size = view.shape[0]
+    cdef const char* data = b''
+    if size > 0:
+        data = <const char*>&view[0]
+
+    cdef Py_ssize_t pos = 0
+    cdef Py_ssize_t line_end
+    cdef const char* p
+    cdef Py_ssize_t num_cells = -1
+
+    # parse the header, line by line
+    lines = []
+    while pos < size:
+        p = <const char*>memchr(data + pos, b'\n', size - pos)
+        line_end = size if p == NULL else p - data
+        line = data[pos:line_end]
+        if len(lines) == 0:
+            logger.debug('Line endings: %s',
+                         'CRLF' if line.endswith(b'\r') else 'LF')
+        line = line.rstrip(b'\r')
+        lines.append(line)
+        pos = line_end + 1
+        if len(lines) <= 2:
+            expected = [b'[CEL]', b'Version=3'][len(lines) - 1]
+            if line != expected:
+                raise ValueError('Invalid Version 3 CEL file "%s" '
+                                 '(expected "%s" in line %d).'
+                                 %(path, expected.decode('ascii'),
+                                   len(lines)))
+        elif num_cells == -1 and line.startswith(b'NumberCells='):
+            num_cells = int(line[len(b'NumberCells='):])
+        elif num_cells >= 0:
+            # this is the CellHeader line
+            break
+
+    if num_cells < 0 or pos > size:
+        raise IOError('Unexpected end of file "%s" (no intensities found).'
+                      %(path))
+    logger.debug('Number of cells: %d', num_cells)
+
+    cdef Py_ssize_t data_start = min(pos, size)
+    cdef int nt = num_threads
+    if nt <= 0:
+        nt = multiprocessing.cpu_count()
+    nt = max(min(nt, (size - data_start) // MIN_BYTES_PER_THREAD), 1)
+
+    # split the data into byte ranges that start at line boundaries
+    cdef Py_ssize_t[::1] starts = np.empty(nt + 1, dtype = np.intp)
+    cdef Py_ssize_t[::1] first = np.zeros(nt + 1, dtype = np.intp)
+    cdef Py_ssize_t[::1] result = np.empty(nt, dtype = np.intp)
+    cdef Py_ssize_t b
+    cdef int t
+    starts[0] = data_start
+    starts[nt] = size
+    for t in range(1, nt):
+        b = data_start + (size - data_start) * t // nt
+        p = <const char*>memchr(data + b - 1, b'\n', size - b + 1)
+        starts[t] = size if p == NULL else (p - data) + 1
+        starts[t] = max(starts[t], starts[t - 1])
+
+    y_arr = np.empty(num_cells, dtype = np.float32)
+    cdef float[::1] y = y_arr
+    cdef float* y_ptr = &y[0] if num_cells > 0 else NULL
+
+    with nogil:
+        if nt > 1:
+            # determine the index of the first cell in each range
+            for t in prange(nt, schedule = 'static', num_threads = nt):
+                first[t + 1] = count_lines(data, starts[t], starts[t + 1])
+            for t in range(nt):
+                first[t + 1] += first[t]
+
+        for t in prange(nt, schedule = 'static', num_threads = nt):
+            result[t] = parse_cell_lines(data, starts[t], starts[t + 1],
+                                         first[t], num_cells, y_ptr)
+
+    num_parsed = 0
+    for t in range(nt):
+        if result[t] < 0:
+            raise ValueError('Invalid data for cell %d in CEL file "%s".'
+                             %(-result[t] - 1, path))
+        num_parsed += result[t]
+    if num_parsed < num_cells:
+        raise IOError('Unexpected end of file "%s" (expected %d cells, '
+                      'found %d).' %(path, num_cells, num_parsed))
+
+    if index is not None or out is not None:
+        return _gather_cells(y_arr, index, out)
+    return y_arr
+
+
+def parse_celfile_v4(path, compressed=True, ignore_outliers=True,
+        ignore_masked=True, full_output=False, mmap=False, index=None,
+        out=None):
     """Parser for CEL file data in Version 4 format.
 
     See: http://media.affymetrix.com/support/developer/powertools/changelog/gcos-agcc/cel.html#V4
-    Data encoding is little endian.
+    Data encoding is little endian. Compressed files (gzip, bzip2, or xz) are
+    decompressed in memory.
+
+    The cell records (intensity, standard deviation, and pixel count) are read
+    as one block. If `full_output` is True, the function returns a tuple
+    containing the intensities, standard deviations (np.float32), and pixel
+    counts (np.int16) of all cells. Otherwise, only the intensities are
+    returned.
+
+    If `mmap` is True, the cell records of the (uncompressed) file are not
+    read, but memory-mapped, and the returned arrays are read-only views on
+    the mapped data. Only the pages that are actually accessed are read from
+    disk. If any masked or outlier cells are set to NaN, a copy of the
+    intensities is made.
+
+    If `index` or `out` is given (see `parse_cel`), the intensities of the
+    selected cells are copied directly from the cell records (which are
+    memory-mapped for uncompressed files, regardless of `mmap`). In that
+    case, `full_output` must be False.
     """
     assert isinstance(path, (text, str))
     assert isinstance(compressed, bool)
     assert isinstance(ignore_outliers, bool)
     assert isinstance(ignore_masked, bool)
+    assert isinstance(full_output, bool)
+    assert isinstance(mmap, bool)
+
+    if mmap and compressed:
+        raise ValueError('Memory-mapping requires an uncompressed file.')
+
+    gather = (index is not None or out is not None)
+    if gather and full_output:
+        raise ValueError('"full_output" cannot be combined with "index" or '
+                         '"out".')
 
     cdef FILE* fp
-    cdef void* buf = malloc(10)
+    cdef char buf[10]
+    cdef long offset
 
     """
     def read_subgrid(fh):
@@ -262,16 +576,13 @@ def parse_celfile_v4(path, compressed=True, ignore_outliers=True, ignore_masked=
     #cdef int i, j
     #cdef int x, y
 
-    final_path = path
+    data = None
     if compressed:
-        # file is compressed (we assume gzip)
-        # create a named pipe
-        logger.debug('Parsing file: %s', path)
-        final_path = create_gzip_pipe(path)
+        # decompress the file in memory
+        logger.debug('Decompressing file: %s', path)
+        data = compression.read_file(path)
 
-    path_bytes = final_path.encode('UTF-8')
-    cdef char* c_path_bytes = path_bytes
-    fp = fopen(c_path_bytes, 'r')
+    fp = open_cel_file(path, data)
 
     try:
 
@@ -289,15 +600,16 @@ def parse_celfile_v4(path, compressed=True, ignore_outliers=True, ignore_masked=
         logger.debug('Number of cols: %d', num_cols)
         logger.debug('Number of cells: %d', num_cells)
         header = read_tag_val(buf, fp)
-        logger.debug('Header information:')
-        logger.debug('  ' + '; '.join(['%s = %s' %(k,v)
-                for k,v in header.items()]))
-        algo_name = str(read_string(buf, fp))
-        logger.debug('Algorithm name: %s', algo_name)
-        logger.debug('Algorithm parameters:')
+        algo_name = read_string(buf, fp).decode('iso-8859-1')
         algo_params = read_tag_val(buf, fp)
-        logger.debug('  ' + '; '.join(['%s = %s' %(k,v)
-                for k,v in algo_params.items()]))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Header information:')
+            logger.debug('  ' + '; '.join(['%s = %s' %(k,v)
+                    for k,v in header.items()]))
+            logger.debug('Algorithm name: %s', algo_name)
+            logger.debug('Algorithm parameters:')
+            logger.debug('  ' + '; '.join(['%s = %s' %(k,v)
+                    for k,v in algo_params.items()]))
 
         cell_margin = read_integer(buf, fp)
         logger.debug('Cell margin: %d', cell_margin)
@@ -311,16 +623,43 @@ def parse_celfile_v4(path, compressed=True, ignore_outliers=True, ignore_masked=
         num_subgrids = read_integer(buf, fp)
         logger.debug('# subgrids: %d', num_subgrids)
         
-        y = read_cell_intensities(buf, fp, num_rows, num_cols)
+        offset = ftell(fp)
+        # when only selected cells are needed, there is no need to read all
+        # cell records of an uncompressed file
+        map_cells = (mmap or (gather and data is None)) and num_cells > 0
+        if map_cells:
+            # map the cell records into memory and skip them
+            logger.debug('Memory-mapping cell data at offset %d', offset)
+            if os.path.getsize(path) < offset + 10 * num_cells:
+                raise IOError('Unexpected end of file while reading cell data.')
+            cells = np.memmap(path, dtype = V4_CELL_DTYPE, mode = 'r',
+                    offset = offset, shape = (num_cells,))
+        elif data is not None:
+            # use the cell records in the decompressed data, and skip them
+            if len(data) < offset + 10 * num_cells:
+                raise IOError('Unexpected end of file while reading cell data.')
+            cells = np.frombuffer(data, dtype = V4_CELL_DTYPE,
+                    count = num_cells, offset = offset)
+        else:
+            cells = read_cell_records(fp, num_cells)
+        if map_cells or data is not None:
+            if fseek(fp, 10 * <long>num_cells, SEEK_CUR) != 0:
+                raise IOError('Unexpected end of file while reading cell data.')
+
+        y = cells['intensity']
+        if not (ignore_masked and ignore_outliers) or \
+                not (mmap or gather):
+            # copy the intensities (without holding the GIL)
+            y = _gather_cells(y, None, None)
         logger.debug('# cells: %d', y.size)
 
-        masked_coords = read_coords(buf, fp, num_masked_cells)
+        masked_coords = read_coords(fp, num_masked_cells)
         if not ignore_masked:
             apply_mask(y, num_rows, num_cols, masked_coords, num_masked_cells)
         else:
             logger.debug('Ignoring any masked cells')
         
-        outlier_coords = read_coords(buf, fp, num_outlier_cells)
+        outlier_coords = read_coords(fp, num_outlier_cells)
         if not ignore_outliers:
             apply_mask(y, num_rows, num_cols, outlier_coords, num_outlier_cells)
         else:
@@ -331,316 +670,221 @@ def parse_celfile_v4(path, compressed=True, ignore_outliers=True, ignore_masked=
         #    subgrids.append(read_subgrid(fh))
 
     finally:
-        if compressed:
-            os.remove(final_path)
-
-    return np.float32(y)
-
-
-#cdef unsigned char read_UBYTE(char* buf, FILE* fp):
-#    fread(buf, 1, 1, fp)
-#    cdef unsigned char c = (<unsigned char*>buf)[0]
-#    return c
-
-#cdef int read_INT(char* buf, char* buf2, FILE* fp):
-#    fread(buf2, 4, 1, fp)
-#    reverse_copy(buf2, buf, 4)
-#    cdef int val = <int>decode_int32(buf)
-#    return val
-
-#cdef unsigned int read_UINT(char* buf, char* buf2, FILE* fp):
-#    fread(buf2, 4, 1, fp)
-#    reverse_copy(buf2, buf, 4)
-#    cdef unsigned int val = <int>decode_uint32(buf)
-#    return val
-
-
-cdef void reverse_copy(const char* src, char* dst, int num):
-    cdef int i
-    for i in range(num):
-        dst[num - i - 1] = src[i]
+        fclose(fp)
 
-cdef float read_FLOAT(char* buf, char* data):
-    reverse_copy(data, buf, 4)
-    cdef float val = (<float*>buf)[0]
-    return val
+    if full_output:
+        if mmap:
+            stdev = cells['stdev']
+            pixels = cells['pixels']
+        else:
+            stdev = np.ascontiguousarray(cells['stdev'], dtype = np.float32)
+            pixels = np.ascontiguousarray(cells['pixels'], dtype = np.int16)
+        return y, stdev, pixels
 
-cdef float[::1] read_cc_intensities(char* data, unsigned int num_values):
-    cdef float[::1] y = np.empty(num_values, dtype = np.float32)
-    cdef unsigned int i
-    cdef char* buf = <char*>malloc(10)
-    for i in range(num_values):
-        y[i] = read_FLOAT(buf, data)
-        data += 4
+    if gather:
+        return _gather_cells(y, index, out)
     return y
 
-def parse_celfile_cc(path, compressed=True, ignore_outliers=True, ignore_masked=True):
+
+### Command Console ("Calvin") format (big-endian)
+
+_CC_UBYTE = struct.Struct('>B')
+_CC_INT8 = struct.Struct('>b')
+_CC_INT16 = struct.Struct('>h')
+_CC_UINT16 = struct.Struct('>H')
+_CC_INT32 = struct.Struct('>i')
+_CC_UINT32 = struct.Struct('>I')
+_CC_FLOAT = struct.Struct('>f')
+
+# decoders for typed header parameter values
+_CC_PARAM_DECODERS = {
+    'text/x-calvin-float': lambda v: _CC_FLOAT.unpack(v[:4])[0],
+    'text/x-calvin-integer-32': lambda v: _CC_INT32.unpack(v[:4])[0],
+    'text/x-calvin-unsigned-integer-32': lambda v: _CC_UINT32.unpack(v[:4])[0],
+    'text/x-calvin-integer-16': lambda v: _CC_INT16.unpack(v[:2])[0],
+    'text/x-calvin-unsigned-integer-16': lambda v: _CC_UINT16.unpack(v[:2])[0],
+    'text/x-calvin-integer-8': lambda v: _CC_INT8.unpack(v[:1])[0],
+    'text/x-calvin-unsigned-integer-8': lambda v: _CC_UBYTE.unpack(v[:1])[0],
+    'text/plain': lambda v: codecs.decode(v, 'UTF-16-BE').rstrip('\x00'),
+    'text/ascii': lambda v: codecs.decode(v, 'ascii').rstrip('\x00'),
+}
+
+def _cc_read(fh, num_bytes):
+    data = fh.read(num_bytes)
+    if len(data) != num_bytes:
+        raise IOError('Unexpected end of file.')
+    return data
+
+def _cc_read_int(fh):
+    return _CC_INT32.unpack(_cc_read(fh, 4))[0]
+
+def _cc_read_uint(fh):
+    return _CC_UINT32.unpack(_cc_read(fh, 4))[0]
+
+def _cc_read_string(fh):
+    return _cc_read(fh, _cc_read_int(fh))
+
+def _cc_read_wstring(fh):
+    return codecs.decode(_cc_read(fh, 2 * _cc_read_int(fh)), 'UTF-16-BE')
+
+def _cc_read_params(fh):
+    """Reads a list of name/value/type triplets."""
+    num_params = _cc_read_int(fh)
+    params = OrderedDict()
+    for i in range(num_params):
+        name = _cc_read_wstring(fh)
+        value = _cc_read_string(fh)
+        value_type = _cc_read_wstring(fh)
+        try:
+            decode = _CC_PARAM_DECODERS[value_type]
+        except KeyError:
+            pass
+        else:
+            value = decode(value)
+        params[name] = value
+    return params
+
+def _cc_read_data_header(fh):
+    """Reads a (generic) data header, including all parent headers."""
+    header = OrderedDict()
+    header['data_type_id'] = _cc_read_string(fh).decode('ascii')
+    header['file_id'] = _cc_read_string(fh)
+    header['creation_time'] = _cc_read_wstring(fh)
+    header['locale'] = _cc_read_wstring(fh)
+    header['params'] = _cc_read_params(fh)
+    num_parents = _cc_read_int(fh)
+    header['parents'] = [_cc_read_data_header(fh) for i in range(num_parents)]
+    return header
+
+def _cc_read_file_header(fh):
+    """Reads the file header and returns the position of the first group."""
+    magic_number, version_number = bytearray(_cc_read(fh, 2))
+    if magic_number != 59:
+        raise IOError('Not a Command Console file.')
+    if version_number != 1:
+        raise IOError('Unsupported Command Console file version: %d'
+                %(version_number))
+    num_data_groups = _cc_read_int(fh)
+    first_data_group_pos = _cc_read_uint(fh)
+    return num_data_groups, first_data_group_pos
+
+def _cc_read_dataset_header(fh):
+    """Reads a data set header (everything up to the data itself)."""
+    data_pos = _cc_read_uint(fh)
+    next_pos = _cc_read_uint(fh)
+    name = _cc_read_wstring(fh)
+    params = _cc_read_params(fh)
+    num_cols = _cc_read_uint(fh)
+    cols = []
+    for i in range(num_cols):
+        col_name = _cc_read_wstring(fh)
+        col_type = _CC_INT8.unpack(_cc_read(fh, 1))[0]
+        col_size = _cc_read_int(fh)
+        cols.append((col_name, col_type, col_size))
+    num_rows = _cc_read_uint(fh)
+    return name, data_pos, next_pos, params, cols, num_rows
+
+def parse_celfile_cc(path, compressed=True, ignore_outliers=True,
+        ignore_masked=True, index=None, out=None):
     """Parser for CEL file data in Command Console version 1 format.
 
     See: http://media.affymetrix.com/support/developer/powertools/changelog/gcos-agcc/cel.html#calvin
-    Note: Data byte order is big endian!
+    Note: Data byte order is big endian! Compressed files (gzip, bzip2, or xz)
+    are decompressed in memory.
+
+    The parser jumps directly to the first data group, and uses the data set
+    positions stored in the file to skip all data sets that are not required.
+    The intensities are decoded in a single vectorized operation. If `index`
+    or `out` is given (see `parse_cel`), only the intensities of the selected
+    cells are decoded.
     """
     assert isinstance(path, (text, str))
     assert isinstance(compressed, bool)
     assert isinstance(ignore_outliers, bool)
     assert isinstance(ignore_masked, bool)
 
-    read = [0]
-        
-    decode_unicode = lambda s: codecs.decode(s, 'UTF-16-BE')
-    #decode_unicode = lambda s: unicode(s, encoding = 'UTF-16-BE')
-    decode_ascii = lambda s: codecs.decode(s, 'ascii')
-    #decode_ascii = lambda s: unicode(s, encoding = 'ascii')
-    decode_float = lambda s: struct.unpack('>f', s)[0]
-    decode_int32 = lambda s: struct.unpack('>i', s)[0]
-    decode_uint32 = lambda s: struct.unpack('>I', s)[0]
-    decode_int8 = lambda s: struct.unpack('>b', s)[0]
-    decode_uint8 = lambda s: struct.unpack('>B', s)[0]
-    decode_int16 = lambda s: struct.unpack('>h', s)[0]
-    decode_uint16 = lambda s: struct.unpack('>H', s)[0]
-
-    def read_float(bytes):
-        read[0] += 4
-        return decode_float(fh.read(4))
-
-    def read_byte(fh):
-        read[0] += 1
-        return decode_int8(fh.read(1))
-
-    def read_ubyte(fh):
-        read[0] += 1
-        return decode_uint8(fh.read(1))
-
-    def read_short(fh):
-        read[0] += 2
-        return decode_int16(fh.read(2))
-
-    def read_ushort(fh):
-        read[0] += 2
-        return decode_uint16(fh.read(2))
-
-    def read_int(fh):
-        read[0] += 4
-        return decode_int32(fh.read(4))
-
-    def read_uint(fh):
-        read[0] +=4
-        return decode_uint32(fh.read(4))
-
-    def read_raw(fh):
-        # reads an int x and then x raw bytes
-        bytes = read_int(fh)
-        read[0] += bytes
-        return fh.read(bytes)
-
-    def read_string(fh):
-        strlen = read_int(fh)
-        read[0] += strlen
-        return fh.read(strlen)
-
-    def read_wstring(fh):
-        strlen = read_int(fh)
-        s = fh.read(2 * strlen)
-        read[0] += (2 * strlen)
-        return decode_unicode(s)
-
-    def read_guid(fh):
-        return read_string(fh)
-
-    def read_datetime(fh):
-        s = read_wstring(fh)
-        logger.debug('DateTime string: %s|||', s)
-        dt = None
-        if s:
-            dt = dateutil.parser.parse(s).replace(tzinfo = None)
-        #s = u'2015-02-20T13:52:11Z'
-        #print s
-        return dt
-
-    def read_locale(fh):
-        loc = read_wstring(fh)
-        return loc[:2], loc[3:]
-
-    def read_value(fh):
-        raw = read_raw(fh)
-        return raw
-
-    def read_type(fh):
-        return read_wstring(fh)
-
-    def read_file_header(fh):
-        magic_number = read_ubyte(fh)
-        logger.debug('Magic number: %d', magic_number)
-        # check magic number
-        assert isinstance(magic_number, int) and magic_number == 59
-        version_number = read_ubyte(fh)
-        # check version number
-        assert version_number == 1
-        num_data_groups = read_int(fh)
-        logger.debug('# data groups: %d', num_data_groups)
-        first_data_group_pos = read_uint(fh)
-        return num_data_groups, first_data_group_pos
-
-    def read_header_param(fh):
-        v1 = read_wstring(fh)
-        v2 = read_value(fh)
-        v3 = read_type(fh)
-
-        if v3 == 'text/plain':
-            v2 = decode_unicode(v2.rstrip('\x00'))
-        elif v3 == 'text/ascii':
-            v2 = decode_ascii(v2.rstrip('\x00'))
-        elif v3 == 'text/x-calvin-float':
-            v2 = decode_float(v2[:4])
-        elif v3 == 'text/x-calvin-integer-32':
-            v2 = decode_int32(v2[:4])
-        elif v3 == 'text/x-calvin-unsigned-integer-32':
-            v2 = decode_uint32(v2[:4])
-        elif v3 == 'text/x-calvin-unsigned-integer-8':
-            v2 = decode_uint8(v2[:1])
-        elif v3 == 'text/x-calvin-unsigned-integer-16':
-            v2 = decode_uint16(v2[:2])
-        elif v3 == 'text/x-calvin-integer-8':
-            v2 = decode_int8(v2[:1])
-        elif v3 == 'text/x-calvin-integer-16':
-            v2 = decode_int16(v2[:2])
-
-        return (v1, v2)
-
-    def read_data_header(fh):
-        data_type_id = read_guid(fh)
-        logger.debug('Data type identifier: %s', data_type_id)
-        file_id = read_guid(fh)
-        logger.debug('File identifier: %s', file_id)
-        creation_time = read_datetime(fh)
-        #print creation_time
-        iso639, iso3166 = read_locale(fh)
-        locale = '-'.join([iso639, iso3166])
-        n_params = read_int(fh)
-        logger.debug('Number of parameters (name/value/type triplets): %d', n_params)
-        params = OrderedDict()
-        for i in range(n_params):
-            params.update([read_header_param(fh)])
-
-        num_parents = read_int(fh)
-        logger.debug('Number of parent file headers: %d', num_parents)
-        
-        parent_headers = []
-        for i in range(num_parents):
-            logger.debug('')
-            logger.debug('-------------------------------------------')
-            parent_headers.append(read_data_header(fh))
-
-    def read_col(fh):
-        name = read_wstring(fh)
-        valtype = read_byte(fh)
-        size = read_int(fh)
-        return (name, valtype, size)
-
-    def read_dataset(fh):
-        logger.debug('New DataSet! Bytes read up until this point: %d', read[0])
-        data_pos = read_uint(fh)
-        next_pos = read_uint(fh)
-        data_size = next_pos - data_pos
-        name = read_wstring(fh)
-        num_params = read_int(fh)
-
-        # read parameters
-        params = OrderedDict()
-        for i in range(num_params):
-            params.update([read_header_param(fh)])
-
-        num_cols = read_uint(fh)
-        logger.debug('DataSet / # cols: %d', num_cols)
-        cols = []
-        for i in range(num_cols):
-            cols.append(read_col(fh))
-        col_names = [c[0] for c in cols]
-        logger.debug('DataSet / col names: %s', ', '.join(col_names))
-
-        num_rows = read_uint(fh)
-        logger.debug('DataSet / # rows: %d', num_rows)
-        logger.debug('DataSet / data position: %d', data_pos)
-        logger.debug('DataSet / next position: %d', next_pos)
-        logger.debug('DataSet / data size: %d', data_size)
-        logger.debug('DataSet / name: %s', name)
-        logger.debug('DataSet / # parameters: %d', num_params)
-        num_chars = next_pos - read[0]
-        data = fh.read(num_chars)
-        read[0] += num_chars
-        y = None
-        # this assumes that the column name etc. is 100% fixed
-        if name == 'Intensity':
-            assert len(cols) == 1
-            col_name = cols[0][0]
-            col_type = cols[0][1]
-            col_size = cols[0][2]
-            assert col_name == 'Intensity'
-            assert col_type == 6
-            assert col_size == 4
-            y = read_cc_intensities(data, num_rows)
-        return y
-
-    def read_data_group(fh):
-        logger.debug('New data group! Number of bytes read so far: %d', read[0])
-        next_pos = read_uint(fh)
-        dataset_pos = read_uint(fh)
-        num_datasets = read_int(fh)
-        name = read_wstring(fh)
-        logger.debug('Data group name: %s', name)
-        y = None
-        for i in range(num_datasets):
-            d = read_dataset(fh)
-            if d is not None:
-                y = d
-        return y
+    # the data sets containing the coordinates of cells to set to NaN
+    mask_datasets = set()
+    if not ignore_outliers:
+        mask_datasets.add('Outlier')
+    if not ignore_masked:
+        mask_datasets.add('Mask')
 
     fh = None
     y = None
-    final_path = path
     if compressed:
-        # file is compressed (we assume gzip)
-        # create a named pipe
-        logger.debug('Parsing file: %s', path)
-        final_path = create_gzip_pipe(path)
+        # decompress the file in memory
+        logger.debug('Decompressing file: %s', path)
+        fh = io.BytesIO(compression.read_file(path))
+    else:
+        fh = open(path, mode='rb')
 
-    fh = open(final_path, mode='rb')
     try:
-        num_data_groups, data_pos = read_file_header(fh)
+        num_data_groups, data_pos = _cc_read_file_header(fh)
         assert num_data_groups == 1 # for expression CEL file
-        logger.debug('# data groups: %d', num_data_groups)
         logger.debug('pos. of first data group: %d', data_pos)
-        #header = read_data_header(fh)
-        read_data_header(fh)
-        assert data_pos == read[0] # position of the first data group
-        y = read_data_group(fh)
-        #data_groups = []
-        #for i in range(num_data_groups):
-        #    data_groups.append(read_data_group(fh))
 
-    finally:
-        fh.close()
-        if compressed:
-            os.remove(final_path)
+        num_rows, num_cols = None, None
+        if mask_datasets:
+            # we need the array dimensions to set cells to NaN
+            header = _cc_read_data_header(fh)
+            num_rows = header['params']['affymetrix-cel-rows']
+            num_cols = header['params']['affymetrix-cel-cols']
+
+        # skip the data header
+        fh.seek(data_pos)
+        _cc_read_uint(fh) # position of the next data group
+        dataset_pos = _cc_read_uint(fh)
+        num_datasets = _cc_read_int(fh)
+        name = _cc_read_wstring(fh)
+        logger.debug('Data group name: %s', name)
 
-    return np.float32(y)
+        coords = []
+        for i in range(num_datasets):
+            fh.seek(dataset_pos)
+            name, data_pos, next_pos, params, cols, num_cells = \
+                    _cc_read_dataset_header(fh)
+            logger.debug('DataSet "%s": %d rows, data position: %d',
+                    name, num_cells, data_pos)
+            if name == 'Intensity':
+                # this assumes that the column name etc. is 100% fixed
+                assert cols == [('Intensity', 6, 4)]
+                fh.seek(data_pos)
+                y = np.frombuffer(_cc_read(fh, 4 * num_cells), dtype = '>f4')
+            elif name in mask_datasets and num_cells > 0:
+                assert len(cols) == 2 and all(c[2] == 2 for c in cols)
+                fh.seek(data_pos)
+                C = np.frombuffer(_cc_read(fh, 4 * num_cells), dtype = '>i2')
+                coords.append(C.reshape(num_cells, 2).astype(np.int16))
+            dataset_pos = next_pos
+
+        if y is None:
+            raise IOError('No intensity data found in file "%s".' %(path))
+
+        if coords or (index is None and out is None):
+            # convert to native byte order (without holding the GIL)
+            y = _gather_cells(y, None, None)
+        for C in coords:
+            apply_mask(y, num_rows, num_cols, C, C.shape[0])
 
+    finally:
+        fh.close()
 
-def try_open_gzip(path):
+    if index is not None or out is not None:
+        return _gather_cells(y, index, out)
+    return y
 
-    fh = None
-    try:
-        fh = gzip.open(path)
-        fh.read(1)
-    except IOError:
-        pass
-    else:
-        fh = gzip.open(path)
 
-    return fh
+def _read_format_byte(fh, path):
+    """Reads the first byte of a CEL file (which determines its format)."""
+    b = fh.read(1)
+    if not b:
+        raise ValueError('Empty CEL file: "%s"' %(path))
+    return ord(b)
 
 
-def parse_cel(path):
+def parse_cel(path, mmap = False, use_cache = True, index = None,
+        out = None, num_threads = 1):
     """Front-end for parsing a CEL file containing expression data.
 
     This function automatically determines the CEL file format. The possible
@@ -653,52 +897,352 @@ def parse_cel(path):
     See http://media.affymetrix.com/support/developer/powertools/changelog/gcos-agcc/cel.html
     for format specifications.
 
-    This function also detects whether the input file is gzip'ed or not. If it
-    is, gunzip is run in an independent process using a named pipe.
+    This function also detects whether the input file is compressed (gzip,
+    bzip2, or xz) or not. Compressed files are decompressed in memory.
 
     Parameters
     ----------
     path: str
         The path of the CEL file.
+    mmap: bool, optional
+        Whether to memory-map the intensities of uncompressed Version 4 CEL
+        files, instead of reading them. In that case, the function returns a
+        read-only (non-contiguous) view on the mapped data. This option is
+        ignored for other files. [False]
+    use_cache: bool, optional
+        Whether to use the cache of parsed CEL files, if it is enabled (see
+        `pyaffy.cache.enable_cel_cache`). In that case, the intensities of
+        previously parsed files are returned as a read-only memory-mapped
+        array. [True]
+    index: np.ndarray (ndim = 1, integer dtype), optional
+        The indices of the cells to return. If specified, only the
+        intensities of these cells are copied, in this order, directly from
+        the parsed data. [None]
+    out: np.ndarray (ndim = 1, dtype = np.float32), optional
+        The array to store the intensities of the (selected) cells in. It
+        can be non-contiguous, e.g., a column of a C-ordered matrix. [None]
+    num_threads: int, optional
+        The number of threads to use for parsing Version 3 (plain-text) CEL
+        files (0 = use all available cores). [1]
 
     Returns
     -------
     np.ndarray of type np.float32
-        The intensities from the array.
+        The intensities from the array (or `out`, if specified).
     """
 
     assert isinstance(path, (text, str))
+    assert isinstance(mmap, bool)
+    assert isinstance(use_cache, bool)
+    assert index is None or isinstance(index, np.ndarray)
+    assert out is None or isinstance(out, np.ndarray)
+    assert isinstance(num_threads, int)
 
     if not os.path.isfile(path):
         raise IOError('File "%s" not found.' %(path))
 
+    file_hash = None
+    if use_cache and cache.get_cel_cache_size() is not None:
+        file_hash = cache.hash_file(path)
+        y = cache.load_cel(file_hash)
+        if y is not None:
+            logger.debug('Loaded CEL data from cache.')
+            if index is not None or out is not None:
+                return _gather_cells(y, index, out)
+            return y
+
     version = 0
 
-    # test if file is gzipped
-    compressed = False
-    fh = None
-    try:
-        fh = try_open_gzip(path)
-        if fh is not None:
-            compressed = True
-        else:
-            fh = open(path, 'rb')
+    # test if file is compressed
+    comp = compression.get_compression(path)
+    compressed = (comp is not None)
 
-        version = ord(fh.read(1)) # read the first byte
+    # read the first byte
+    with compression.open_file(path, comp) as fh:
+        version = _read_format_byte(fh, path)
 
-    finally:
-        if fh is not None:
-            fh.close()
+    # all intensities are required for storing them in the cache
+    kwargs = {}
+    if file_hash is None:
+        kwargs = dict(index = index, out = out)
 
     y = None
     if version == 59:
         # command console generic data file format (binary, big-endian)
-        y = parse_celfile_cc(path, compressed = compressed)
+        y = parse_celfile_cc(path, compressed = compressed, **kwargs)
     elif version == 64:
         # version 4 format (binary, little-endian)
-        y = parse_celfile_v4(path, compressed = compressed)
+        y = parse_celfile_v4(path, compressed = compressed,
+                mmap = (mmap and not compressed), **kwargs)
     else:
         # version 3 format (plain-text)
-        y = parse_celfile_v3(path, compressed = compressed)
+        y = parse_celfile_v3(path, compressed = compressed,
+                num_threads = num_threads, **kwargs)
+
+    if file_hash is not None:
+        cache.store_cel(file_hash, y)
+        if index is not None or out is not None:
+            return _gather_cells(y, index, out)
 
     return y
+
+
+### Headers
+
+# the header information of a CEL file (see `read_cel_header`)
+CELHeader = namedtuple('CELHeader', [
+    'path', 'format', 'compression', 'num_rows', 'num_cols', 'chip_type',
+    'algorithm', 'algorithm_params', 'scan_date', 'num_masked_cells',
+    'num_outlier_cells'])
+
+_V4_HEADER = struct.Struct('<iiiii')
+_V4_INT32 = struct.Struct('<i')
+_V4_UINT32 = struct.Struct('<I')
+
+# the array type and the scan date in the "DatHeader" of Version 3 and 4
+# files
+_DAT_CHIP_TYPE = re.compile(r'(\S+)\.1sq')
+_DAT_SCAN_DATE = re.compile(r'\d\d/\d\d/\d\d \d\d:\d\d:\d\d')
+
+# the size of the blocks that the end of a Version 3 file is read in
+_V3_TAIL_BLOCK_SIZE = 65536
+
+def _parse_dat_header(dat_header):
+    """Returns the array type and the scan date stored in a "DatHeader"."""
+    chip_type, scan_date = None, None
+    m = _DAT_CHIP_TYPE.search(dat_header)
+    if m is not None:
+        chip_type = m.group(1)
+    m = _DAT_SCAN_DATE.search(dat_header)
+    if m is not None:
+        scan_date = m.group(0)
+    return chip_type, scan_date
+
+def _parse_algorithm_params(s):
+    """Parses algorithm parameters of the form "name:value;name:value"."""
+    params = OrderedDict()
+    for param in s.split(';'):
+        name, _, value = param.partition(':')
+        if name.strip():
+            params[name.strip()] = value.strip()
+    return params
+
+def _v3_read_tail_counts(fh):
+    """Reads the number of masked and outlier cells of a Version 3 file.
+
+    The [MASKS] and [OUTLIERS] sections follow the intensities, so the file
+    is read backwards (in blocks) from the end, until both sections are
+    found.
+    """
+    fh.seek(0, io.SEEK_END)
+    pos = fh.tell()
+    blocks = []
+    while pos > 0:
+        num_bytes = min(_V3_TAIL_BLOCK_SIZE, pos)
+        pos -= num_bytes
+        fh.seek(pos)
+        block = fh.read(num_bytes)
+        # the section header can extend into the next block
+        overlap = blocks[0][:6] if blocks else b''
+        blocks.insert(0, block)
+        if b'[MASKS]' in block + overlap:
+            break
+    else:
+        return None, None
+    tail = b''.join(blocks)
+
+    counts = []
+    for section in [b'[MASKS]', b'[OUTLIERS]']:
+        m = re.search(re.escape(section) + br'\s*NumberCells=(\d+)', tail)
+        counts.append(int(m.group(1)) if m is not None else None)
+    return tuple(counts)
+
+def _v3_read_header(fh, path, seekable):
+    values = {}
+    num_lines = 0
+    while True:
+        line = fh.readline()
+        if not line:
+            raise IOError('Unexpected end of file "%s" (no intensities '
+                          'found).' %(path))
+        line = line.rstrip(b'\r\n').decode('iso-8859-1')
+        num_lines += 1
+        if num_lines <= 2:
+            expected = ['[CEL]', 'Version=3'][num_lines - 1]
+            if line != expected:
+                raise ValueError('Invalid Version 3 CEL file "%s" (expected '
+                                 '"%s" in line %d).'
+                                 %(path, expected, num_lines))
+        elif line == '[INTENSITY]':
+            break
+        elif '=' in line:
+            key, val = line.split('=', 1)
+            values.setdefault(key, val)
+
+    chip_type, scan_date = _parse_dat_header(values.get('DatHeader', ''))
+    num_masked, num_outliers = None, None
+    if seekable:
+        num_masked, num_outliers = _v3_read_tail_counts(fh)
+
+    return int(values['Rows']), int(values['Cols']), chip_type, \
+            values.get('Algorithm'), \
+            _parse_algorithm_params(values.get('AlgorithmParameters', '')), \
+            scan_date, num_masked, num_outliers
+
+def _v4_read_string(fh):
+    return _cc_read(fh, _V4_INT32.unpack(_cc_read(fh, 4))[0])
+
+def _v4_read_header(fh, path):
+    magic_number, version_number, num_cols, num_rows, num_cells = \
+            _V4_HEADER.unpack(_cc_read(fh, _V4_HEADER.size))
+    if version_number != 4:
+        raise IOError('Unsupported CEL file version: %d' %(version_number))
+
+    values = {}
+    header = _v4_read_string(fh).decode('iso-8859-1')
+    for line in header.splitlines():
+        if '=' in line:
+            key, val = line.split('=', 1)
+            values.setdefault(key, val)
+    chip_type, scan_date = _parse_dat_header(values.get('DatHeader', ''))
+
+    algorithm = _v4_read_string(fh).decode('iso-8859-1')
+    algorithm_params = _parse_algorithm_params(
+            _v4_read_string(fh).decode('iso-8859-1'))
+    _cc_read(fh, 4) # cell margin
+    num_outliers = _V4_UINT32.unpack(_cc_read(fh, 4))[0]
+    num_masked = _V4_UINT32.unpack(_cc_read(fh, 4))[0]
+
+    return num_rows, num_cols, chip_type, algorithm, algorithm_params, \
+            scan_date, num_masked, num_outliers
+
+def _cc_find_param(header, name):
+    """Looks up a parameter in a data header and its parent headers."""
+    if name in header['params']:
+        return header['params'][name]
+    for parent in header['parents']:
+        value = _cc_find_param(parent, name)
+        if value is not None:
+            return value
+    return None
+
+def _cc_read_header(fh, path, seekable):
+    num_data_groups, data_pos = _cc_read_file_header(fh)
+    header = _cc_read_data_header(fh)
+    params = header['params']
+
+    prefix = 'affymetrix-algorithm-param-'
+    algorithm_params = OrderedDict(
+            (k[len(prefix):], v) for k, v in params.items()
+            if k.startswith(prefix))
+
+    num_masked, num_outliers = None, None
+    if seekable:
+        # the data set headers contain the number of masked and outlier
+        # cells
+        num_masked, num_outliers = 0, 0
+        fh.seek(data_pos)
+        _cc_read_uint(fh) # position of the next data group
+        dataset_pos = _cc_read_uint(fh)
+        num_datasets = _cc_read_int(fh)
+        for i in range(num_datasets):
+            fh.seek(dataset_pos)
+            name, _, dataset_pos, _, _, num_cells = \
+                    _cc_read_dataset_header(fh)
+            if name == 'Mask':
+                num_masked = num_cells
+            elif name == 'Outlier':
+                num_outliers = num_cells
+
+    return params['affymetrix-cel-rows'], params['affymetrix-cel-cols'], \
+            params.get('affymetrix-array-type'), \
+            params.get('affymetrix-algorithm-name'), algorithm_params, \
+            _cc_find_param(header, 'affymetrix-scan-date'), num_masked, \
+            num_outliers
+
+def read_cel_header(path):
+    """Reads the header of a CEL file, without reading the intensities.
+
+    The format of the file (Version 3, Version 4, or Command Console) and
+    its compression are determined automatically. Compressed files are
+    decompressed on the fly, only up to the end of the header.
+
+    The number of masked and outlier cells of Version 3 and Command Console
+    files is stored after the intensities. For uncompressed files, it is
+    read by seeking past them, and for compressed files, it is not
+    determined.
+
+    Parameters
+    ----------
+    path: str
+        The path of the CEL file.
+
+    Returns
+    -------
+    `CELHeader`
+        The header information: The path of the file, its format ("v3",
+        "v4", or "cc"), its compression format (or None), the number of rows
+        and columns, the array type, the name of the algorithm used to
+        calculate the intensities, the algorithm parameters (an
+        OrderedDict), the scan date (a string in the format used by the
+        file), and the number of masked and outlier cells. The array type,
+        algorithm, scan date, and cell numbers are None if they are not
+        available.
+    """
+    assert isinstance(path, (text, str))
+
+    if not os.path.isfile(path):
+        raise IOError('File "%s" not found.' %(path))
+
+    comp = compression.get_compression(path)
+    with compression.open_file(path, comp) as fh:
+        version = _read_format_byte(fh, path)
+        fh.seek(0)
+        seekable = (comp is None)
+        if version == 59:
+            fmt = 'cc'
+            info = _cc_read_header(fh, path, seekable)
+        elif version == 64:
+            fmt = 'v4'
+            info = _v4_read_header(fh, path)
+        else:
+            fmt = 'v3'
+            info = _v3_read_header(fh, path, seekable)
+
+    return CELHeader(path, fmt, comp, *info)
+
+
+def read_cel_headers(paths, num_threads = 1):
+    """Reads the headers of multiple CEL files concurrently.
+
+    Parameters
+    ----------
+    paths: list of str
+        The paths of the CEL files.
+    num_threads: int, optional
+        The number of threads to use (0 = use all available cores). Reading
+        headers mostly consists of waiting for I/O and decompression, so
+        using more threads than cores can be beneficial. [1]
+
+    Returns
+    -------
+    list of `CELHeader`
+        The header of each file (see `read_cel_header`).
+    """
+    assert isinstance(paths, (list, tuple))
+    assert isinstance(num_threads, int)
+
+    nt = num_threads
+    if nt <= 0:
+        nt = multiprocessing.cpu_count()
+    nt = min(nt, len(paths))
+
+    if nt <= 1:
+        return [read_cel_header(p) for p in paths]
+
+    pool = ThreadPool(nt)
+    try:
+        return pool.map(read_cel_header, paths)
+    finally:
+        pool.close()
+        pool.join()
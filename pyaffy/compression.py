@@ -0,0 +1,245 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""In-process decompression of (optionally) compressed input files.
+
+The compression format is detected from the first bytes of the file.
+Supported formats are gzip (using zlib), bzip2 and xz (if the `lzma` module
+is available).
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+_oldstr = str
+from builtins import *
+
+import os
+import io
+import zlib
+import bz2
+import gzip
+import logging
+
+import numpy as np
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+logger = logging.getLogger(__name__)
+
+# size of the blocks that compressed data is read and decompressed in
+BLOCK_SIZE = 4 * 1024 * 1024
+
+_MAGIC_NUMBERS = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+]
+
+
+def get_compression(path):
+    """Determines the compression format of a file.
+
+    Parameters
+    ----------
+    path: str
+        The path of the file.
+
+    Returns
+    -------
+    str or None
+        The compression format ("gzip", "bz2", or "xz"), or None if the file
+        is not compressed.
+    """
+    assert isinstance(path, (str, _oldstr))
+
+    with io.open(path, 'rb') as fh:
+        start = fh.read(6)
+
+    for magic, compression in _MAGIC_NUMBERS:
+        if start.startswith(magic):
+            return compression
+    return None
+
+
+def _get_decompressor(compression):
+    """Returns a new streaming decompressor object."""
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif compression == 'xz':
+        if lzma is None:
+            raise IOError('xz-compressed files require the "lzma" module.')
+        return lzma.LZMADecompressor()
+    else:
+        raise ValueError('Unknown compression format: "%s"' %(compression))
+
+
+def _stream_ended(decomp):
+    """Determines whether a decompressor has reached the end of its stream.
+
+    A decompressor must not receive any more data after the end of its
+    stream (bz2 and xz decompressors raise an `EOFError`).
+    """
+    try:
+        return decomp.eof
+    except AttributeError:
+        # Python 2 decompressors do not have the `eof` attribute
+        return len(decomp.unused_data) > 0
+
+
+def iter_decompressed(path, compression = None, block_size = BLOCK_SIZE):
+    """Decompresses a file in blocks.
+
+    Files consisting of multiple compressed streams (e.g., concatenated gzip
+    files) are supported. An IOError is raised if the last stream is
+    incomplete (i.e., if the file is truncated).
+
+    Parameters
+    ----------
+    path: str
+        The path of the file.
+    compression: str or None, optional
+        The compression format. If None, it is determined automatically.
+    block_size: int, optional
+        The number of compressed bytes to read at once.
+
+    Yields
+    ------
+    bytes
+        The next block of decompressed data.
+    """
+    if compression is None:
+        compression = get_compression(path)
+    if compression is None:
+        raise IOError('File "%s" is not compressed.' %(path))
+
+    # the decompressor of the current stream (None between streams)
+    decomp = None
+    with io.open(path, 'rb') as fh:
+        while True:
+            block = fh.read(block_size)
+            if not block:
+                break
+            while block:
+                if decomp is None:
+                    # skip padding between (or after) the compressed streams
+                    block = block.lstrip(b'\x00')
+                    if not block:
+                        break
+                    # start of a new compressed stream
+                    decomp = _get_decompressor(compression)
+                data = decomp.decompress(block)
+                if data:
+                    yield data
+                block = b''
+                if _stream_ended(decomp):
+                    # the rest of the block belongs to the next stream
+                    block = decomp.unused_data
+                    decomp = None
+
+    if decomp is not None:
+        if hasattr(decomp, 'flush'):
+            data = decomp.flush()
+            if data:
+                yield data
+        # (Python 2 decompressors cannot tell whether a stream is complete)
+        if not getattr(decomp, 'eof', True):
+            raise IOError('Unexpected end of compressed file "%s".' %(path))
+
+
+def read_file(path, compression = None, block_size = BLOCK_SIZE):
+    """Reads and decompresses a file in memory.
+
+    Parameters
+    ----------
+    path: str
+        The path of the file.
+    compression: str or None, optional
+        The compression format. If None, it is determined automatically.
+    block_size: int, optional
+        The number of compressed bytes to read at once.
+
+    Returns
+    -------
+    bytes
+        The decompressed file contents.
+    """
+    return b''.join(iter_decompressed(path, compression, block_size))
+
+
+def read_array(path, compressed = None):
+    """Returns the (decompressed) contents of a file as a uint8 array.
+
+    Compressed files are decompressed in memory, and uncompressed files are
+    memory-mapped (read-only).
+
+    Parameters
+    ----------
+    path: str
+        The path of the file.
+    compressed: bool or None, optional
+        Whether the file is compressed. If None, this is determined
+        automatically.
+
+    Returns
+    -------
+    np.ndarray (ndim = 1, dtype = np.uint8)
+        The file contents.
+    """
+    if compressed is None:
+        compressed = (get_compression(path) is not None)
+    if compressed:
+        logger.debug('Decompressing file: %s', path)
+        return np.frombuffer(read_file(path), dtype = np.uint8)
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype = np.uint8)
+    return np.memmap(path, dtype = np.uint8, mode = 'r')
+
+
+def open_file(path, compression = None):
+    """Opens a file for streaming (binary) reading, decompressing on the fly.
+
+    Parameters
+    ----------
+    path: str
+        The path of the file.
+    compression: str or None, optional
+        The compression format. If None, it is determined automatically.
+
+    Returns
+    -------
+    file object
+        The opened file.
+    """
+    if compression is None:
+        compression = get_compression(path)
+
+    if compression is None:
+        return io.open(path, 'rb')
+    elif compression == 'gzip':
+        return gzip.GzipFile(path, 'rb')
+    elif compression == 'bz2':
+        return bz2.BZ2File(path, 'rb')
+    elif compression == 'xz':
+        if lzma is None:
+            raise IOError('xz-compressed files require the "lzma" module.')
+        return lzma.LZMAFile(path, 'rb')
+    else:
+        raise ValueError('Unknown compression format: "%s"' %(compression))
@@ -0,0 +1,352 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Processing of new samples using a frozen RMA model.
+
+Similar to frozen RMA (fRMA; McCall et al., 2010), the quantile
+normalization reference distribution and the probe effects estimated by
+median polish are determined once, from a set of reference samples. New
+samples can then be processed individually (or in small batches), without
+re-processing the reference samples:
+
+1. The intensities are background-corrected (this only depends on the
+   sample itself).
+2. Each intensity is replaced with the value of the reference distribution
+   with the same rank.
+3. The expression of each probeset is the median of the log2-transformed
+   intensities of its probes, after subtracting the probe effects.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+_oldstr = str
+from builtins import *
+
+import os
+import io
+import time
+import logging
+import collections
+import multiprocessing
+
+import numpy as np
+
+from .cdfparser import parse_cdf
+from .probesets import ProbesetIndex
+from .background import rma_bg_correct
+from .normalize import rank_samples, apply_ranks
+from .medpolish import median_batch
+from .process import (_create_cel_pool, _check_cel_files, _read_cel_files,
+                      _rma_in_memory, _permute_rows)
+
+logger = logging.getLogger(__name__)
+
+# increase this whenever the format of saved models changes
+FORMAT_VERSION = 1
+
+
+class FrozenRMA(object):
+    """A frozen RMA model, for processing new samples.
+
+    Models are usually created using `FrozenRMA.fit`, or loaded using
+    `FrozenRMA.load`.
+
+    Parameters
+    ----------
+    probesets: `pyaffy.probesets.ProbesetIndex`
+        The probes of each probeset.
+    target: np.ndarray (ndim = 1, dtype = np.float32) or None, optional
+        The quantile normalization reference distribution (on a linear
+        scale, with one value per probe). If None, no quantile normalization
+        is performed. [None]
+    probe_effects: np.ndarray (ndim = 1, dtype = np.float32) or None, optional
+        The probe effects (on a log2-scale), in the order of the probes in
+        `probesets`. If None, probesets are summarized using the median of
+        the probe intensities. [None]
+    bg_correct: bool, optional
+        Whether to apply background correction. [True]
+    """
+    def __init__(self, probesets, target = None, probe_effects = None,
+                 bg_correct = True):
+
+        assert isinstance(probesets, ProbesetIndex)
+        p = probesets.num_probes
+        if target is not None:
+            target = np.asarray(target, dtype = np.float32)
+            assert target.shape == (p,)
+        if probe_effects is not None:
+            probe_effects = np.asarray(probe_effects, dtype = np.float32)
+            assert probe_effects.shape == (p,)
+        assert isinstance(bg_correct, bool)
+
+        self._probesets = probesets
+        self._target = target
+        self._probe_effects = probe_effects
+        self._bg_correct = bg_correct
+
+        # the values that ranks are replaced with (see
+        # `pyaffy.normalize.apply_ranks`)
+        self._values = None
+        if target is not None:
+            self._values = np.empty(p + 1, dtype = np.float32)
+            np.log2(target, out = self._values[:p])
+            self._values[p] = np.nan
+
+    def __repr__(self):
+        return '<%s object (%d probesets, %d probes)>' \
+                %(self.__class__.__name__, len(self._probesets),
+                  self._probesets.num_probes)
+
+    @property
+    def probesets(self):
+        """The probes of each probeset (`ProbesetIndex`)."""
+        return self._probesets
+
+    @property
+    def target(self):
+        """The quantile normalization reference distribution (or None)."""
+        return self._target
+
+    @property
+    def probe_effects(self):
+        """The probe effects (or None)."""
+        return self._probe_effects
+
+    @property
+    def bg_correct(self):
+        """Whether background correction is applied."""
+        return self._bg_correct
+
+    @classmethod
+    def fit(cls, cdf_file, sample_cel_files, pm_probes_only = True,
+            bg_correct = True, quantile_normalize = True,
+            medianpolish = True, n_jobs = 1, mmap = False,
+            use_cdf_cache = True, full_output = False):
+        """Performs RMA on a set of reference samples, and freezes the model.
+
+        Parameters
+        ----------
+        cdf_file: str
+            The path of the Brainarray CDF file to use.
+        sample_cel_files: collections.OrderedDict (st => str)
+            The CEL files of the reference samples (see `pyaffy.rma`).
+        pm_probes_only, bg_correct, quantile_normalize, medianpolish, \
+n_jobs, mmap, use_cdf_cache:
+            See `pyaffy.rma`.
+        full_output: bool, optional
+            Whether to also return the RMA results for the reference
+            samples. [False]
+
+        Returns
+        -------
+        model: `FrozenRMA`
+            The model.
+        genes: list of str
+            The list of gene names. Only returned if `full_output` is True.
+        samples: list of str
+            The list of sample names. Only returned if `full_output` is
+            True.
+        X: np.ndarray (ndim = 2, dtype = np.float32)
+            The expression matrix (genes-by-samples) of the reference
+            samples, as returned by `pyaffy.rma`. Only returned if
+            `full_output` is True.
+        """
+        assert isinstance(cdf_file, (str, _oldstr))
+        assert os.path.isfile(cdf_file), \
+                'CDF file "%s" does not exist!' %(cdf_file)
+        assert isinstance(sample_cel_files, collections.OrderedDict)
+        assert len(sample_cel_files) > 0
+        for cel_file in sample_cel_files.values():
+            assert os.path.isfile(cel_file), \
+                    'CEL file "%s" does not exist!' %(cel_file)
+        assert isinstance(pm_probes_only, bool)
+        assert isinstance(bg_correct, bool)
+        assert isinstance(quantile_normalize, bool)
+        assert isinstance(medianpolish, bool)
+        assert isinstance(n_jobs, int) and (n_jobs >= 1 or n_jobs == -1)
+        assert isinstance(full_output, bool)
+
+        if n_jobs == -1:
+            n_jobs = multiprocessing.cpu_count()
+
+        probe_type = 'pm'
+        if not pm_probes_only:
+            probe_type = 'all'
+        _, num_rows, num_cols, probesets = parse_cdf(
+                cdf_file, probe_type = probe_type, use_cache = use_cdf_cache,
+                num_threads = n_jobs)
+        _check_cel_files(list(sample_cel_files.values()), num_rows, num_cols,
+                         num_threads = n_jobs)
+
+        logger.info('Fitting frozen RMA model using %d samples...',
+                    len(sample_cel_files))
+        t0 = time.time()
+        X, _, _, target, probe_effects = _rma_in_memory(
+                list(sample_cel_files.values()), probesets, bg_correct,
+                quantile_normalize, medianpolish, n_jobs, mmap,
+                full_output = True)
+        t1 = time.time()
+        logger.info('Model fitting time: %.1f s.', t1 - t0)
+
+        model = cls(probesets, target = target, probe_effects = probe_effects,
+                    bg_correct = bg_correct)
+
+        if full_output:
+            a = probesets.sort_order()
+            genes = probesets.names[a].tolist()
+            samples = list(sample_cel_files.keys())
+            return model, genes, samples, _permute_rows(X, a)
+        return model
+
+    def process(self, sample_cel_files, n_jobs = 1, mmap = False):
+        """Processes new samples using the frozen model.
+
+        Each sample is processed independently, so the results do not
+        depend on which other samples are processed at the same time.
+
+        Parameters
+        ----------
+        sample_cel_files: collections.OrderedDict (st => str)
+            The CEL files of the samples (see `pyaffy.rma`).
+        n_jobs: int, optional
+            The number of worker processes to use for parsing CEL files, and
+            the number of threads for processing the samples. If -1, use all
+            available cores. [1]
+        mmap: bool, optional
+            See `pyaffy.rma`. [False]
+
+        Returns
+        -------
+        genes: list of str
+            The list of gene names (sorted alphabetically).
+        samples: list of str
+            The list of sample names.
+        X: np.ndarray (ndim = 2, dtype = np.float32)
+            The expression matrix (genes-by-samples).
+        """
+        assert isinstance(sample_cel_files, collections.OrderedDict)
+        for cel_file in sample_cel_files.values():
+            assert os.path.isfile(cel_file), \
+                    'CEL file "%s" does not exist!' %(cel_file)
+        assert isinstance(n_jobs, int) and (n_jobs >= 1 or n_jobs == -1)
+        assert isinstance(mmap, bool)
+
+        if n_jobs == -1:
+            n_jobs = multiprocessing.cpu_count()
+
+        probesets = self._probesets
+        pm_sel = probesets.indices
+        p = pm_sel.size
+        samples = list(sample_cel_files.keys())
+        cel_files = list(sample_cel_files.values())
+        n = len(cel_files)
+
+        ### read CEL data
+        num_procs = min(n_jobs, n)
+        parse_threads = max(n_jobs // max(num_procs, 1), 1)
+        pool = None
+        if num_procs > 1:
+            pool, Y = _create_cel_pool(num_procs, (p, n), pm_sel, mmap,
+                                       num_threads = parse_threads)
+        else:
+            Y = np.empty((p, n), dtype = np.float32)
+        try:
+            _read_cel_files(cel_files, pm_sel, Y, pool, mmap,
+                            num_threads = parse_threads)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        ### background correction
+        if self._bg_correct:
+            Y = rma_bg_correct(Y, num_threads = n_jobs)
+
+        ### quantile normalization (using the frozen reference)
+        if self._values is not None:
+            R = rank_samples(Y, np.zeros(p, dtype = np.float64),
+                             num_threads = n_jobs)
+            Y = apply_ranks(R, self._values, num_threads = n_jobs)
+        else:
+            np.log2(Y, out = Y)
+
+        ### summarization (using the frozen probe effects)
+        if self._probe_effects is not None:
+            Y -= self._probe_effects[:, np.newaxis]
+        X = median_batch(Y, probesets.offsets, num_threads = n_jobs)
+
+        a = probesets.sort_order()
+        genes = probesets.names[a].tolist()
+        return genes, samples, _permute_rows(X, a)
+
+    def save(self, path):
+        """Saves the model to a file (in NumPy's ".npz" format).
+
+        Parameters
+        ----------
+        path: str
+            The path of the file.
+        """
+        assert isinstance(path, (str, _oldstr))
+
+        data = collections.OrderedDict([
+            ('format_version', np.int64(FORMAT_VERSION)),
+            ('names', np.asarray(self._probesets.names, dtype = np.str_)),
+            ('offsets', self._probesets.offsets),
+            ('indices', self._probesets.indices),
+            ('bg_correct', np.bool_(self._bg_correct)),
+        ])
+        if self._target is not None:
+            data['target'] = self._target
+        if self._probe_effects is not None:
+            data['probe_effects'] = self._probe_effects
+
+        with io.open(path, 'wb') as fh:
+            np.savez(fh, **data)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a model from a file.
+
+        Parameters
+        ----------
+        path: str
+            The path of the file (see `FrozenRMA.save`).
+
+        Returns
+        -------
+        `FrozenRMA`
+            The model.
+        """
+        assert isinstance(path, (str, _oldstr))
+
+        with np.load(path, allow_pickle = False) as data:
+            version = int(data['format_version'])
+            if version != FORMAT_VERSION:
+                raise ValueError('Unsupported model format version: %d'
+                                 %(version))
+            probesets = ProbesetIndex(data['names'], data['offsets'],
+                                      data['indices'])
+            target = None
+            if 'target' in data.files:
+                target = data['target']
+            probe_effects = None
+            if 'probe_effects' in data.files:
+                probe_effects = data['probe_effects']
+            bg_correct = bool(data['bg_correct'])
+
+        return cls(probesets, target = target, probe_effects = probe_effects,
+                   bg_correct = bg_correct)
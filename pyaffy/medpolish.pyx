@@ -17,77 +17,419 @@
 #cython: profile=False, wraparound=False, boundscheck=False, cdivision=True
 
 cimport cython
+from cython.parallel cimport prange, threadid
+from libc.math cimport NAN, isnan
+
+import multiprocessing
 
 import numpy as np
 cimport numpy as np
 
+from .quickselect cimport (select_float, median_float,
+                          pairwise_abs_sum_float)
+
 np.import_array()
 
-def medpolish(float[:,:] X, float eps = 0.01, int maxiter = 10, copy = True):
+cdef int medpolish_kernel(float* X, Py_ssize_t num_rows, Py_ssize_t num_cols,
+        float eps, int maxiter, float* row_eff, float* col_eff,
+        float* global_eff, float* scratch, int* converged) nogil:
+    """Median polish of a C-contiguous matrix, modifying it in-place.
 
-    if copy:
-        X = X.copy()
-    
-    cdef int num_rows = X.shape[0]
-    cdef int num_cols = X.shape[1]
-
-    cdef float[::1] row_eff = np.zeros(num_rows, dtype = np.float32)
-    cdef float[::1] col_eff = np.zeros(num_cols, dtype = np.float32)
-    cdef float global_eff = 0.0
-    cdef float sar = 0.0 # sum of absolute residuals
-    
-    cdef int converged = 0
+    `scratch` must have space for ``max(num_rows, num_cols)`` values. Returns
+    the number of iterations performed.
+    """
+    cdef Py_ssize_t i, j
+    cdef float diff, sar, new_sar, g
     cdef int t = 0
-    
-    cdef float[::1] rdiff, cdiff
-    cdef float diff
-    cdef float new_sar
-    cdef int i, j
-    
-    while (maxiter == -1 or t < maxiter) and converged == 0:
-        
-        # sweep rows
-        rdiff = np.median(X, axis = 1)
 
-        #X = X - np.tile(rdiff, (num_cols, 1)).T
+    for i in range(num_rows):
+        row_eff[i] = 0.0
+    for j in range(num_cols):
+        col_eff[j] = 0.0
+    g = 0.0
+    sar = 0.0
+    converged[0] = 0
+
+    while (maxiter == -1 or t < maxiter) and converged[0] == 0:
+
+        # sweep rows
         for i in range(num_rows):
+            for j in range(num_cols):
+                scratch[j] = X[i*num_cols + j]
+            diff = median_float(scratch, num_cols)
             # substract median from the row
             for j in range(num_cols):
-                X[i,j] -= rdiff[i]
+                X[i*num_cols + j] -= diff
             # add median to the row effect
-            row_eff[i] += rdiff[i]
+            row_eff[i] += diff
         # also the row containing the column effects
-        diff = np.median(col_eff)
+        for j in range(num_cols):
+            scratch[j] = col_eff[j]
+        diff = median_float(scratch, num_cols)
         for j in range(num_cols):
             col_eff[j] -= diff
-        global_eff += diff
+        g += diff
 
         # sweep columns
-        cdiff = np.median(X, axis = 0)
-
-        #X = X - np.tile(cdiff, (num_rows, 1))
         for j in range(num_cols):
+            for i in range(num_rows):
+                scratch[i] = X[i*num_cols + j]
+            diff = median_float(scratch, num_rows)
             # substract median from the column
             for i in range(num_rows):
-                X[i,j] -= cdiff[j]
+                X[i*num_cols + j] -= diff
             # add median to the column effect
-            col_eff[j] += cdiff[j]
+            col_eff[j] += diff
         # also the column containing the row effects
-        diff = np.median(row_eff)
+        for i in range(num_rows):
+            scratch[i] = row_eff[i]
+        diff = median_float(scratch, num_rows)
         for i in range(num_rows):
             row_eff[i] -= diff
-        global_eff += diff
+        g += diff
 
         # next
         t += 1
 
-         # calculate new sum of absolute residuals
-        new_sar = np.sum(np.absolute(X))
+        # calculate new sum of absolute residuals
+        new_sar = pairwise_abs_sum_float(X, num_rows * num_cols)
         # test for convergence
         if abs(new_sar - sar) < eps * new_sar:
-            converged = 1
+            converged[0] = 1
 
         sar = new_sar
+
+    global_eff[0] = g
+    return t
+
+
+def medpolish_batch(float[:,::1] Y not None, offsets, float eps = 0.01,
+        int maxiter = 10, copy = True, int num_threads = 0,
+        full_output = False):
+    """Median polish of many probesets, in parallel.
+
+    The probesets are consecutive blocks of rows in `Y`. All probesets are
+    processed in compiled code without holding the GIL, using multiple
+    threads. The result for each probeset does not depend on the number of
+    threads.
+
+    Parameters
+    ----------
+    Y: np.ndarray (ndim = 2, dtype = np.float32)
+        The (C-contiguous) probe-by-sample matrix (on a log2-scale). The rows
+        of the i'th probeset are ``Y[offsets[i]:offsets[i+1], :]``.
+    offsets: np.ndarray
+        The row offsets of the probesets (one more than there are
+        probesets).
+    eps: float, optional
+        The convergence tolerance. [0.01]
+    maxiter: int, optional
+        The maximum number of iterations (-1 = no limit). [10]
+    copy: bool, optional
+        Whether to make a copy of `Y`, instead of replacing its values with
+        the residuals. [True]
+    num_threads: int, optional
+        The number of threads to use (0 = use all available cores). [0]
+    full_output: bool, optional
+        Whether to also return the row (probe) effects. [False]
+
+    Returns
+    -------
+    X: np.ndarray (ndim = 2, dtype = np.float32)
+        The summarized (probeset-by-sample) matrix, i.e., the column effects
+        plus the overall effect of each probeset.
+    converged: np.ndarray (dtype = np.bool_)
+        Whether median polish converged for each probeset.
+    num_iter: np.ndarray (dtype = np.int32)
+        The number of iterations performed for each probeset.
+    row_eff: np.ndarray (ndim = 1, dtype = np.float32)
+        The row effect of each row of `Y` (NaN for rows that do not belong to
+        any probeset). Only returned if `full_output` is True.
+    """
+    if copy:
+        Y = Y.copy()
+
+    cdef const np.int64_t[::1] off = np.ascontiguousarray(offsets,
+            dtype = np.int64)
+    cdef Py_ssize_t p = off.shape[0] - 1
+    cdef Py_ssize_t n = Y.shape[1]
+
+    assert p >= 0
+    assert off[0] >= 0 and off[p] <= Y.shape[0]
+
+    X_arr = np.empty((p, n), dtype = np.float32)
+    conv_arr = np.zeros(p, dtype = np.int32)
+    iter_arr = np.zeros(p, dtype = np.int32)
+    row_eff_arr = np.full(Y.shape[0], np.nan, dtype = np.float32)
+    cdef float[:,::1] X = X_arr
+    cdef float[::1] R = row_eff_arr
+    cdef int[::1] conv = conv_arr
+    cdef int[::1] num_iter = iter_arr
+
+    cdef Py_ssize_t i, j, max_rows = 0
+    for i in range(p):
+        assert off[i+1] >= off[i]
+        if off[i+1] - off[i] > max_rows:
+            max_rows = off[i+1] - off[i]
+
+    if num_threads <= 0:
+        num_threads = multiprocessing.cpu_count()
+
+    # scratch buffers for each thread (the overall effect, column effects,
+    # and values for median calculations); the overall effect must be kept
+    # in the buffer, since a variable whose address is taken would be shared
+    # by all threads
+    cdef Py_ssize_t buf_size = 1 + n + max(max_rows, n)
+    cdef float[:,::1] buf = np.empty((num_threads, buf_size), dtype = np.float32)
+    cdef float* row_eff
+    cdef float* col_eff
+    cdef float* global_eff
+    cdef float* scratch
+    cdef int tid
+
+    if p > 0 and n > 0:
+        for i in prange(p, nogil = True, schedule = 'dynamic',
+                num_threads = num_threads):
+            tid = threadid()
+            global_eff = &buf[tid, 0]
+            col_eff = global_eff + 1
+            scratch = col_eff + n
+            if off[i+1] > off[i]:
+                row_eff = &R[off[i]]
+                num_iter[i] = medpolish_kernel(&Y[off[i], 0],
+                        off[i+1] - off[i], n, eps, maxiter,
+                        row_eff, col_eff, global_eff, scratch, &conv[i])
+                for j in range(n):
+                    X[i, j] = col_eff[j] + global_eff[0]
+            else:
+                for j in range(n):
+                    X[i, j] = NAN
+
+    if full_output:
+        return X_arr, conv_arr.astype(np.bool_), iter_arr, row_eff_arr
+    return X_arr, conv_arr.astype(np.bool_), iter_arr
+
+
+# the probeset summarization methods (see `summarize_batch`)
+SUMMARY_METHODS = ('median', 'mean', 'trimmed_mean', 'biweight')
+
+cdef enum:
+    SUMMARY_MEDIAN = 0
+    SUMMARY_MEAN = 1
+    SUMMARY_TRIMMED_MEAN = 2
+    SUMMARY_BIWEIGHT = 3
+
+
+cdef inline float mean_float(float* a, Py_ssize_t n) nogil:
+    """Returns the mean of `a` (accumulated in double precision)."""
+    cdef Py_ssize_t i
+    cdef double s = 0.0
+    for i in range(n):
+        s += a[i]
+    return <float>(s / n)
+
+
+cdef inline float trimmed_mean_float(float* a, Py_ssize_t n,
+        double trim) nogil:
+    """Returns the mean of `a` without its smallest and largest values.
+
+    As done by `scipy.stats.trim_mean`, ``int(trim * n)`` values are removed
+    from each end. The array is reordered in the process. If any value is
+    NaN, NaN is returned.
+    """
+    cdef Py_ssize_t i
+    cdef Py_ssize_t cut = <Py_ssize_t>(trim * n)
+    for i in range(n):
+        if isnan(a[i]):
+            return a[i]
+    if cut > 0:
+        # move the smallest values to the front, and the largest values to
+        # the back
+        select_float(a, n, cut)
+        select_float(a + cut, n - cut, n - 2*cut - 1)
+    return mean_float(a + cut, n - 2*cut)
+
+
+cdef inline float biweight_float(float* a, Py_ssize_t n,
+        float* scratch) nogil:
+    """Returns the one-step Tukey biweight estimate of `a`.
+
+    This follows ``tukey.biweight`` of the R package affy (``c = 5``,
+    ``epsilon = 1e-4``): Values are weighted by their distance from the
+    median, in units of the median absolute deviation. The array is
+    reordered in the process, and `scratch` must have space for `n` values.
+    """
+    cdef Py_ssize_t i
+    cdef float m, s, u
+    cdef double w, sum_w = 0.0, sum_wx = 0.0
+    m = median_float(a, n)
+    if isnan(m):
+        return m
+    for i in range(n):
+        scratch[i] = abs(a[i] - m)
+    s = median_float(scratch, n)
+    for i in range(n):
+        u = (a[i] - m) / (5.0 * s + 1e-4)
+        if abs(u) <= 1.0:
+            w = (1.0 - u*u) * (1.0 - u*u)
+            sum_w += w
+            sum_wx += w * a[i]
+    return <float>(sum_wx / sum_w)
+
+
+def summarize_batch(const float[:,:] Y not None, offsets, method = 'median',
+        double trim = 0.1, int num_threads = 0):
+    """Summarizes many probesets, in parallel.
+
+    For each probeset and sample, the values of all probes are summarized
+    using a single robust (or non-robust) estimate. The probesets are
+    consecutive blocks of rows in `Y`, and are processed in compiled code
+    without holding the GIL, using multiple threads.
+
+    Parameters
+    ----------
+    Y: np.ndarray (ndim = 2, dtype = np.float32)
+        The probe-by-sample matrix. The rows of the i'th probeset are
+        ``Y[offsets[i]:offsets[i+1], :]``.
+    offsets: np.ndarray
+        The row offsets of the probesets (one more than there are
+        probesets).
+    method: str, optional
+        The estimate to use: "median" (as done by `np.median`), "mean",
+        "trimmed_mean" (see `trim`), or "biweight" (the one-step Tukey
+        biweight, as used by MAS5). ["median"]
+    trim: float, optional
+        The fraction of values to remove from each end before calculating a
+        trimmed mean (as done by `scipy.stats.trim_mean`). [0.1]
+    num_threads: int, optional
+        The number of threads to use (0 = use all available cores). [0]
+
+    Returns
+    -------
+    np.ndarray (ndim = 2, dtype = np.float32)
+        The probeset-by-sample matrix of estimates (NaN for empty
+        probesets).
+    """
+    assert method in SUMMARY_METHODS, \
+            'Unknown summarization method: %s' %(method)
+    assert 0.0 <= trim < 0.5
+
+    cdef int m = SUMMARY_METHODS.index(method)
+    cdef const np.int64_t[::1] off = np.ascontiguousarray(offsets,
+            dtype = np.int64)
+    cdef Py_ssize_t p = off.shape[0] - 1
+    cdef Py_ssize_t n = Y.shape[1]
+
+    assert p >= 0
+    assert off[0] >= 0 and off[p] <= Y.shape[0]
+
+    X_arr = np.empty((p, n), dtype = np.float32)
+    cdef float[:,::1] X = X_arr
+
+    cdef Py_ssize_t i, j, k, max_rows = 0
+    for i in range(p):
+        assert off[i+1] >= off[i]
+        if off[i+1] - off[i] > max_rows:
+            max_rows = off[i+1] - off[i]
+
+    if num_threads <= 0:
+        num_threads = multiprocessing.cpu_count()
+
+    # scratch buffers for each thread (the values of a probeset, and the
+    # absolute deviations for the biweight)
+    cdef float[:,::1] buf = np.empty((num_threads, 2 * max(max_rows, 1)),
+            dtype = np.float32)
+    cdef float* scratch
+    cdef Py_ssize_t num_rows
+    cdef float v
+
+    if p > 0 and n > 0:
+        for i in prange(p, nogil = True, schedule = 'dynamic',
+                num_threads = num_threads):
+            scratch = &buf[threadid(), 0]
+            num_rows = off[i+1] - off[i]
+            for j in range(n):
+                if num_rows > 0:
+                    for k in range(num_rows):
+                        scratch[k] = Y[off[i] + k, j]
+                    if m == SUMMARY_MEDIAN:
+                        v = median_float(scratch, num_rows)
+                    elif m == SUMMARY_MEAN:
+                        v = mean_float(scratch, num_rows)
+                    elif m == SUMMARY_TRIMMED_MEAN:
+                        v = trimmed_mean_float(scratch, num_rows, trim)
+                    else:
+                        v = biweight_float(scratch, num_rows,
+                                scratch + num_rows)
+                    X[i, j] = v
+                else:
+                    X[i, j] = NAN
+
+    return X_arr
+
+
+def median_batch(const float[:,:] Y not None, offsets, int num_threads = 0):
+    """Medians of many probesets, in parallel.
+
+    For each probeset and sample, the median of the values of all probes is
+    calculated (as done by `np.median`). See `summarize_batch`.
+
+    Parameters
+    ----------
+    Y: np.ndarray (ndim = 2, dtype = np.float32)
+        The probe-by-sample matrix. The rows of the i'th probeset are
+        ``Y[offsets[i]:offsets[i+1], :]``.
+    offsets: np.ndarray
+        The row offsets of the probesets (one more than there are
+        probesets).
+    num_threads: int, optional
+        The number of threads to use (0 = use all available cores). [0]
+
+    Returns
+    -------
+    np.ndarray (ndim = 2, dtype = np.float32)
+        The probeset-by-sample matrix of medians (NaN for empty probesets).
+    """
+    return summarize_batch(Y, offsets, method = 'median',
+                           num_threads = num_threads)
+
+
+def medpolish(float[:,:] X, float eps = 0.01, int maxiter = 10, copy = True):
+
+    if copy:
+        X = X.copy()
+    
+    cdef Py_ssize_t num_rows = X.shape[0]
+    cdef Py_ssize_t num_cols = X.shape[1]
+
+    cdef float[::1] row_eff = np.empty(num_rows, dtype = np.float32)
+    cdef float[::1] col_eff = np.empty(num_cols, dtype = np.float32)
+    cdef float global_eff = 0.0
+    # scratch space for median calculations (reused in all iterations)
+    cdef float[::1] scratch = np.empty(max(num_rows, num_cols, 1),
+            dtype = np.float32)
+    
+    cdef int converged = 0
+    cdef int t = 0
+
+    # the kernel requires a C-contiguous matrix
+    cdef float[:,::1] C
+    X_arr = np.asarray(X)
+    is_contiguous = X_arr.flags.c_contiguous
+    if is_contiguous:
+        C = X_arr
+    else:
+        C = np.ascontiguousarray(X_arr)
+
+    if num_rows > 0 and num_cols > 0:
+        with nogil:
+            t = medpolish_kernel(&C[0, 0], num_rows, num_cols, eps, maxiter,
+                    &row_eff[0], &col_eff[0], &global_eff, &scratch[0],
+                    &converged)
+
+    if not is_contiguous:
+        # write the residuals back
+        X[:,:] = C
         
     return X, np.float32(row_eff), np.float32(col_eff), float(global_eff), bool(converged), int(t)
 
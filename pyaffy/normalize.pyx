@@ -0,0 +1,350 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+#cython: profile=False, wraparound=False, boundscheck=False, cdivision=True
+
+"""In-place quantile normalization of single-precision data.
+
+The normalization is performed in two passes over the data. In the first
+pass (`rank_samples`), each sample (column) is sorted, the sorted values are
+added to the reference distribution, and the rank of each value is stored in
+place of the value itself (as an unsigned 32-bit integer). In the second
+pass (`apply_ranks`), each rank is replaced with the corresponding value of
+the reference distribution. Apart from the matrix itself, memory is only
+required for a few columns per thread.
+"""
+
+cimport cython
+from cython.parallel cimport prange, threadid
+from libc.string cimport memset
+
+import logging
+import multiprocessing
+
+import numpy as np
+cimport numpy as np
+
+np.import_array()
+
+logger = logging.getLogger(__name__)
+
+# radix sort digits (three passes of 11 bits)
+cdef enum:
+    RADIX_BITS = 11
+    RADIX_SIZE = 2048
+    RADIX_MASK = 2047
+
+
+cdef inline np.uint32_t float_key(np.uint32_t u) nogil:
+    """Maps the bits of a float to an unsigned integer with the same order."""
+    cdef np.uint32_t sign = <np.uint32_t>1 << 31
+    if u == sign:
+        # negative zero is equal to positive zero
+        u = 0
+    if u & sign:
+        return ~u
+    return u | sign
+
+
+cdef int argsort_float(np.uint32_t* keys, np.uint32_t* idx,
+        np.uint32_t* keys_tmp, np.uint32_t* idx_tmp, Py_ssize_t n,
+        np.int64_t* counts) nogil:
+    """Stable LSD radix sort of the float keys `keys`, along with `idx`.
+
+    `keys` must contain the values converted using `float_key`. The sorted
+    keys and indices are stored in `keys` and `idx`. The temporary arrays
+    must have space for `n` values, and `counts` for ``RADIX_SIZE`` values.
+    """
+    cdef Py_ssize_t i
+    cdef int p, shift
+    cdef np.uint32_t d
+    cdef np.int64_t s, c
+    cdef np.uint32_t* src_k = keys
+    cdef np.uint32_t* src_i = idx
+    cdef np.uint32_t* dst_k = keys_tmp
+    cdef np.uint32_t* dst_i = idx_tmp
+    cdef np.uint32_t* t
+
+    for p in range(3):
+        shift = p * RADIX_BITS
+        memset(counts, 0, RADIX_SIZE * sizeof(np.int64_t))
+        for i in range(n):
+            counts[(src_k[i] >> shift) & RADIX_MASK] += 1
+        s = 0
+        for i in range(RADIX_SIZE):
+            c = counts[i]
+            counts[i] = s
+            s += c
+        for i in range(n):
+            d = (src_k[i] >> shift) & RADIX_MASK
+            dst_k[counts[d]] = src_k[i]
+            dst_i[counts[d]] = src_i[i]
+            counts[d] += 1
+        t = src_k; src_k = dst_k; dst_k = t
+        t = src_i; src_i = dst_i; dst_i = t
+
+    # after an odd number of passes, the result is in the temporary arrays
+    for i in range(n):
+        keys[i] = src_k[i]
+        idx[i] = src_i[i]
+
+    return 0
+
+
+def _fill_missing(Y):
+    """Replaces missing values with evenly spaced percentiles.
+
+    Returns the positions of the missing values in each column.
+    """
+    missing = []
+    for j in range(Y.shape[1]):
+        sel = np.nonzero(np.isnan(Y[:,j]))[0]
+        if sel.size > 0:
+            q = np.linspace(0, 100.0, sel.size + 2)[1:(sel.size + 1)]
+            Y[sel, j] = np.nanpercentile(Y[:,j], q)
+        missing.append(sel)
+    return missing
+
+
+def rank_samples(Y, target_sum, num_threads = 0):
+    """Replaces each value with its rank within its sample (in-place).
+
+    This is the first pass of quantile normalization. The sorted values of
+    each sample are added to `target_sum`, in the order of the samples, so
+    that a matrix can also be processed in several consecutive blocks of
+    samples, with the same result.
+
+    Missing values (NaN) are temporarily replaced with evenly spaced
+    percentiles of the other values in the same sample, and are assigned
+    the rank ``p``, where ``p`` is the number of rows.
+
+    Parameters
+    ----------
+    Y: np.ndarray (ndim = 2, dtype = np.float32)
+        The matrix to normalize (probes-by-samples).
+    target_sum: np.ndarray (ndim = 1, dtype = np.float64)
+        The sum of the sorted values of all samples (``p`` values).
+    num_threads: int, optional
+        The number of threads to use (0 = use all available cores). [0]
+
+    Returns
+    -------
+    np.ndarray (ndim = 2, dtype = np.uint32)
+        The ranks (the data of `Y`, interpreted as unsigned integers).
+    """
+    assert isinstance(Y, np.ndarray)
+    assert Y.ndim == 2 and Y.dtype == np.float32
+    assert Y.shape[0] < 2**32 - 1
+    assert isinstance(target_sum, np.ndarray)
+    assert target_sum.shape == (Y.shape[0],)
+    assert isinstance(num_threads, int)
+
+    cdef Py_ssize_t p = Y.shape[0]
+    cdef Py_ssize_t n = Y.shape[1]
+    cdef int nt = num_threads
+    if nt <= 0:
+        nt = multiprocessing.cpu_count()
+    nt = min(nt, max(n, 1))
+
+    missing = _fill_missing(Y)
+
+    cdef float[:,:] Yv = Y
+    # the same data, interpreted as ranks
+    R_arr = Y.view(np.uint32)
+    cdef np.uint32_t[:,:] R = R_arr
+    cdef double[::1] tsum = target_sum
+
+    # scratch buffers for each thread
+    cdef np.uint32_t[:,::1] keys = np.empty((nt, 2*p), dtype = np.uint32)
+    cdef np.uint32_t[:,::1] idx = np.empty((nt, 2*p), dtype = np.uint32)
+    cdef np.int64_t[:,::1] counts = np.empty((nt, RADIX_SIZE),
+            dtype = np.int64)
+    # the sorted values of a block of samples
+    cdef float[:,::1] S = np.empty((nt, p), dtype = np.float32)
+
+    cdef Py_ssize_t i, j, j0, b, k, num_block
+    cdef int tid
+
+    for j0 in range(0, n, nt):
+        num_block = min(nt, n - j0)
+
+        for b in prange(num_block, nogil = True, schedule = 'static',
+                num_threads = nt):
+            tid = threadid()
+            j = j0 + b
+            for i in range(p):
+                keys[tid, i] = float_key(R[i, j])
+                idx[tid, i] = <np.uint32_t>i
+            argsort_float(&keys[tid, 0], &idx[tid, 0], &keys[tid, p],
+                    &idx[tid, p], p, &counts[tid, 0])
+            for k in range(p):
+                S[b, k] = Yv[idx[tid, k], j]
+            for k in range(p):
+                R[idx[tid, k], j] = <np.uint32_t>k
+
+        # add up the sorted samples in order, so that the result does not
+        # depend on the number of threads
+        for k in prange(p, nogil = True, schedule = 'static',
+                num_threads = nt):
+            for b in range(num_block):
+                tsum[k] += S[b, k]
+
+    for j, sel in enumerate(missing):
+        if sel.size > 0:
+            R_arr[sel, j] = p
+
+    return R_arr
+
+
+def get_reference(target_sum, num_samples, log2 = False):
+    """Calculates the reference distribution from the sum of all samples.
+
+    Parameters
+    ----------
+    target_sum: np.ndarray (ndim = 1, dtype = np.float64)
+        The sum of the sorted values of all samples (see `rank_samples`).
+    num_samples: int
+        The number of samples.
+    log2: bool, optional
+        Whether to return the log2-transformed values as well. [False]
+
+    Returns
+    -------
+    target: np.ndarray (ndim = 1, dtype = np.float32)
+        The reference distribution.
+    values: np.ndarray (ndim = 1, dtype = np.float32)
+        The values that the ranks are replaced with (the reference
+        distribution, log2-transformed if `log2` is True, followed by NaN
+        for missing values).
+    """
+    if num_samples > 0:
+        target = (target_sum / num_samples).astype(np.float32)
+    else:
+        target = np.zeros(target_sum.size, dtype = np.float32)
+
+    p = target.size
+    values = np.empty(p + 1, dtype = np.float32)
+    if log2:
+        np.log2(target, out = values[:p])
+    else:
+        values[:p] = target
+    values[p] = np.nan
+    return target, values
+
+
+def apply_ranks(R, values, num_threads = 0):
+    """Replaces each rank with the corresponding reference value (in-place).
+
+    This is the second pass of quantile normalization.
+
+    Parameters
+    ----------
+    R: np.ndarray (ndim = 2, dtype = np.uint32)
+        The ranks (see `rank_samples`).
+    values: np.ndarray (ndim = 1, dtype = np.float32)
+        The values to replace the ranks with (see `get_reference`).
+    num_threads: int, optional
+        The number of threads to use (0 = use all available cores). [0]
+
+    Returns
+    -------
+    np.ndarray (ndim = 2, dtype = np.float32)
+        The normalized values (the data of `R`, interpreted as floats).
+    """
+    assert isinstance(R, np.ndarray)
+    assert R.ndim == 2 and R.dtype == np.uint32
+    assert isinstance(values, np.ndarray) and values.dtype == np.float32
+    assert isinstance(num_threads, int)
+
+    cdef Py_ssize_t p = R.shape[0]
+    cdef Py_ssize_t n = R.shape[1]
+    cdef Py_ssize_t num_values = values.size
+    cdef int nt = num_threads
+    if nt <= 0:
+        nt = multiprocessing.cpu_count()
+
+    Y_arr = R.view(np.float32)
+    cdef float[:,:] Y = Y_arr
+    cdef np.uint32_t[:,:] Rv = R
+    cdef const float[::1] v = values
+    cdef Py_ssize_t i, j
+
+    # check the ranks first, so that the data is left unchanged on error
+    if R.size > 0 and np.amax(R) >= num_values:
+        raise ValueError('Rank out of range.')
+
+    for i in prange(p, nogil = True, schedule = 'static', num_threads = nt):
+        for j in range(n):
+            Y[i, j] = v[Rv[i, j]]
+
+    return Y_arr
+
+
+def quantile_normalize(Y, make_copy = False, log2 = False, num_threads = 0,
+        full_output = False):
+    """Quantile normalization, performed in-place.
+
+    Each value is replaced with the mean of the values with the same rank in
+    all samples (columns). Ties are broken by position (a value in an
+    earlier row receives a lower rank), as done by a stable sort. The
+    reference distribution is accumulated in double precision, by adding up
+    the sorted samples in order.
+
+    Missing values (NaN) are temporarily replaced with evenly spaced
+    percentiles of the other values in the same sample, and are restored
+    after normalization.
+
+    Parameters
+    ----------
+    Y: np.ndarray (ndim = 2, dtype = np.float32)
+        The matrix to normalize (probes-by-samples).
+    make_copy: bool, optional
+        Whether to make a copy of the data instead of modifying it in-place.
+        [False]
+    log2: bool, optional
+        Whether to also log2-transform the normalized values (in the same
+        pass). [False]
+    num_threads: int, optional
+        The number of threads to use (0 = use all available cores). [0]
+    full_output: bool, optional
+        Whether to also return the reference distribution. [False]
+
+    Returns
+    -------
+    Y: np.ndarray (ndim = 2, dtype = np.float32)
+        The normalized matrix.
+    target: np.ndarray (ndim = 1, dtype = np.float32)
+        The (sorted) reference distribution, on a linear scale. Only returned
+        if `full_output` is True.
+    """
+    assert isinstance(Y, np.ndarray)
+    assert Y.ndim == 2 and Y.dtype == np.float32
+    assert isinstance(make_copy, bool)
+    assert isinstance(log2, bool)
+    assert isinstance(num_threads, int)
+    assert isinstance(full_output, bool)
+
+    if make_copy:
+        Y = Y.copy()
+
+    target_sum = np.zeros(Y.shape[0], dtype = np.float64)
+    R = rank_samples(Y, target_sum, num_threads = num_threads)
+    target, values = get_reference(target_sum, Y.shape[1], log2 = log2)
+    apply_ranks(R, values, num_threads = num_threads)
+
+    if full_output:
+        return Y, target
+    return Y
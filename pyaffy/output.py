@@ -0,0 +1,291 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming output of the expression matrix.
+
+An output sink receives the rows (genes) of the expression matrix in blocks,
+as soon as they have been summarized (see the `output` parameter of
+`pyaffy.rma`). The whole matrix therefore never needs to be held in memory,
+and other processes can read the rows that have already been written.
+
+Supported formats are NumPy's ".npy" format (memory-mapped), HDF5 (if the
+`h5py` package is available) and Zarr (if the `zarr` package is available).
+The gene and sample names are stored along with the matrix.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+_oldstr = str
+from builtins import *
+
+import io
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class OutputSink(object):
+    """Base class of output sinks for the expression matrix.
+
+    `pyaffy.rma` calls `open` once (with the final gene and sample names),
+    then `write` for every block of genes, and finally `close`. Subclasses
+    implement `_create`, `_write_rows`, and optionally `_flush` and
+    `_close`.
+
+    Parameters
+    ----------
+    flush: bool, optional
+        Whether to flush the output to disk after every block (e.g., so that
+        other processes can read an HDF5 file while it is being written). By
+        default, the output is only flushed when it is closed. [False]
+    """
+    def __init__(self, flush = False):
+        assert isinstance(flush, bool)
+        self.flush = flush
+        self.genes = None
+        self.samples = None
+        self.shape = None
+        self.num_written = 0
+
+    def __repr__(self):
+        return '<%s object (shape = %s, %d rows written)>' \
+                %(self.__class__.__name__, self.shape, self.num_written)
+
+    def open(self, genes, samples, dtype = np.float32):
+        """Creates the output (the matrix, and the gene and sample names).
+
+        Parameters
+        ----------
+        genes: list of str
+            The gene names (the rows of the matrix).
+        samples: list of str
+            The sample names (the columns of the matrix).
+        dtype: numpy dtype, optional
+            The data type of the matrix. [np.float32]
+        """
+        assert self.shape is None, 'The output has already been opened.'
+        self.genes = list(genes)
+        self.samples = list(samples)
+        self.shape = (len(self.genes), len(self.samples))
+        self._create(self.genes, self.samples, np.dtype(dtype))
+
+    def write(self, rows, X):
+        """Writes rows of the matrix.
+
+        Parameters
+        ----------
+        rows: np.ndarray (ndim = 1)
+            The (increasing) indices of the rows.
+        X: np.ndarray (ndim = 2)
+            The values of the rows.
+        """
+        assert self.shape is not None, 'The output has not been opened.'
+        rows = np.asarray(rows, dtype = np.int64)
+        assert X.shape == (rows.size, self.shape[1])
+        if rows.size == 0:
+            return
+        assert np.all(np.diff(rows) > 0)
+
+        # write each run of consecutive rows as a single slice
+        breaks = np.nonzero(np.diff(rows) != 1)[0] + 1
+        starts = np.r_[0, breaks]
+        stops = np.r_[breaks, rows.size]
+        for s0, s1 in zip(starts.tolist(), stops.tolist()):
+            self._write_rows(int(rows[s0]), X[s0:s1])
+        if self.flush:
+            self._flush()
+        self.num_written += rows.size
+
+    def close(self):
+        """Finishes writing the output."""
+        if self.shape is not None:
+            self._close()
+
+    def _create(self, genes, samples, dtype):
+        raise NotImplementedError()
+
+    def _write_rows(self, start, X):
+        raise NotImplementedError()
+
+    def _flush(self):
+        pass
+
+    def _close(self):
+        pass
+
+
+def _write_names(path, names):
+    """Writes names to a text file (one per line)."""
+    with io.open(path, 'w', encoding = 'utf-8') as ofh:
+        for n in names:
+            ofh.write('%s\n' %(n))
+
+
+class NpyOutput(OutputSink):
+    """Writes the expression matrix to a memory-mapped ".npy" file.
+
+    The gene and sample names are written to text files (one name per line)
+    in the same directory, with the extensions ".genes.txt" and
+    ".samples.txt" instead of ".npy". The matrix can be read while it is
+    being written, using ``np.load(path, mmap_mode = 'r')`` (rows that have
+    not been written yet contain zeros).
+
+    Parameters
+    ----------
+    path: str
+        The path of the ".npy" file.
+    flush: bool, optional
+        See `OutputSink`. Flushing is not required for reading the file on
+        the same machine while it is being written. [False]
+    """
+    def __init__(self, path, flush = False):
+        assert isinstance(path, (str, _oldstr))
+        super(NpyOutput, self).__init__(flush = flush)
+        self.path = path
+        prefix = path
+        if prefix.endswith('.npy'):
+            prefix = prefix[:-4]
+        self.genes_path = prefix + '.genes.txt'
+        self.samples_path = prefix + '.samples.txt'
+        self._X = None
+
+    def _create(self, genes, samples, dtype):
+        _write_names(self.genes_path, genes)
+        _write_names(self.samples_path, samples)
+        self._X = np.lib.format.open_memmap(self.path, mode = 'w+',
+                                            dtype = dtype, shape = self.shape)
+
+    def _write_rows(self, start, X):
+        self._X[start:(start + X.shape[0])] = X
+
+    def _flush(self):
+        self._X.flush()
+
+    def _close(self):
+        if self._X is not None:
+            self._X.flush()
+            self._X = None
+
+
+class HDF5Output(OutputSink):
+    """Writes the expression matrix to a chunked HDF5 dataset.
+
+    The gene and sample names are stored in the datasets "genes" and
+    "samples" of the same file. Requires the `h5py` package.
+
+    Parameters
+    ----------
+    path: str
+        The path of the HDF5 file.
+    dataset: str, optional
+        The name of the dataset for the matrix. ["X"]
+    chunks: tuple of int or True, optional
+        The chunk shape of the dataset (True = determined by `h5py`). [True]
+    compression: str or None, optional
+        The compression filter (e.g., "gzip"). [None]
+    flush: bool, optional
+        See `OutputSink`. [False]
+    """
+    def __init__(self, path, dataset = 'X', chunks = True,
+            compression = None, flush = False):
+        # imported here, since importing h5py is slow
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError('Writing HDF5 files requires the "h5py" '
+                              'package.')
+        assert isinstance(path, (str, _oldstr))
+        assert isinstance(dataset, (str, _oldstr))
+        super(HDF5Output, self).__init__(flush = flush)
+        self.path = path
+        self.dataset = dataset
+        self.chunks = chunks
+        self.compression = compression
+        self._h5py = h5py
+        self._file = None
+        self._X = None
+
+    def _create(self, genes, samples, dtype):
+        h5py = self._h5py
+        str_dtype = h5py.special_dtype(vlen = str)
+        self._file = h5py.File(self.path, 'w')
+        self._file.create_dataset('genes', data = genes, dtype = str_dtype)
+        self._file.create_dataset('samples', data = samples,
+                                  dtype = str_dtype)
+        # chunking requires a non-empty dataset
+        chunks = self.chunks if min(self.shape) > 0 else None
+        self._X = self._file.create_dataset(self.dataset, shape = self.shape,
+                dtype = dtype, chunks = chunks,
+                compression = self.compression)
+
+    def _write_rows(self, start, X):
+        self._X[start:(start + X.shape[0]), :] = X
+
+    def _flush(self):
+        self._file.flush()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._X = None
+
+
+class ZarrOutput(OutputSink):
+    """Writes the expression matrix to a chunked Zarr array.
+
+    The matrix is stored as the array "X" of a Zarr group, and the gene and
+    sample names as the attributes "genes" and "samples" of the group.
+    Requires the `zarr` package.
+
+    Parameters
+    ----------
+    path: str
+        The path of the Zarr group (a directory).
+    chunks: tuple of int or None, optional
+        The chunk shape of the array (None = determined by `zarr`). [None]
+    """
+    def __init__(self, path, chunks = None):
+        # imported here, since importing zarr is slow
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError('Writing Zarr arrays requires the "zarr" '
+                              'package.')
+        assert isinstance(path, (str, _oldstr))
+        super(ZarrOutput, self).__init__()
+        self.path = path
+        self.chunks = chunks
+        self._zarr = zarr
+        self._X = None
+
+    def _create(self, genes, samples, dtype):
+        group = self._zarr.open_group(self.path, mode = 'w')
+        group.attrs['genes'] = genes
+        group.attrs['samples'] = samples
+        kwargs = {}
+        if self.chunks is not None:
+            kwargs['chunks'] = self.chunks
+        self._X = group.zeros(name = 'X', shape = self.shape, dtype = dtype,
+                              **kwargs)
+
+    def _write_rows(self, start, X):
+        self._X[start:(start + X.shape[0]), :] = X
+
+    def _close(self):
+        self._X = None
@@ -0,0 +1,397 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+#cython: profile=False, wraparound=False, boundscheck=False, cdivision=True
+
+"""Robust fitting of probe-level models (PLM) for many probesets.
+
+For each probeset, the (log2-scale) probe intensities are modeled as
+
+    y_kj = m_j + a_k + e_kj,
+
+where ``m_j`` is the expression of the probeset in sample j, and ``a_k`` is
+the effect of probe k (the probe effects sum to zero). The model is fit
+using an M-estimator with Huber's psi function, by iteratively reweighted
+least squares (IRLS), as done by ``fitPLM`` of the R package affyPLM
+(``rlm_fit_anova`` of preprocessCore).
+
+Each weighted least squares fit exploits the structure of the design
+matrix: The sample effects are eliminated, and only the (K-1)-by-(K-1)
+system for the probe effects of a probeset with K probes is solved (using a
+Cholesky decomposition). The cost of each iteration is therefore linear in
+the number of samples.
+"""
+
+cimport cython
+from cython.parallel cimport prange, threadid
+from libc.math cimport NAN, sqrt, fabs, isnan
+
+import multiprocessing
+
+import numpy as np
+cimport numpy as np
+
+from .quickselect cimport median_float
+
+np.import_array()
+
+
+cdef int cholesky(double* A, Py_ssize_t n) nogil:
+    """Cholesky decomposition of the symmetric matrix `A` (in-place).
+
+    Only the lower triangle of `A` is used, and replaced with the factor.
+    Returns -1 if `A` is not positive definite.
+    """
+    cdef Py_ssize_t i, j, k
+    cdef double d, s
+    for j in range(n):
+        d = A[j*n + j]
+        for k in range(j):
+            d -= A[j*n + k] * A[j*n + k]
+        if d <= 0:
+            return -1
+        d = sqrt(d)
+        A[j*n + j] = d
+        for i in range(j + 1, n):
+            s = A[i*n + j]
+            for k in range(j):
+                s -= A[i*n + k] * A[j*n + k]
+            A[i*n + j] = s / d
+    return 0
+
+
+cdef void forward_subst(const double* L, double* b, Py_ssize_t n) nogil:
+    """Solves ``L x = b`` in-place, for a lower triangular `L`."""
+    cdef Py_ssize_t i, k
+    cdef double s
+    for i in range(n):
+        s = b[i]
+        for k in range(i):
+            s -= L[i*n + k] * b[k]
+        b[i] = s / L[i*n + i]
+
+
+cdef void backward_subst(const double* L, double* b, Py_ssize_t n) nogil:
+    """Solves ``L^T x = b`` in-place, for a lower triangular `L`."""
+    cdef Py_ssize_t i, k
+    cdef double s
+    for i in range(n - 1, -1, -1):
+        s = b[i]
+        for k in range(i + 1, n):
+            s -= L[k*n + i] * b[k]
+        b[i] = s / L[i*n + i]
+
+
+cdef int wls_fit(const float* y, const double* w, Py_ssize_t num_rows,
+        Py_ssize_t num_cols, double* m, double* a, double* col_w,
+        double* S, double* t) nogil:
+    """Weighted least squares fit of the additive model of one probeset.
+
+    `y` and `w` are the (C-contiguous) values and weights of the probes.
+    The sample effects are stored in `m`, the probe effects in `a`, and the
+    sum of the weights of each sample in `col_w`. Afterwards, `S` contains
+    the Cholesky factor of the reduced system for the first ``num_rows - 1``
+    probe effects. Returns -1 if the system is singular.
+    """
+    cdef Py_ssize_t n = num_cols
+    cdef Py_ssize_t K = num_rows - 1  # the number of free probe effects
+    cdef Py_ssize_t j, k, l
+    cdef double wk, bk, r, s
+
+    for j in range(n):
+        col_w[j] = 0.0
+        for k in range(num_rows):
+            col_w[j] += w[k*n + j]
+        if col_w[j] <= 0:
+            return -1
+
+    for k in range(K*K):
+        S[k] = 0.0
+    for k in range(K):
+        t[k] = 0.0
+
+    # eliminate the sample effects (the last probe effect is minus the sum
+    # of the others)
+    for j in range(n):
+        wk = w[K*n + j]
+        r = 0.0
+        for k in range(num_rows):
+            r += w[k*n + j] * y[k*n + j]
+        for k in range(K):
+            bk = w[k*n + j] - wk
+            t[k] += w[k*n + j] * y[k*n + j] - wk * y[K*n + j] \
+                    - bk * r / col_w[j]
+            S[k*K + k] += w[k*n + j]
+            for l in range(k + 1):
+                S[k*K + l] += wk - bk * (w[l*n + j] - wk) / col_w[j]
+
+    if cholesky(S, K) != 0:
+        return -1
+    forward_subst(S, t, K)
+    backward_subst(S, t, K)
+
+    s = 0.0
+    for k in range(K):
+        a[k] = t[k]
+        s += t[k]
+    a[K] = -s
+
+    for j in range(n):
+        s = 0.0
+        for k in range(num_rows):
+            s += w[k*n + j] * (y[k*n + j] - a[k])
+        m[j] = s / col_w[j]
+
+    return 0
+
+
+cdef int fill_nan(Py_ssize_t num_rows, Py_ssize_t num_cols, float* est,
+        float* se, float* probe_eff, float* weights) nogil:
+    """Sets all results of a probeset to NaN (and returns 0)."""
+    cdef Py_ssize_t i
+    for i in range(num_cols):
+        est[i] = NAN
+        se[i] = NAN
+    for i in range(num_rows):
+        probe_eff[i] = NAN
+    if weights != NULL:
+        for i in range(num_rows * num_cols):
+            weights[i] = NAN
+    return 0
+
+
+cdef int plm_kernel(const float* y, Py_ssize_t num_rows, Py_ssize_t num_cols,
+        double psi_k, int maxiter, double eps, float* est, float* se,
+        float* probe_eff, float* weights, double* buf, float* abs_res,
+        int* converged) nogil:
+    """Fits the probe-level model of one probeset, using IRLS.
+
+    The expression estimates and their standard errors (`num_cols` values),
+    the probe effects (`num_rows` values), and the final weights (in the
+    layout of `y`; unless `weights` is NULL) are stored in the output
+    arrays. `buf` and `abs_res` are
+    scratch space (see `plm_batch`). Returns the number of iterations.
+    """
+    cdef Py_ssize_t n = num_cols
+    cdef Py_ssize_t size = num_rows * num_cols
+    cdef Py_ssize_t K = num_rows - 1
+    cdef Py_ssize_t i, j, k
+    cdef double* w = buf
+    cdef double* res = w + size
+    cdef double* m = res + size
+    cdef double* col_w = m + n
+    cdef double* a = col_w + n
+    cdef double* t = a + num_rows
+    cdef double* S = t + num_rows
+    cdef double scale, u, r, delta, norm, rss, df, v
+    cdef int it = 0
+
+    converged[0] = 0
+
+    for i in range(size):
+        if isnan(y[i]):
+            return fill_nan(num_rows, n, est, se, probe_eff, weights)
+
+    for i in range(size):
+        w[i] = 1.0
+    if wls_fit(y, w, num_rows, n, m, a, col_w, S, t) != 0:
+        return fill_nan(num_rows, n, est, se, probe_eff, weights)
+    for k in range(num_rows):
+        for j in range(n):
+            res[k*n + j] = y[k*n + j] - m[j] - a[k]
+
+    while it < maxiter:
+        # robust estimate of the residual scale
+        for i in range(size):
+            abs_res[i] = <float>fabs(res[i])
+        scale = median_float(abs_res, size) / 0.6745
+        if scale < 1e-10:
+            converged[0] = 1
+            break
+
+        # Huber weights
+        for i in range(size):
+            u = fabs(res[i] / scale)
+            w[i] = 1.0 if u <= psi_k else psi_k / u
+
+        if wls_fit(y, w, num_rows, n, m, a, col_w, S, t) != 0:
+            return fill_nan(num_rows, n, est, se, probe_eff, weights)
+        it += 1
+
+        delta = 0.0
+        norm = 0.0
+        for k in range(num_rows):
+            for j in range(n):
+                r = y[k*n + j] - m[j] - a[k]
+                delta += (r - res[k*n + j]) * (r - res[k*n + j])
+                norm += res[k*n + j] * res[k*n + j]
+                res[k*n + j] = r
+        if sqrt(delta / max(norm, 1e-20)) < eps:
+            converged[0] = 1
+            break
+
+    # the standard errors of the sample effects are based on the weighted
+    # residual variance and the inverse of X'WX
+    rss = 0.0
+    for i in range(size):
+        rss += w[i] * res[i] * res[i]
+    df = <double>(size - n - K)
+    for j in range(n):
+        est[j] = <float>m[j]
+        if df > 0:
+            # the column of the eliminated block for sample j
+            for k in range(K):
+                t[k] = w[k*n + j] - w[K*n + j]
+            forward_subst(S, t, K)
+            v = 0.0
+            for k in range(K):
+                v += t[k] * t[k]
+            v = 1.0 / col_w[j] + v / (col_w[j] * col_w[j])
+            se[j] = <float>sqrt(v * rss / df)
+        else:
+            se[j] = NAN
+    for k in range(num_rows):
+        probe_eff[k] = <float>a[k]
+    if weights != NULL:
+        for i in range(size):
+            weights[i] = <float>w[i]
+    return it
+
+
+def plm_batch(const float[:,::1] Y not None, offsets, double k = 1.345,
+        int maxiter = 20, double eps = 1e-4, int num_threads = 0,
+        return_weights = True, full_output = False):
+    """Robust probe-level model fits of many probesets, in parallel.
+
+    The probesets are consecutive blocks of rows in `Y` (the layout used by
+    `pyaffy.medpolish.medpolish_batch`). All probesets are processed in
+    compiled code without holding the GIL, using multiple threads. The
+    result for each probeset does not depend on the number of threads.
+
+    Parameters
+    ----------
+    Y: np.ndarray (ndim = 2, dtype = np.float32)
+        The (C-contiguous) probe-by-sample matrix (on a log2-scale). The rows
+        of the i'th probeset are ``Y[offsets[i]:offsets[i+1], :]``.
+    offsets: np.ndarray
+        The row offsets of the probesets (one more than there are
+        probesets).
+    k: float, optional
+        The tuning constant of Huber's psi function. [1.345]
+    maxiter: int, optional
+        The maximum number of IRLS iterations. [20]
+    eps: float, optional
+        The convergence tolerance (for the relative change of the
+        residuals). [1e-4]
+    num_threads: int, optional
+        The number of threads to use (0 = use all available cores). [0]
+    return_weights: bool, optional
+        Whether to return the final IRLS weights. If False, `weights` is
+        None (and no array of the size of `Y` is allocated for them). [True]
+    full_output: bool, optional
+        Whether to also return whether the fit converged for each probeset,
+        and the number of iterations. [False]
+
+    Returns
+    -------
+    X: np.ndarray (ndim = 2, dtype = np.float32)
+        The expression estimates (probeset-by-sample).
+    se: np.ndarray (ndim = 2, dtype = np.float32)
+        The standard errors of the expression estimates (probeset-by-sample;
+        NaN for probesets with a single probe, or a single sample).
+    row_eff: np.ndarray (ndim = 1, dtype = np.float32)
+        The effect of each row of `Y` (NaN for rows that do not belong to
+        any probeset).
+    weights: np.ndarray (ndim = 2, dtype = np.float32)
+        The final IRLS weights (in the layout of `Y`; NaN for rows that do
+        not belong to any probeset), or None if `return_weights` is False.
+    converged: np.ndarray (dtype = np.bool_)
+        Whether the fit converged for each probeset. Only returned if
+        `full_output` is True.
+    num_iter: np.ndarray (dtype = np.int32)
+        The number of iterations performed for each probeset. Only returned
+        if `full_output` is True.
+
+    Notes
+    -----
+    Probesets with missing values (NaN), and empty probesets, are not
+    fitted (all of their results are NaN).
+    """
+    assert k > 0
+    assert maxiter >= 0
+
+    cdef const np.int64_t[::1] off = np.ascontiguousarray(offsets,
+            dtype = np.int64)
+    cdef Py_ssize_t p = off.shape[0] - 1
+    cdef Py_ssize_t n = Y.shape[1]
+
+    assert p >= 0
+    assert off[0] >= 0 and off[p] <= Y.shape[0]
+
+    X_arr = np.full((p, n), np.nan, dtype = np.float32)
+    se_arr = np.full((p, n), np.nan, dtype = np.float32)
+    row_eff_arr = np.full(Y.shape[0], np.nan, dtype = np.float32)
+    weights_arr = None
+    if return_weights:
+        weights_arr = np.full((Y.shape[0], n), np.nan, dtype = np.float32)
+    conv_arr = np.zeros(p, dtype = np.int32)
+    iter_arr = np.zeros(p, dtype = np.int32)
+    cdef float[:,::1] X = X_arr
+    cdef float[:,::1] se = se_arr
+    cdef float[::1] R = row_eff_arr
+    cdef float[:,::1] W
+    cdef float* W_ptr = NULL
+    if return_weights and Y.shape[0] > 0 and n > 0:
+        W = weights_arr
+        W_ptr = &W[0, 0]
+    cdef int[::1] conv = conv_arr
+    cdef int[::1] num_iter = iter_arr
+
+    cdef Py_ssize_t i, max_rows = 0
+    for i in range(p):
+        assert off[i+1] >= off[i]
+        if off[i+1] - off[i] > max_rows:
+            max_rows = off[i+1] - off[i]
+
+    if num_threads <= 0:
+        num_threads = multiprocessing.cpu_count()
+
+    # scratch buffers for each thread (weights and residuals, sample
+    # effects and weight sums, probe effects, right-hand side, and the
+    # reduced system)
+    cdef Py_ssize_t buf_size = 2 * max_rows * n + 2 * n + 2 * max_rows + \
+            max_rows * max_rows + 1
+    cdef double[:,::1] buf = np.empty((num_threads, buf_size),
+            dtype = np.float64)
+    cdef float[:,::1] abs_res = np.empty(
+            (num_threads, max(max_rows * n, 1)), dtype = np.float32)
+    cdef int tid
+
+    if p > 0 and n > 0:
+        for i in prange(p, nogil = True, schedule = 'dynamic',
+                num_threads = num_threads):
+            tid = threadid()
+            if off[i+1] > off[i]:
+                num_iter[i] = plm_kernel(&Y[off[i], 0], off[i+1] - off[i], n,
+                        k, maxiter, eps, &X[i, 0], &se[i, 0], &R[off[i]],
+                        (W_ptr + off[i] * n) if W_ptr != NULL else NULL,
+                        &buf[tid, 0], &abs_res[tid, 0],
+                        &conv[i])
+
+    if full_output:
+        return X_arr, se_arr, row_eff_arr, weights_arr, \
+                conv_arr.astype(np.bool_), iter_arr
+    return X_arr, se_arr, row_eff_arr, weights_arr
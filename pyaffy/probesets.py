@@ -0,0 +1,224 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""A compact index of the probes belonging to each probeset."""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+_oldstr = str
+from builtins import *
+
+import collections
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import numpy as np
+
+
+class ProbesetIndex(Mapping):
+    """The probe indices of a set of probesets, stored in CSR format.
+
+    The indices of all probes are stored in one flat array, and the probes of
+    the i'th probeset are ``indices[offsets[i]:offsets[i+1]]``. The probe
+    indices refer to the order in which probe intensities are stored in CEL
+    files.
+
+    The class implements the `Mapping` interface (with probeset names as keys
+    and index arrays as values), so it can be used like the ordered
+    dictionary that `parse_cdf` used to return.
+
+    Parameters
+    ----------
+    names: list or np.ndarray of str
+        The probeset names.
+    offsets: np.ndarray of integers
+        The offsets of the probesets in `indices` (one more than there are
+        probesets, starting at 0).
+    indices: np.ndarray of type np.uint32
+        The concatenated probe indices of all probesets.
+    """
+    def __init__(self, names, offsets, indices):
+        names = np.asarray(names, dtype = np.str_)
+        offsets = np.asarray(offsets, dtype = np.int64)
+        indices = np.asarray(indices, dtype = np.uint32)
+
+        assert names.ndim == 1
+        assert offsets.ndim == 1 and offsets.size == names.size + 1
+        assert indices.ndim == 1
+        assert offsets[0] == 0 and offsets[-1] == indices.size
+
+        self._names = names
+        self._offsets = offsets
+        self._indices = indices
+        self._positions = None
+
+    def __repr__(self):
+        return '<%s object (%d probesets, %d probes)>' \
+                %(self.__class__.__name__, len(self), self.num_probes)
+
+    def __len__(self):
+        return self._names.size
+
+    def __iter__(self):
+        return iter(self._names.tolist())
+
+    def __contains__(self, name):
+        return name in self._get_positions()
+
+    def __getitem__(self, name):
+        i = self._get_positions()[name]
+        return self._indices[self._offsets[i]:self._offsets[i+1]]
+
+    def _get_positions(self):
+        """Returns a dictionary mapping each name to its position."""
+        if self._positions is None:
+            self._positions = dict(
+                (name, i) for i, name in enumerate(self._names.tolist()))
+        return self._positions
+
+    @property
+    def names(self):
+        """The probeset names (np.ndarray)."""
+        return self._names
+
+    @property
+    def offsets(self):
+        """The probeset offsets (np.ndarray of type np.int64)."""
+        return self._offsets
+
+    @property
+    def indices(self):
+        """The concatenated probe indices (np.ndarray of type np.uint32)."""
+        return self._indices
+
+    @property
+    def sizes(self):
+        """The number of probes in each probeset (np.ndarray)."""
+        return np.diff(self._offsets)
+
+    @property
+    def num_probes(self):
+        """The total number of probes."""
+        return self._indices.size
+
+    @classmethod
+    def from_dict(cls, probesets):
+        """Creates an index from a (ordered) dictionary.
+
+        Parameters
+        ----------
+        probesets: dict (str => np.ndarray)
+            The probe indices of each probeset.
+
+        Returns
+        -------
+        ProbesetIndex
+            The index.
+        """
+        names = list(probesets.keys())
+        arrays = [np.asarray(v, dtype = np.uint32) for v in probesets.values()]
+        offsets = np.zeros(len(arrays) + 1, dtype = np.int64)
+        np.cumsum([a.size for a in arrays], out = offsets[1:])
+        if arrays:
+            indices = np.concatenate(arrays)
+        else:
+            indices = np.empty(0, dtype = np.uint32)
+        return cls(names, offsets, indices)
+
+    def to_dict(self):
+        """Converts the index to an ordered dictionary.
+
+        Returns
+        -------
+        collections.OrderedDict (str => np.ndarray)
+            The probe indices of each probeset.
+        """
+        return collections.OrderedDict(self.items())
+
+    def slice(self, start, stop):
+        """Returns the index of a contiguous range of probesets.
+
+        The new index shares the probe indices with this index (no copy is
+        made).
+
+        Parameters
+        ----------
+        start: int
+            The position of the first probeset.
+        stop: int
+            The position after the last probeset.
+
+        Returns
+        -------
+        ProbesetIndex
+            The index of the probesets.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        offsets = self._offsets[start:(stop + 1)]
+        indices = self._indices[offsets[0]:offsets[-1]]
+        return ProbesetIndex(self._names[start:stop], offsets - offsets[0],
+                             indices)
+
+    def subset(self, sel):
+        """Returns the index of a subset of probesets.
+
+        Parameters
+        ----------
+        sel: np.ndarray
+            The positions (integers) of the probesets to select (in the order
+            in which they should appear), or a boolean mask.
+
+        Returns
+        -------
+        ProbesetIndex
+            The index of the selected probesets.
+        """
+        sel = np.asarray(sel)
+        if sel.dtype == np.bool_:
+            sel = np.nonzero(sel)[0]
+        sizes = self.sizes[sel]
+        offsets = np.zeros(sel.size + 1, dtype = np.int64)
+        np.cumsum(sizes, out = offsets[1:])
+
+        # gather the probe indices of all selected probesets at once
+        probe_sel = np.arange(offsets[-1], dtype = np.int64)
+        probe_sel += np.repeat(self._offsets[sel] - offsets[:-1], sizes)
+        return ProbesetIndex(self._names[sel], offsets,
+                             self._indices[probe_sel])
+
+    def sort_order(self):
+        """Returns the positions of the probesets in alphabetical order.
+
+        Returns
+        -------
+        np.ndarray
+            The positions (the sort is stable).
+        """
+        return np.argsort(self._names, kind = 'mergesort')
+
+    def sorted(self):
+        """Returns an index with the probesets in alphabetical order.
+
+        Returns
+        -------
+        ProbesetIndex
+            The sorted index.
+        """
+        return self.subset(self.sort_order())
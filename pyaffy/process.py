@@ -21,29 +21,463 @@ from builtins import *
 
 import os
 import time
+import shutil
+import tempfile
+import ctypes
 import logging
 import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
-from genometools.expression import quantile_normalize as qnorm
-from genometools.expression import ExpMatrix
-
 from .cdfparser import parse_cdf
-from . import celparser
-from .celparser import parse_cel
-from .medpolish import medpolish
+from . import cache
+from .celparser import parse_cel, read_cel_headers
+from .medpolish import medpolish_batch, summarize_batch, SUMMARY_METHODS
+from .plm import plm_batch
 from .background import rma_bg_correct
+from .normalize import quantile_normalize as qnorm
+from .normalize import rank_samples, get_reference, apply_ranks
+from .stats import RMAStats, _wall_clock, _cpu_clock, _thread_cpu_clock
+from .output import OutputSink
 
 logger = logging.getLogger(__name__)
 
+# state of CEL parsing worker processes (set by `_init_cel_worker`)
+_worker = {}
+
+def _init_cel_worker(shared, shape, pm_sel, mmap, num_threads, cache_dir,
+        cel_cache_size):
+    """Initializes a worker process for parallel CEL file parsing."""
+    _worker['Y'] = np.frombuffer(shared, dtype = np.float32).reshape(shape)
+    _worker['pm_sel'] = pm_sel
+    _worker['mmap'] = mmap
+    _worker['num_threads'] = num_threads
+    # use the same cache settings as the parent process
+    cache.set_cache_dir(cache_dir)
+    if cel_cache_size is not None:
+        cache.enable_cel_cache(cel_cache_size)
+    else:
+        cache.disable_cel_cache()
+
+def _parse_cel_column(cel_file, pm_sel, y, mmap, num_threads,
+        cpu_clock = _cpu_clock):
+    """Parses a CEL file and writes the selected probes into `y`.
+
+    Returns the wall-clock and CPU time (measured using `cpu_clock`).
+    """
+    w0, c0 = _wall_clock(), cpu_clock()
+    parse_cel(cel_file, mmap = mmap, index = pm_sel, out = y,
+              num_threads = num_threads)
+    return _wall_clock() - w0, cpu_clock() - c0
+
+def _parse_cel_worker(args):
+    """Parses a CEL file and writes the selected probes into shared memory.
+
+    Returns the column index, and the wall-clock and CPU time.
+    """
+    j, cel_file = args
+    wall_time, cpu_time = _parse_cel_column(cel_file, _worker['pm_sel'],
+            _worker['Y'][:,j], _worker['mmap'], _worker['num_threads'])
+    return j, wall_time, cpu_time
+
+def _create_cel_pool(num_procs, shape, pm_sel, mmap, num_threads = 1,
+        use_threads = False):
+    """Creates a pool of CEL parsing worker processes (or threads).
+
+    Each worker uses `num_threads` threads for parsing plain-text CEL files.
+    Returns the pool and the shared-memory matrix that the workers write to.
+    If `use_threads` is True, the pool is a thread pool, and the matrix is
+    a regular array.
+    """
+    if use_threads:
+        return ThreadPool(num_procs), np.empty(shape, dtype = np.float32)
+
+    shared = multiprocessing.RawArray(ctypes.c_float, shape[0] * shape[1])
+    Y = np.frombuffer(shared, dtype = np.float32).reshape(shape)
+    pool = multiprocessing.Pool(num_procs, initializer = _init_cel_worker,
+            initargs = (shared, shape, pm_sel, mmap, num_threads,
+                        cache.get_cache_dir(), cache.get_cel_cache_size()))
+    return pool, Y
+
+def _check_cel_files(cel_files, num_rows, num_cols, num_threads = 1):
+    """Checks that the dimensions of all CEL files match those of the CDF.
+
+    Only the file headers are read (using `num_threads` threads). Raises a
+    ValueError if any file does not match, and logs a warning if the files
+    are of different array types.
+    """
+    headers = read_cel_headers(cel_files, num_threads = num_threads)
+    mismatched = [h for h in headers
+                  if (h.num_rows, h.num_cols) != (num_rows, num_cols)]
+    if mismatched:
+        h = mismatched[0]
+        raise ValueError('%d of %d CEL files do not match the dimensions of '
+                         'the CDF file (%d x %d), e.g., "%s" (%d x %d).'
+                         %(len(mismatched), len(headers), num_rows, num_cols,
+                           h.path, h.num_rows, h.num_cols))
+
+    chip_types = set(h.chip_type for h in headers
+                     if h.chip_type is not None)
+    if len(chip_types) > 1:
+        logger.warning('The CEL files are of different array types: %s',
+                       ', '.join(sorted(chip_types)))
+    return headers
+
+def _read_cel_files(cel_files, pm_sel, Y, pool = None, mmap = False,
+        num_threads = 1, stats = None, first_index = 0):
+    """Parses CEL files and stores the selected probes in the columns of `Y`.
+
+    If `pool` is a pool of worker processes (see `_create_cel_pool`), `Y`
+    must be (a view of) the shared-memory matrix that they write to. If it
+    is a thread pool, its threads write to `Y` directly (the parsers do not
+    hold the GIL while decoding the intensities). Either way, plain-text CEL
+    files are parsed using `num_threads` threads each. If `stats` is given,
+    the parsing time of each file is recorded, with the file index starting
+    at `first_index`.
+    """
+    if isinstance(pool, ThreadPool):
+        def parse(args):
+            j, cel_file = args
+            wall_time, cpu_time = _parse_cel_column(cel_file, pm_sel,
+                    Y[:,j], mmap, num_threads,
+                    cpu_clock = _thread_cpu_clock)
+            return j, wall_time, cpu_time
+        results = pool.imap_unordered(parse, enumerate(cel_files))
+
+    elif pool is not None:
+        results = pool.imap_unordered(_parse_cel_worker,
+                                      enumerate(cel_files))
+
+    else:
+        def parse_all():
+            for j, cel_file in enumerate(cel_files):
+                logger.debug('Parsing CEL file: %s', cel_file)
+                wall_time, cpu_time = _parse_cel_column(cel_file, pm_sel,
+                        Y[:,j], mmap, num_threads)
+                yield j, wall_time, cpu_time
+        results = parse_all()
+
+    for j, wall_time, cpu_time in results:
+        logger.debug('Parsed CEL file: %s', cel_files[j])
+        if stats is not None:
+            stats.add_cel_file(first_index + j, cel_files[j],
+                               wall_time, cpu_time)
+
+def _permute_rows(X, a):
+    """Reorders the rows of `X` in-place, so that row i is the former row a[i].
+
+    The permutation is applied cycle by cycle, so that only one row is copied
+    at a time (instead of the whole matrix, as with ``X[a,:]``).
+    """
+    a = a.tolist()
+    done = [False] * len(a)
+    for i in range(len(a)):
+        if done[i] or a[i] == i:
+            continue
+        row = X[i].copy()
+        j = i
+        while a[j] != i:
+            X[j] = X[a[j]]
+            done[j] = True
+            j = a[j]
+        X[j] = row
+        done[j] = True
+    return X
+
+def _summarize(Y, probesets, medianpolish, n_jobs, method = 'median',
+        stats = None, full_output = False):
+    """Summarizes the (log2-scale) probe intensities of each probeset.
+
+    Without median polish, each probeset is summarized using `method` (see
+    `pyaffy.medpolish.summarize_batch`), or by fitting a robust probe-level
+    model if `method` is "plm" (see `pyaffy.plm.plm_batch`). Returns the
+    probeset-by-sample matrix, whether median polish (or the model fit)
+    converged for each probeset (or None), and the standard errors of the
+    model fit (or None). If `full_output` is True, the probe effects (or
+    None) are returned as well.
+    """
+    # all probesets are processed in compiled code, using n_jobs threads
+    se = None
+    if medianpolish:
+        X, converged, num_iter, row_eff = medpolish_batch(Y,
+                probesets.offsets, copy = False, num_threads = n_jobs,
+                full_output = True)
+        if stats is not None:
+            stats.add_medpolish_results(converged, num_iter)
+    elif method == 'plm':
+        X, se, row_eff, _, converged, _ = plm_batch(Y, probesets.offsets,
+                num_threads = n_jobs, return_weights = False,
+                full_output = True)
+    else:
+        # simply summarize the values of the probes in each sample
+        X = summarize_batch(Y, probesets.offsets, method = method,
+                            num_threads = n_jobs)
+        converged, row_eff = None, None
+
+    if full_output:
+        return X, converged, se, row_eff
+    return X, converged, se
+
+def _rma_chunked(cel_files, probesets, bg_correct, quantile_normalize,
+        medianpolish, n_jobs, mmap, scratch_dir, memory_budget,
+        stats = None, use_threads = False, summary_method = 'median',
+        output = None, positions = None):
+    """Performs RMA in chunks, using a disk-backed probe matrix.
+
+    In the first pass, the CEL files are read in chunks of samples. Each
+    chunk is background-corrected, and its values are replaced with their
+    ranks (see `pyaffy.normalize.rank_samples`), which are written to a
+    probe-by-sample matrix in the scratch directory. In the second pass,
+    the matrix is read back in blocks of probesets, the ranks are replaced
+    with the (log2-transformed) reference values, and the probesets are
+    summarized. The result is identical to that of in-memory processing.
+
+    Returns the probeset-by-sample matrix, whether median polish (or the
+    model fit) converged for each probeset (or None), and the standard
+    errors of the model fit (or None; see `_summarize`). If `output` is
+    specified, the blocks of probesets are instead written to the output
+    sink as they are summarized (to the rows given by `positions`), and None
+    is returned in place of the matrix. The performance of each stage is
+    recorded in `stats`.
+    """
+    if stats is None:
+        stats = RMAStats(len(cel_files))
+
+    pm_sel = probesets.indices
+    p = pm_sel.size
+    n = len(cel_files)
+
+    # the number of samples to process at once
+    chunk_size = int(min(max(memory_budget // (4 * max(p, 1)), 1), n))
+    num_procs = min(n_jobs, chunk_size)
+    # the remaining cores are used for parsing each file with several threads
+    parse_threads = max(n_jobs // num_procs, 1)
+    logger.info('Processing %d samples at a time.', chunk_size)
+
+    temp_dir = tempfile.mkdtemp(prefix = 'pyaffy_', dir = scratch_dir)
+    try:
+        # the probe matrix contains ranks (after quantile normalization) or
+        # log2-transformed intensities
+        dtype = np.uint32 if quantile_normalize else np.float32
+        D = np.memmap(os.path.join(temp_dir, 'probes.dat'), dtype = dtype,
+                      mode = 'w+', shape = (p, n))
+        target_sum = np.zeros(p, dtype = np.float64)
+
+        ### first pass: read, correct and rank the samples
+        pool = None
+        if num_procs > 1:
+            logger.info('Using %d worker %s.', num_procs,
+                        'threads' if use_threads else 'processes')
+            pool, buf = _create_cel_pool(num_procs, (p, chunk_size), pm_sel,
+                                         mmap, num_threads = parse_threads,
+                                         use_threads = use_threads)
+        else:
+            buf = np.empty((p, chunk_size), dtype = np.float32)
+
+        try:
+            for j0 in range(0, n, chunk_size):
+                j1 = min(j0 + chunk_size, n)
+                Y = buf[:, :(j1 - j0)]
+                with stats.stage('cel'):
+                    _read_cel_files(cel_files[j0:j1], pm_sel, Y, pool, mmap,
+                                    num_threads = parse_threads,
+                                    stats = stats, first_index = j0)
+                if bg_correct:
+                    with stats.stage('background'):
+                        Y = rma_bg_correct(Y, num_threads = n_jobs)
+                if quantile_normalize:
+                    with stats.stage('normalization'):
+                        Y = rank_samples(Y, target_sum, num_threads = n_jobs)
+                else:
+                    with stats.stage('log2'):
+                        np.log2(Y, out = Y)
+                with stats.stage('scratch_io'):
+                    D[:, j0:j1] = Y
+                logger.debug('Processed samples %d - %d.', j0 + 1, j1)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        del buf, Y
+        D.flush()
+
+        if quantile_normalize:
+            _, values = get_reference(target_sum, n, log2 = True)
+
+        ### second pass: summarize blocks of probesets
+        # the number of probes to process at once
+        block_size = max(memory_budget // (4 * max(n, 1)), 1)
+        offsets = probesets.offsets
+        m = len(probesets)
+        X = None
+        if output is None:
+            X = np.empty((m, n), dtype = np.float32)
+        converged = None
+        if medianpolish or summary_method == 'plm':
+            converged = np.empty(m, dtype = np.bool_)
+        se = None
+        if not medianpolish and summary_method == 'plm':
+            se = np.empty((m, n), dtype = np.float32)
+        blocks = []
+        i0 = 0
+        while i0 < m:
+            # always include at least one probeset
+            i1 = max(int(np.searchsorted(offsets, offsets[i0] + block_size,
+                                         side = 'right')) - 1, i0 + 1)
+            blocks.append((i0, i1))
+            i0 = i1
+        # the blocks are read into the same buffer
+        max_rows = max([offsets[i1] - offsets[i0] for i0, i1 in blocks] + [0])
+        buf = np.empty((max_rows, n), dtype = dtype)
+        for i0, i1 in blocks:
+            with stats.stage('scratch_io'):
+                Y = buf[:(offsets[i1] - offsets[i0])]
+                Y[:] = D[offsets[i0]:offsets[i1], :]
+            if quantile_normalize:
+                with stats.stage('normalization'):
+                    Y = apply_ranks(Y, values, num_threads = n_jobs)
+            with stats.stage('summarization'):
+                X_block, c, se_block = _summarize(Y,
+                                        probesets.slice(i0, i1),
+                                        medianpolish, n_jobs,
+                                        method = summary_method,
+                                        stats = stats)
+            if output is not None:
+                with stats.stage('output'):
+                    rows = positions[i0:i1]
+                    b = np.argsort(rows, kind = 'mergesort')
+                    output.write(rows[b], X_block[b])
+            else:
+                X[i0:i1] = X_block
+            if converged is not None:
+                converged[i0:i1] = c
+            if se is not None:
+                se[i0:i1] = se_block
+        del D, buf
+
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors = True)
+
+    return X, converged, se
+
+def _rma_in_memory(cel_files, probesets, bg_correct, quantile_normalize,
+        medianpolish, n_jobs, mmap, stats = None, full_output = False,
+        use_threads = False, summary_method = 'median'):
+    """Performs RMA with the whole probe matrix in memory.
+
+    Returns the probeset-by-sample matrix, whether median polish (or the
+    model fit) converged for each probeset (or None), and the standard
+    errors of the model fit (or None; see `_summarize`). If `full_output`
+    is True, the quantile normalization reference distribution (or None)
+    and the probe effects (or None) are returned as well. The performance of each stage
+    is recorded in `stats`.
+    """
+    if stats is None:
+        stats = RMAStats(len(cel_files))
+
+    ### read CEL data
+    logger.info('Parsing CEL files...')
+    t0 = time.time()
+    pm_sel = probesets.indices
+    p = pm_sel.size
+    n = len(cel_files)
+    num_procs = min(n_jobs, n)
+    # the remaining cores are used for parsing each file with several threads
+    parse_threads = max(n_jobs // max(num_procs, 1), 1)
+
+    pool = None
+    if num_procs > 1:
+        logger.info('Using %d worker %s.', num_procs,
+                    'threads' if use_threads else 'processes')
+        pool, Y = _create_cel_pool(num_procs, (p, n), pm_sel, mmap,
+                                   num_threads = parse_threads,
+                                   use_threads = use_threads)
+    else:
+        Y = np.empty((p, n), dtype = np.float32)
+
+    try:
+        with stats.stage('cel'):
+            _read_cel_files(cel_files, pm_sel, Y, pool, mmap,
+                            num_threads = parse_threads, stats = stats)
+    finally:
+        if pool is not None:
+            # all results have been received at this point (unless an error
+            # occurred), so it is safe to terminate the workers
+            pool.terminate()
+            pool.join()
+
+    t1 = time.time()
+    logger.info('CEL files parsing time: %.1f s.', t1 - t0)
+
+    ### background correction
+    if bg_correct:
+        logger.info('Performing background correction...')
+        t0 = time.time()
+        with stats.stage('background'):
+            Y = rma_bg_correct(Y, num_threads = n_jobs)
+        t1 = time.time()
+        logger.info('Background correction time: %.1f s.', t1 -t0)
+    else:
+        logger.info('Skipping background correction.')
+
+    ### quantile normalization
+    # (intensities are converted to log2-scale in the same pass)
+    if quantile_normalize:
+        logger.info('Performing quantile normalization...')
+        t0 = time.time()
+        with stats.stage('normalization'):
+            Y, target = qnorm(Y, log2 = True, num_threads = n_jobs,
+                              full_output = True)
+        t1 = time.time()
+        logger.info('Quantile normalization time: %.1f s.', t1 - t0)
+    else:
+        logger.info('Skipping quantile normalization.')
+        target = None
+        ### convert intensities to log2-scale
+        with stats.stage('log2'):
+            np.log2(Y, out = Y)
+
+    ### probeset summarization (with or without median polish)
+    if medianpolish:
+        logger.info('Summarize probeset intensities (with medianpolish)...')
+    elif summary_method == 'plm':
+        logger.info('Summarize probeset intensities (without medianpolish, '
+                    'using a robust probe-level model)...')
+    else:
+        logger.info('Summarize probeset intensities (without medianpolish, '
+                    'using the %s)...', summary_method.replace('_', ' '))
+
+    t0 = time.time()
+    with stats.stage('summarization'):
+        X, converged, se, row_eff = _summarize(Y, probesets, medianpolish,
+                n_jobs, method = summary_method, stats = stats,
+                full_output = True)
+    t1 = time.time()
+    logger.info('Probeset summarization time: %.2f s.', t1 - t0)
+
+    if full_output:
+        return X, converged, se, target, row_eff
+    return X, converged, se
+
 def rma(
         cdf_file,
         sample_cel_files,
         pm_probes_only = True,
         bg_correct = True,
         quantile_normalize = True,
-        medianpolish = True
+        medianpolish = True,
+        summary_method = 'median',
+        n_jobs = 1,
+        mmap = False,
+        use_cdf_cache = True,
+        scratch_dir = None,
+        memory_budget = None,
+        callback = None,
+        use_threads = False,
+        output = None,
+        full_output = False
     ):
     """Perform RMA on a set of samples.
 
@@ -66,6 +500,64 @@ def rma(
         Whether or not to apply quantile normalization. [True]
     medianpolish: bool, optional
         Whether or not to apply medianpolish. [True]
+    summary_method: str, optional
+        How to summarize the probes of each probeset if `medianpolish` is
+        False: "median", "mean", "trimmed_mean" (10% of the values are
+        removed from each end), "biweight" (the one-step Tukey biweight), or
+        "plm" (a robust probe-level model, as fitted by the R package
+        affyPLM, which also provides standard errors; see
+        `pyaffy.plm.plm_batch`). See `pyaffy.medpolish.summarize_batch`.
+        ["median"]
+    n_jobs: int, optional
+        The number of worker processes (or threads, see `use_threads`) to
+        use for parsing CEL files, and the number of threads to use for
+        background correction, quantile normalization and median polish.
+        Worker processes write the intensities of the selected probes
+        directly into a shared-memory probe matrix (worker threads write
+        into the probe matrix of the current process). If -1, use all
+        available cores. [1]
+    mmap: bool, optional
+        Whether to memory-map uncompressed Version 4 CEL files instead of
+        reading them. Only the pages containing the selected probes are then
+        read from disk, and no full-size intensity array is allocated per
+        sample. [False]
+    use_cdf_cache: bool, optional
+        Whether to use the on-disk cache of parsed CDF files (see
+        `pyaffy.cache`). [True] The cache of parsed CEL files is used
+        automatically if it is enabled (see
+        `pyaffy.cache.enable_cel_cache`).
+    scratch_dir: str, optional
+        If specified, perform RMA out-of-core, for data sets that do not fit
+        into memory. The samples are then processed in chunks, and the probe
+        matrix is stored in a temporary file in this directory (it requires
+        four bytes per probe and sample). The results are identical to those
+        of in-memory processing. [None]
+    memory_budget: int, optional
+        The (approximate) amount of memory in bytes to use for the probe data
+        when performing RMA out-of-core. This determines the number of
+        samples, and the number of probes, that are processed at once. It
+        does not include the memory required for the CDF data and the
+        results. [1 GiB]
+    callback: callable, optional
+        A function that is called as ``callback(event, stats)`` whenever a
+        processing stage starts or finishes, and whenever a CEL file has been
+        parsed (e.g., for reporting progress). See `pyaffy.stats.RMAStats`.
+        [None]
+    use_threads: bool, optional
+        Whether to parse CEL files using `n_jobs` threads of the current
+        process, instead of `n_jobs` worker processes. The parsers do not
+        hold the GIL while decoding the intensities, so this avoids the
+        overhead of starting worker processes and of copying data between
+        them. [False]
+    output: `pyaffy.output.OutputSink`, optional
+        If specified, the expression matrix is written to this output sink
+        (e.g., `pyaffy.output.HDF5Output`) in blocks of genes, and the sink
+        is returned instead of the matrix. When processing out-of-core, each
+        block is written as soon as it has been summarized, and the whole
+        matrix is never held in memory. [None]
+    full_output: bool, optional
+        Whether to also return the performance statistics (and the standard
+        errors, if `summary_method` is "plm"). [False]
 
     Returns
     -------
@@ -74,7 +566,17 @@ def rma(
     samples: tuple of str
         The list of sample names.
     X: np.ndarray (ndim = 2, dtype = np.float32)
-        The expression matrix (genes-by-samples).
+        The expression matrix (genes-by-samples). If `output` is specified,
+        the (closed) output sink is returned instead.
+    stats: `pyaffy.stats.RMAStats`
+        The performance statistics (wall-clock and CPU time and memory usage
+        of each stage, parsing time of each CEL file, and convergence of
+        median polish). Only returned if `full_output` is True.
+    se: np.ndarray (ndim = 2, dtype = np.float32)
+        The standard errors of the expression values (genes-by-samples; NaN
+        for genes with a single probe). Only returned if `full_output` is
+        True and the probesets are summarized using "plm". The matrix is
+        held in memory even if `output` is specified.
 
     Examples
     --------
@@ -104,8 +606,29 @@ def rma(
     assert isinstance(bg_correct, bool)
     assert isinstance(quantile_normalize, bool)
     assert isinstance(medianpolish, bool)
+    assert summary_method in SUMMARY_METHODS or summary_method == 'plm', \
+            'Unknown summarization method: %s' %(summary_method)
+    assert isinstance(n_jobs, int) and (n_jobs >= 1 or n_jobs == -1)
+    assert isinstance(mmap, bool)
+    assert isinstance(use_cdf_cache, bool)
+    if scratch_dir is not None:
+        assert isinstance(scratch_dir, (str, _oldstr))
+        assert os.path.isdir(scratch_dir), \
+                'Scratch directory "%s" does not exist!' %(scratch_dir)
+    if memory_budget is not None:
+        assert isinstance(memory_budget, int) and memory_budget > 0
+    else:
+        memory_budget = 2**30
+    assert callback is None or callable(callback)
+    assert isinstance(use_threads, bool)
+    assert output is None or isinstance(output, OutputSink)
+    assert isinstance(full_output, bool)
+
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
 
     t00 = time.time()
+    stats = RMAStats(len(sample_cel_files), callback = callback)
 
     ### read CDF data
     logger.info('Parsing CDF file.')
@@ -114,106 +637,87 @@ def rma(
     probe_type = 'pm'
     if not pm_probes_only:
         probe_type = 'all'
-    name, num_rows, num_cols, pm_probesets = \
-            parse_cdf(cdf_file, probe_type=probe_type)
-
-    # concatenate indices of all PM probes into one long vector
-    pm_sel = np.concatenate(list(pm_probesets.values()))
+    with stats.stage('cdf'):
+        name, num_rows, num_cols, pm_probesets = \
+                parse_cdf(cdf_file, probe_type=probe_type,
+                          use_cache=use_cdf_cache, num_threads=n_jobs)
 
     t1 = time.time()
     logger.info('CDF file parsing time: %.2f s', t1 - t0)
     logger.info('CDF array design name: %s', name)
     logger.info('CDF rows / columns: %d x %d', num_rows, num_cols)
 
-    ### read CEL data
-    logger.info('Parsing CEL files...')
-    t0 = time.time()
-    p = pm_sel.size
-    n = len(sample_cel_files)
-    Y = np.empty((p, n), dtype = np.float32)
-
-    samples = []
-    sub_logger = logging.getLogger(celparser.__name__)
-    sub_logger.setLevel(logging.WARNING)
-    for j, (sample, cel_file) in enumerate(sample_cel_files.items()):
-        logger.debug('Parsing CEL file for sample "%s": %s', sample, cel_file)
-        samples.append(sample)
-        y = parse_cel(cel_file)
-        Y[:,j] = y[pm_sel]
-    sub_logger.setLevel(logging.NOTSET)
-    t1 = time.time()
-    logger.info('CEL files parsing time: %.1f s.', t1 - t0)
-
-    ### background correction
-    if bg_correct:
-        logger.info('Performing background correction...')
-        t0 = time.time()
-        Y = rma_bg_correct(Y)
-        t1 = time.time()
-        logger.info('Background correction time: %.1f s.', t1 -t0)
-    else:
-        logger.info('Skipping background correction.')
+    samples = list(sample_cel_files.keys())
+    cel_files = list(sample_cel_files.values())
 
-    matrix = ExpMatrix(genes=pm_sel, samples=samples, X=Y)
+    # fail early if any CEL file does not match the CDF
+    with stats.stage('cel_headers'):
+        _check_cel_files(cel_files, num_rows, num_cols, num_threads = n_jobs)
 
-    ### quantile normalization
-    if quantile_normalize:
-        logger.info('Performing quantile normalization...')
-        t0 = time.time()
-        matrix = qnorm(matrix)
-        t1 = time.time()
-        logger.info('Quantile normalization time: %.1f s.', t1 - t0)
-    else:
-        logger.info('Skipping quantile normalization.')
+    # the genes are sorted alphabetically
+    a = pm_probesets.sort_order()
+    genes = pm_probesets.names[a].tolist()
 
-    ### convert intensities to log2-scale
-    Y = np.log2(matrix.values)
+    positions = None
+    if output is not None:
+        # the position of each probeset in the output
+        positions = np.empty(a.size, dtype = np.int64)
+        positions[a] = np.arange(a.size)
+        output.open(genes, samples)
 
-    ### probeset summarization (with or without median polish)
-    method = 'with'
-    if not medianpolish:
-        method = 'without'
-    logger.info('Summarize probeset intensities (%s medianpolish)...', method)
+    try:
+        if scratch_dir is not None:
+            logger.info('Performing RMA in chunks (out-of-core)...')
+            t0 = time.time()
+            X, converged, se = _rma_chunked(cel_files, pm_probesets, bg_correct,
+                    quantile_normalize, medianpolish, n_jobs, mmap,
+                    scratch_dir, memory_budget, stats = stats,
+                    use_threads = use_threads,
+                    summary_method = summary_method, output = output,
+                    positions = positions)
+            t1 = time.time()
+            logger.info('Chunked RMA time: %.1f s.', t1 - t0)
 
-    t0 = time.time()
-    p = len(pm_probesets)
-    n = Y.shape[1]
-    X = np.empty((p, n), dtype = np.float32)
-    cur = 0
-    num_converged = 0
-    genes = []
-    for i , (gene_id, probes) in enumerate(pm_probesets.items()):
-        genes.append(gene_id)
-
-        if medianpolish:
-            #X_sub = np.ascontiguousarray(Y[cur:(cur + probes.size),:])
-            X_sub = Y[cur:(cur + probes.size),:]
-            _, row_eff, col_eff, global_eff, converged, num_iter = medpolish(X_sub, copy = False)
-            X[i,:] = col_eff + global_eff
-            if converged:
-                num_converged += 1
-         
         else:
-            # simply use median across probes
-            X[i,:] = np.median(Y[cur:(cur+probes.size),:], axis = 0) 
-            #X[i,:] = np.ma.median(X_sub, axis = 0)
+            X, converged, se = _rma_in_memory(cel_files, pm_probesets,
+                    bg_correct, quantile_normalize, medianpolish, n_jobs,
+                    mmap, stats = stats, use_threads = use_threads,
+                    summary_method = summary_method)
+            if output is not None:
+                # write the genes in sorted order, in blocks
+                block_size = max(memory_budget // (4 * max(len(samples), 1)),
+                                 1)
+                with stats.stage('output'):
+                    for i0 in range(0, a.size, block_size):
+                        i1 = min(i0 + block_size, a.size)
+                        output.write(np.arange(i0, i1), X[a[i0:i1]])
+                X = None
 
-        cur += probes.size
+    finally:
+        if output is not None:
+            output.close()
 
-    t1 = time.time()
-    logger.info('Probeset summarization time: %.2f s.', t1 - t0)
-
-    if medianpolish:
+    if converged is not None:
+        num_converged = int(np.sum(converged))
+        m = converged.size
         logger.debug('Converged: %d / %d (%.1f%%)',
-                num_converged, p, 100 * (num_converged / float(p)))
+                num_converged, m, 100 * (num_converged / float(max(m, 1))))
     
     ### report total time
     t11 = time.time()
     logger.info('Total RMA time: %.1f s.', t11 - t00)
 
     ### sort alphabetically by gene name
-    a = np.lexsort([genes])
-    genes = [genes[i] for i in a]
-    X = X[a,:]
+    if output is not None:
+        X = output
+    else:
+        _permute_rows(X, a)
+    if se is not None:
+        _permute_rows(se, a)
+    stats.finish()
 
+    if full_output:
+        if se is not None:
+            return genes, samples, X, stats, se
+        return genes, samples, X, stats
     return genes, samples, X
@@ -0,0 +1,168 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+#cython: profile=False, wraparound=False, boundscheck=False, cdivision=True
+
+"""
+In-place selection (quickselect) and related helpers, for use in nogil code.
+
+The functions in this file are inlined into the extension modules that
+cimport them.
+"""
+
+from libc.math cimport isnan
+
+cdef inline float select_float(float* a, Py_ssize_t n, Py_ssize_t k) nogil:
+    """Returns the k'th smallest value of `a` (Wirth's algorithm).
+
+    The array is partially reordered: Afterwards, no value before position k
+    is larger, and no value after position k is smaller than ``a[k]``.
+    """
+    cdef Py_ssize_t i, j, l, m
+    cdef float x, t
+    l = 0
+    m = n - 1
+    while l < m:
+        x = a[k]
+        i = l
+        j = m
+        while True:
+            while a[i] < x:
+                i += 1
+            while x < a[j]:
+                j -= 1
+            if i <= j:
+                t = a[i]
+                a[i] = a[j]
+                a[j] = t
+                i += 1
+                j -= 1
+            if i > j:
+                break
+        if j < k:
+            l = i
+        if k < i:
+            m = j
+    return a[k]
+
+
+cdef inline float median_float(float* a, Py_ssize_t n) nogil:
+    """Returns the median of `a`, reordering it in the process.
+
+    For an even number of values, the mean of the two middle values is
+    returned (calculated in single precision, as done by `np.median`). If
+    any value is NaN, NaN is returned (also as done by `np.median`).
+    """
+    cdef Py_ssize_t i, k
+    cdef float lo, hi
+    if n == 0:
+        return 0.0
+    for i in range(n):
+        if isnan(a[i]):
+            return a[i]
+    k = n // 2
+    hi = select_float(a, n, k)
+    if n % 2 == 1:
+        return hi
+    # the largest value before position k is the lower middle value
+    lo = a[0]
+    for i in range(1, k):
+        if a[i] > lo:
+            lo = a[i]
+    return (lo + hi) / 2.0
+
+
+cdef inline float pairwise_abs_sum_float(float* a, Py_ssize_t n) nogil:
+    """Returns the sum of absolute values, using pairwise summation.
+
+    This follows the summation order of NumPy's `add.reduce` for contiguous
+    single-precision data, so the result is identical to
+    ``np.sum(np.absolute(a))``.
+    """
+    cdef Py_ssize_t i, n2
+    cdef float res
+    cdef float r[8]
+    if n < 8:
+        res = 0.0
+        for i in range(n):
+            res += abs(a[i])
+        return res
+    elif n <= 128:
+        for i in range(8):
+            r[i] = abs(a[i])
+        i = 8
+        while i < n - (n % 8):
+            r[0] += abs(a[i])
+            r[1] += abs(a[i + 1])
+            r[2] += abs(a[i + 2])
+            r[3] += abs(a[i + 3])
+            r[4] += abs(a[i + 4])
+            r[5] += abs(a[i + 5])
+            r[6] += abs(a[i + 6])
+            r[7] += abs(a[i + 7])
+            i += 8
+        res = ((r[0] + r[1]) + (r[2] + r[3])) + \
+              ((r[4] + r[5]) + (r[6] + r[7]))
+        while i < n:
+            res += abs(a[i])
+            i += 1
+        return res
+    else:
+        n2 = n // 2
+        n2 -= n2 % 8
+        return pairwise_abs_sum_float(a, n2) + \
+               pairwise_abs_sum_float(a + n2, n - n2)
+
+
+cdef inline double pairwise_sum_double(double* a, Py_ssize_t n) nogil:
+    """Returns the sum of `a`, using pairwise summation.
+
+    This follows the summation order of NumPy's `add.reduce` for contiguous
+    double-precision data, so the result is identical to ``np.sum(a)``.
+    """
+    cdef Py_ssize_t i, n2
+    cdef double res
+    cdef double r[8]
+    if n < 8:
+        res = 0.0
+        for i in range(n):
+            res += a[i]
+        return res
+    elif n <= 128:
+        for i in range(8):
+            r[i] = a[i]
+        i = 8
+        while i < n - (n % 8):
+            r[0] += a[i]
+            r[1] += a[i + 1]
+            r[2] += a[i + 2]
+            r[3] += a[i + 3]
+            r[4] += a[i + 4]
+            r[5] += a[i + 5]
+            r[6] += a[i + 6]
+            r[7] += a[i + 7]
+            i += 8
+        res = ((r[0] + r[1]) + (r[2] + r[3])) + \
+              ((r[4] + r[5]) + (r[6] + r[7]))
+        while i < n:
+            res += a[i]
+            i += 1
+        return res
+    else:
+        n2 = n // 2
+        n2 -= n2 % 8
+        return pairwise_sum_double(a, n2) + \
+               pairwise_sum_double(a + n2, n - n2)
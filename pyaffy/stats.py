@@ -0,0 +1,323 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Performance statistics of RMA runs.
+
+`RMAStats` objects are returned by `pyaffy.rma` (with ``full_output=True``),
+and passed to the callback function of `pyaffy.rma` whenever a processing
+stage starts or finishes, and whenever a CEL file has been parsed.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+_oldstr = str
+from builtins import *
+
+import os
+import sys
+import time
+import logging
+import contextlib
+import collections
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # not available in Python 2
+    tracemalloc = None
+
+logger = logging.getLogger(__name__)
+
+# use the most precise clocks available
+try:
+    _wall_clock = time.perf_counter
+    _cpu_clock = time.process_time
+except AttributeError:
+    _wall_clock = time.time
+    _cpu_clock = time.clock
+
+# the CPU time of the current thread (only available in Python 3.7+)
+try:
+    _thread_cpu_clock = time.thread_time
+except AttributeError:
+    _thread_cpu_clock = _cpu_clock
+
+# statistics for parsing a CEL file (the index is the position of the file in
+# the list of CEL files, and the number of bytes is the size of the file)
+CELFileStats = collections.namedtuple('CELFileStats',
+        ['index', 'path', 'num_bytes', 'wall_time', 'cpu_time'])
+
+
+def _get_max_rss():
+    """Returns the maximum resident set size of the process so far (in bytes).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # macOS reports bytes, Linux reports kilobytes
+        return peak
+    return peak * 1024
+
+
+def _is_tracing():
+    return tracemalloc is not None and tracemalloc.is_tracing() and \
+            hasattr(tracemalloc, 'reset_peak')
+
+
+class StageStats(object):
+    """Statistics for one processing stage.
+
+    If a stage is run several times (e.g., once for each chunk of samples
+    during out-of-core processing), the times are added up, and the peak
+    memory is the maximum over all runs.
+
+    Attributes
+    ----------
+    name: str
+        The name of the stage.
+    num_runs: int
+        The number of times the stage was run.
+    wall_time: float
+        The elapsed (wall-clock) time, in seconds.
+    cpu_time: float
+        The CPU time of the process (all threads, but not including worker
+        processes), in seconds.
+    process_max_rss: int or None
+        The maximum resident set size of the process up to the end of the
+        (last run of the) stage, in bytes (None if not available). This is
+        cumulative over the lifetime of the process, i.e., it also includes
+        the memory used by previous stages, and not the peak memory of the
+        stage itself (see `peak_traced`).
+    peak_traced: int or None
+        The peak size of the memory blocks allocated during the stage, in
+        bytes, as traced by `tracemalloc`. Only available if `tracemalloc`
+        is tracing (see `tracemalloc.start`), otherwise None.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.num_runs = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.process_max_rss = None
+        self.peak_traced = None
+
+    def __repr__(self):
+        return '<%s "%s" (%.3f s wall time, %.3f s CPU time)>' \
+                %(self.__class__.__name__, self.name, self.wall_time,
+                  self.cpu_time)
+
+    def as_dict(self):
+        """Returns the statistics as a dictionary."""
+        return collections.OrderedDict([
+            ('name', self.name),
+            ('num_runs', self.num_runs),
+            ('wall_time', self.wall_time),
+            ('cpu_time', self.cpu_time),
+            ('process_max_rss', self.process_max_rss),
+            ('peak_traced', self.peak_traced),
+        ])
+
+
+class RMAStats(object):
+    """Performance statistics of an RMA run.
+
+    Parameters
+    ----------
+    num_cel_files: int, optional
+        The total number of CEL files to parse. [0]
+    callback: callable, optional
+        A function that is called as ``callback(event, stats)``, where
+        `event` is one of "stage_start", "stage_end", and "cel_file", and
+        `stats` is this object. For "stage_start", the stage is
+        `current_stage`; for "stage_end", it is `last_stage`; and for
+        "cel_file", the parsed file is the last element of `cel_files`.
+        [None]
+
+    Attributes
+    ----------
+    stages: collections.OrderedDict (str => `StageStats`)
+        The statistics of each processing stage, in the order in which
+        the stages were first run.
+    cel_files: list of `CELFileStats`
+        The statistics for each parsed CEL file, in the order in which they
+        were parsed.
+    num_probesets: int
+        The number of probesets summarized with median polish.
+    num_converged: int
+        The number of probesets for which median polish converged.
+    medpolish_iterations: np.ndarray (dtype = np.int64) or None
+        A histogram of the number of median polish iterations (the i'th
+        element is the number of probesets that required i iterations).
+    """
+    def __init__(self, num_cel_files = 0, callback = None):
+        assert isinstance(num_cel_files, int)
+        assert callback is None or callable(callback)
+
+        self.num_cel_files = num_cel_files
+        self.callback = callback
+        self.stages = collections.OrderedDict()
+        self.cel_files = []
+        self.num_probesets = 0
+        self.num_converged = 0
+        self.medpolish_iterations = None
+        self.current_stage = None
+        self.last_stage = None
+        self._t0 = _wall_clock()
+        self._t_end = None
+        self._t_cel_start = None
+
+    def __repr__(self):
+        return '<%s object (%d stages, %d CEL files, %.1f s)>' \
+                %(self.__class__.__name__, len(self.stages),
+                  len(self.cel_files), self.total_time)
+
+    def _notify(self, event):
+        if self.callback is not None:
+            self.callback(event, self)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager for measuring the performance of a stage.
+
+        Parameters
+        ----------
+        name: str
+            The name of the stage.
+        """
+        try:
+            s = self.stages[name]
+        except KeyError:
+            s = StageStats(name)
+            self.stages[name] = s
+
+        tracing = _is_tracing()
+        if tracing:
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        self.current_stage = s
+        self._notify('stage_start')
+        w0, c0 = _wall_clock(), _cpu_clock()
+        if name == 'cel' and self._t_cel_start is None:
+            self._t_cel_start = w0
+
+        try:
+            yield s
+        finally:
+            # also record the stage if it raised an exception
+            s.wall_time += _wall_clock() - w0
+            s.cpu_time += _cpu_clock() - c0
+            s.num_runs += 1
+            s.process_max_rss = _get_max_rss()
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1] - base
+                s.peak_traced = max(peak, s.peak_traced or 0)
+
+            self.current_stage = None
+            self.last_stage = s
+            self._notify('stage_end')
+
+    def add_cel_file(self, index, path, wall_time, cpu_time):
+        """Records the statistics for parsing a CEL file."""
+        self.cel_files.append(CELFileStats(index, path,
+                                           os.path.getsize(path),
+                                           wall_time, cpu_time))
+        self._notify('cel_file')
+
+    def add_medpolish_results(self, converged, num_iter):
+        """Records the convergence of median polish for a set of probesets.
+
+        Parameters
+        ----------
+        converged: np.ndarray (dtype = np.bool_)
+            Whether median polish converged for each probeset.
+        num_iter: np.ndarray (dtype = np.int32)
+            The number of iterations for each probeset.
+        """
+        self.num_probesets += converged.size
+        self.num_converged += int(np.sum(converged))
+        hist = np.bincount(num_iter, minlength = 1).astype(np.int64)
+        if self.medpolish_iterations is None:
+            self.medpolish_iterations = hist
+        else:
+            # the histograms can have different lengths
+            n = max(hist.size, self.medpolish_iterations.size)
+            total = np.zeros(n, dtype = np.int64)
+            total[:hist.size] += hist
+            total[:self.medpolish_iterations.size] += \
+                    self.medpolish_iterations
+            self.medpolish_iterations = total
+
+    def finish(self):
+        """Stops the measurement of the total time."""
+        self._t_end = _wall_clock()
+
+    @property
+    def total_time(self):
+        """The total (wall-clock) time, in seconds."""
+        t_end = self._t_end
+        if t_end is None:
+            t_end = _wall_clock()
+        return t_end - self._t0
+
+    @property
+    def cel_bytes(self):
+        """The total size of the parsed CEL files, in bytes."""
+        return sum(f.num_bytes for f in self.cel_files)
+
+    @property
+    def cel_progress(self):
+        """The fraction of CEL files that have been parsed."""
+        if self.num_cel_files == 0:
+            return 1.0
+        return len(self.cel_files) / float(self.num_cel_files)
+
+    @property
+    def cel_eta(self):
+        """The estimated time until all CEL files are parsed (in seconds).
+
+        The estimate assumes that the remaining files are parsed at the same
+        rate as the files parsed so far. It is None if no file has been
+        parsed yet.
+        """
+        n = len(self.cel_files)
+        if n == 0 or self._t_cel_start is None:
+            return None
+        elapsed = _wall_clock() - self._t_cel_start
+        return elapsed / n * (self.num_cel_files - n)
+
+    def as_dict(self):
+        """Returns the statistics as a dictionary (e.g., for JSON output)."""
+        iterations = None
+        if self.medpolish_iterations is not None:
+            iterations = self.medpolish_iterations.tolist()
+        return collections.OrderedDict([
+            ('total_time', self.total_time),
+            ('stages', [s.as_dict() for s in self.stages.values()]),
+            ('cel_files', [f._asdict() for f in self.cel_files]),
+            ('num_probesets', self.num_probesets),
+            ('num_converged', self.num_converged),
+            ('medpolish_iterations', iterations),
+        ])
@@ -52,11 +52,25 @@ except ImportError:
 else:
     ### Specify Cython modules
 
+    # OpenMP is used for multi-threading in some modules
+    # (set PYAFFY_NO_OPENMP=1 to build without it)
+    openmp_compile_args = []
+    openmp_link_args = []
+    if not os.environ.get('PYAFFY_NO_OPENMP'):
+        if sys.platform == 'win32':
+            openmp_compile_args = ['/openmp']
+        elif sys.platform != 'darwin':
+            # Apple's compiler does not support OpenMP out of the box
+            openmp_compile_args = ['-fopenmp']
+            openmp_link_args = ['-fopenmp']
+
     ext_modules.append(
         Extension(
             root + '.' + 'celparser',
             sources= [root + os.sep + 'celparser.pyx'],
             include_dirs = [np.get_include()],
+            extra_compile_args = openmp_compile_args,
+            extra_link_args = openmp_link_args,
         )
     )
 
@@ -65,6 +79,8 @@ else:
             root + '.' + 'cdfparser',
             sources= [root + os.sep + 'cdfparser.pyx'],
             include_dirs = [np.get_include()],
+            extra_compile_args = openmp_compile_args,
+            extra_link_args = openmp_link_args,
         )
     )
 
@@ -73,6 +89,38 @@ else:
             root + '.' + 'medpolish',
             sources= [root + os.sep + 'medpolish.pyx'],
             include_dirs = [np.get_include()],
+            extra_compile_args = openmp_compile_args,
+            extra_link_args = openmp_link_args,
+        )
+    )
+
+    ext_modules.append(
+        Extension(
+            root + '.' + 'plm',
+            sources= [root + os.sep + 'plm.pyx'],
+            include_dirs = [np.get_include()],
+            extra_compile_args = openmp_compile_args,
+            extra_link_args = openmp_link_args,
+        )
+    )
+
+    ext_modules.append(
+        Extension(
+            root + '.' + 'background',
+            sources= [root + os.sep + 'background.pyx'],
+            include_dirs = [np.get_include()],
+            extra_compile_args = openmp_compile_args,
+            extra_link_args = openmp_link_args,
+        )
+    )
+
+    ext_modules.append(
+        Extension(
+            root + '.' + 'normalize',
+            sources= [root + os.sep + 'normalize.pyx'],
+            include_dirs = [np.get_include()],
+            extra_compile_args = openmp_compile_args,
+            extra_link_args = openmp_link_args,
         )
     )
 
@@ -128,7 +176,7 @@ setup(
     keywords = 'affymetrix microarray rma expression normalization',
 
     #packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
-    packages = find_packages(exclude = ['docs']),
+    packages = find_packages(exclude = ['docs', 'benchmarks']),
 
 	#libraries = [],
 
@@ -150,6 +198,12 @@ setup(
             'pytest>=2.8.5, <3',
             'pytest-cov>=2.2.1, <3',
             'requests>=2.10.0, <3',
+            'h5py>=2.6',
+            'zarr>=2.2',
+        ],
+        'output': [
+            'h5py>=2.6',
+            'zarr>=2.2',
         ],
     #        'docs': ['sphinx','sphinx-rtd-theme','sphinx-argparse','mock']
     },
@@ -26,7 +26,9 @@ import os
 
 import numpy as np
 
-from pyaffy import rma
+from pyaffy import rma, FrozenRMA
+from pyaffy.celparser import parse_cel
+from pyaffy.output import NpyOutput
 
 
 def test_download(my_cdf_file, my_cel_files):
@@ -35,6 +37,16 @@ def test_download(my_cdf_file, my_cel_files):
         assert os.path.isfile(path)
 
 
+def test_parse_cel_gather(my_cel_files):
+    y = parse_cel(my_cel_files[0])
+    index = np.arange(y.size - 1, 0, -7, dtype = np.uint32)
+    # write into a (non-contiguous) column of a matrix
+    Y = np.zeros((index.size, 3), dtype = np.float32)
+    parse_cel(my_cel_files[0], index = index, out = Y[:,1])
+    assert np.array_equal(Y[:,1], y[index])
+    assert np.all(Y[:,0] == 0) and np.all(Y[:,2] == 0)
+
+
 def test_rma(my_cdf_file, my_cel_files):
     sample_cel_files = OrderedDict([
         ('Sample %d' % (i+1), path) for i, path in enumerate(my_cel_files)
@@ -44,4 +56,107 @@ def test_rma(my_cdf_file, my_cel_files):
     assert isinstance(genes, list)
     assert isinstance(samples, list)
     assert len(samples) == 2
-    assert isinstance(X, np.ndarray) and X.ndim == 2
\ No newline at end of file
+    assert isinstance(X, np.ndarray) and X.ndim == 2
+
+def test_rma_stats(my_cdf_file, my_cel_files):
+    sample_cel_files = OrderedDict([
+        ('Sample %d' % (i+1), path) for i, path in enumerate(my_cel_files)
+    ])
+    events = []
+    def callback(event, stats):
+        events.append(event)
+
+    genes, samples, X, stats = rma(my_cdf_file, sample_cel_files,
+                                   callback = callback, full_output = True)
+    assert list(stats.stages.keys()) == \
+            ['cdf', 'cel_headers', 'cel', 'background', 'normalization',
+             'summarization']
+    assert [f.index for f in stats.cel_files] == [0, 1]
+    assert events.count('cel_file') == 2
+    assert stats.num_probesets == len(genes)
+    assert stats.medpolish_iterations.sum() == len(genes)
+
+
+def test_rma_parallel(my_cdf_file, my_cel_files):
+    sample_cel_files = OrderedDict([
+        ('Sample %d' % (i+1), path) for i, path in enumerate(my_cel_files)
+    ])
+    genes, samples, X = rma(my_cdf_file, sample_cel_files)
+    genes_par, samples_par, X_par = rma(my_cdf_file, sample_cel_files,
+                                        n_jobs=2)
+
+    assert genes_par == genes
+    assert samples_par == samples
+    assert np.array_equal(X_par, X)
+
+    genes_thr, samples_thr, X_thr = rma(my_cdf_file, sample_cel_files,
+                                        n_jobs=2, use_threads=True)
+    assert genes_thr == genes
+    assert np.array_equal(X_thr, X)
+
+def test_rma_out_of_core(my_cdf_file, my_cel_files, tmpdir):
+    sample_cel_files = OrderedDict([
+        ('Sample %d' % (i+1), path) for i, path in enumerate(my_cel_files)
+    ])
+    genes, samples, X = rma(my_cdf_file, sample_cel_files)
+    # process one sample at a time
+    genes_ooc, samples_ooc, X_ooc = rma(my_cdf_file, sample_cel_files,
+                                        scratch_dir=text(tmpdir),
+                                        memory_budget=4*1024*1024)
+
+    assert genes_ooc == genes
+    assert samples_ooc == samples
+    assert np.array_equal(X_ooc, X)
+    assert not tmpdir.listdir()
+
+def test_rma_summary_method(my_cdf_file, my_cel_files, tmpdir):
+    sample_cel_files = OrderedDict([
+        ('Sample %d' % (i+1), path) for i, path in enumerate(my_cel_files)
+    ])
+    for method in ['median', 'mean', 'trimmed_mean', 'biweight']:
+        genes, samples, X = rma(my_cdf_file, sample_cel_files,
+                                medianpolish=False, summary_method=method)
+        _, _, X_ooc = rma(my_cdf_file, sample_cel_files,
+                          medianpolish=False, summary_method=method,
+                          scratch_dir=text(tmpdir),
+                          memory_budget=4*1024*1024)
+        assert X.shape == (len(genes), len(samples))
+        assert np.array_equal(X_ooc, X)
+
+
+def test_rma_output(my_cdf_file, my_cel_files, tmpdir):
+    sample_cel_files = OrderedDict([
+        ('Sample %d' % (i+1), path) for i, path in enumerate(my_cel_files)
+    ])
+    genes, samples, X = rma(my_cdf_file, sample_cel_files)
+    for scratch_dir in [None, text(tmpdir)]:
+        path = text(tmpdir.join('X.npy'))
+        output = NpyOutput(path)
+        genes_out, samples_out, result = rma(my_cdf_file, sample_cel_files,
+                                             scratch_dir=scratch_dir,
+                                             memory_budget=4*1024*1024,
+                                             output=output)
+        assert result is output
+        assert genes_out == genes
+        assert samples_out == samples
+        assert np.array_equal(np.load(path), X)
+
+
+
+def test_frozen_rma(my_cdf_file, my_cel_files, tmpdir):
+    sample_cel_files = OrderedDict([
+        ('Sample %d' % (i+1), path) for i, path in enumerate(my_cel_files)
+    ])
+    model, genes, samples, X = FrozenRMA.fit(my_cdf_file, sample_cel_files,
+                                             full_output=True)
+    path = text(tmpdir.join('model.npz'))
+    model.save(path)
+    model = FrozenRMA.load(path)
+
+    # process the samples one at a time
+    for j, (sample, cel_file) in enumerate(sample_cel_files.items()):
+        genes_frozen, _, X_frozen = model.process(
+            OrderedDict([(sample, cel_file)]))
+        assert genes_frozen == genes
+        diff = np.abs(X_frozen[:, 0] - X[:, j])
+        assert np.nanmedian(diff) < 0.01
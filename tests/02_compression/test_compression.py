@@ -0,0 +1,103 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import str as text
+
+import gzip
+import bz2
+
+import pytest
+
+from pyaffy import compression
+
+DATA = b''.join([b'line %d\r\n' % i for i in range(10000)])
+
+
+def _write(path, data, compressed):
+    if compressed == 'gzip':
+        with gzip.GzipFile(path, 'wb') as fh:
+            fh.write(data)
+    elif compressed == 'bz2':
+        with bz2.BZ2File(path, 'wb') as fh:
+            fh.write(data)
+    else:
+        with open(path, 'wb') as fh:
+            fh.write(data)
+
+
+@pytest.mark.parametrize('comp', [None, 'gzip', 'bz2'])
+def test_detect(tmpdir, comp):
+    path = text(tmpdir.join('test.dat'))
+    _write(path, DATA, comp)
+    assert compression.get_compression(path) == comp
+    with compression.open_file(path) as fh:
+        assert fh.read() == DATA
+
+
+@pytest.mark.parametrize('comp', ['gzip', 'bz2'])
+def test_read_file(tmpdir, comp):
+    path = text(tmpdir.join('test.dat'))
+    _write(path, DATA, comp)
+    assert compression.read_file(path, block_size=1000) == DATA
+
+
+def test_multiple_streams(tmpdir):
+    path = text(tmpdir.join('test.dat.gz'))
+    with open(path, 'wb') as fh:
+        fh.write(gzip.compress(DATA[:5000]))
+        fh.write(gzip.compress(DATA[5000:]))
+    assert compression.read_file(path, block_size=1000) == DATA
+
+
+@pytest.mark.parametrize('comp', ['gzip', 'bz2', 'xz'])
+def test_stream_boundaries(tmpdir, comp):
+    if comp == 'xz':
+        lzma = pytest.importorskip('lzma')
+        compress = lzma.compress
+    else:
+        compress = {'gzip': gzip.compress, 'bz2': bz2.compress}[comp]
+    first = compress(DATA[:5000])
+    second = compress(DATA[5000:])
+    path = text(tmpdir.join('test.dat'))
+
+    # the first stream ends exactly at the end of a block
+    with open(path, 'wb') as fh:
+        fh.write(first + second)
+    assert compression.read_file(path, block_size=len(first)) == DATA
+
+    # padding between the streams that spans several blocks
+    with open(path, 'wb') as fh:
+        fh.write(first + b'\x00' * 100 + second + b'\x00' * 10)
+    assert compression.read_file(path, block_size=len(first) + 20) == DATA
+    assert compression.read_file(path, block_size=7) == DATA
+
+
+@pytest.mark.parametrize('comp', ['gzip', 'bz2', 'xz'])
+def test_truncated(tmpdir, comp):
+    if comp == 'xz':
+        lzma = pytest.importorskip('lzma')
+        compress = lzma.compress
+    else:
+        compress = {'gzip': gzip.compress, 'bz2': bz2.compress}[comp]
+    data = compress(DATA[:5000]) + compress(DATA[5000:])
+    path = text(tmpdir.join('test.dat'))
+    for num_bytes in [1, 5000]:
+        with open(path, 'wb') as fh:
+            fh.write(data[:-num_bytes])
+        with pytest.raises(IOError):
+            compression.read_file(path, block_size=1000)
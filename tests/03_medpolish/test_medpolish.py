@@ -0,0 +1,197 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import numpy as np
+
+from pyaffy.medpolish import medpolish, medpolish_batch, summarize_batch
+
+
+def _get_data(num_cols, seed = 0):
+    rng = np.random.RandomState(seed)
+    sizes = rng.randint(1, 20, size = 100)
+    offsets = np.zeros(sizes.size + 1, dtype = np.int64)
+    np.cumsum(sizes, out = offsets[1:])
+    Y = rng.normal(8, 2, size = (offsets[-1], num_cols)).astype(np.float32)
+    # introduce ties
+    Y[::3] = np.round(Y[::3], 1)
+    return Y, offsets
+
+
+def _medpolish(X, eps = 0.01, maxiter = 10):
+    # reference implementation (using NumPy, in single precision)
+    X = X.copy()
+    row_eff = np.zeros(X.shape[0], dtype = np.float32)
+    col_eff = np.zeros(X.shape[1], dtype = np.float32)
+    global_eff = np.float32(0)
+    sar = np.float32(0)
+    converged = False
+    t = 0
+    while t < maxiter and not converged:
+        d = np.median(X, axis = 1)
+        X -= d[:, np.newaxis]
+        row_eff += d
+        d = np.median(col_eff)
+        col_eff -= d
+        global_eff += d
+        d = np.median(X, axis = 0)
+        X -= d
+        col_eff += d
+        d = np.median(row_eff)
+        row_eff -= d
+        global_eff += d
+        t += 1
+        new_sar = np.sum(np.absolute(X))
+        converged = bool(abs(new_sar - sar) < eps * new_sar)
+        sar = new_sar
+    return X, row_eff, col_eff, global_eff, converged, t
+
+
+def test_medpolish():
+    # compare with the reference (the previous implementation, using
+    # `np.median`) on random matrices of random shapes
+    rng = np.random.RandomState(6)
+    for _ in range(200):
+        num_rows, num_cols = rng.randint(1, 30, size = 2)
+        X = rng.normal(8, 2, size = (num_rows, num_cols)).astype(np.float32)
+        if rng.rand() < 0.5:
+            # introduce ties
+            X = np.round(X, rng.randint(0, 2))
+        R, r, c, g, conv, t = medpolish(X)
+        R_ref, r_ref, c_ref, g_ref, conv_ref, t_ref = _medpolish(X)
+        # the results are identical (not just close)
+        assert np.array_equal(R, R_ref)
+        assert np.array_equal(r, r_ref)
+        assert np.array_equal(c, c_ref)
+        assert np.float32(g) == g_ref
+        assert conv == conv_ref
+        assert t == t_ref
+
+
+def test_medpolish_copy():
+    rng = np.random.RandomState(7)
+    Y = rng.normal(8, 2, size = (12, 14)).astype(np.float32)
+    R_ref = _medpolish(Y[:, ::2])[0]
+
+    # non-contiguous input
+    X = Y.copy()
+    R = medpolish(X[:, ::2])[0]
+    assert np.array_equal(R, R_ref)
+    assert np.array_equal(X, Y)
+
+    # the residuals are written back to the input
+    R = medpolish(X[:, ::2], copy = False)[0]
+    assert np.array_equal(X[:, ::2], R)
+    assert np.array_equal(X[:, 1::2], Y[:, 1::2])
+    assert np.array_equal(R, R_ref)
+
+
+def test_batch():
+    for num_cols in [1, 2, 5, 40, 200]:
+        Y, offsets = _get_data(num_cols)
+        X, converged, num_iter, row_eff = medpolish_batch(Y, offsets,
+                num_threads = 2, full_output = True)
+        for i in range(offsets.size - 1):
+            sel = slice(offsets[i], offsets[i+1])
+            _, r, c, g, conv, t = _medpolish(Y[sel])
+            assert np.allclose(X[i], c + g, atol = 1e-5)
+            assert np.allclose(row_eff[sel], r, atol = 1e-5)
+            assert converged[i] == conv
+            assert num_iter[i] == t
+
+
+def test_batch_medpolish():
+    # the batch function and `medpolish` use the same kernel
+    Y, offsets = _get_data(5)
+    X, _, _ = medpolish_batch(Y, offsets)
+    for i in range(offsets.size - 1):
+        _, _, col_eff, global_eff, _, _ = \
+                medpolish(Y[offsets[i]:offsets[i+1]])
+        assert np.array_equal(X[i], col_eff + global_eff)
+
+
+def test_batch_threads():
+    Y, offsets = _get_data(20, seed = 1)
+    X1, _, _ = medpolish_batch(Y, offsets, num_threads = 1)
+    X4, _, _ = medpolish_batch(Y, offsets, num_threads = 4)
+    assert np.array_equal(X1, X4)
+
+
+def test_batch_threads_many():
+    # many probesets, so that all threads run at the same time
+    rng = np.random.RandomState(5)
+    sizes = rng.randint(1, 20, size = 10000)
+    offsets = np.zeros(sizes.size + 1, dtype = np.int64)
+    np.cumsum(sizes, out = offsets[1:])
+    # probesets with very different overall levels
+    levels = np.repeat(rng.uniform(0, 16, size = sizes.size), sizes)
+    Y = (levels[:, np.newaxis] + rng.normal(0, 1, size = (offsets[-1], 40)))
+    Y = Y.astype(np.float32)
+    X1, _, _ = medpolish_batch(Y, offsets, num_threads = 1)
+    for _ in range(5):
+        X8, _, _ = medpolish_batch(Y, offsets, num_threads = 8)
+        assert np.array_equal(X1, X8)
+
+
+def test_batch_missing():
+    Y, offsets = _get_data(6, seed = 2)
+    Y[offsets[3] + 1, 2] = np.nan
+    X, converged, _ = medpolish_batch(Y, offsets)
+    assert np.all(np.isnan(X[3]))
+    assert not converged[3]
+    assert not np.any(np.isnan(np.delete(X, 3, axis = 0)))
+
+
+def _biweight(x, c = 5.0, eps = 1e-4):
+    # tukey.biweight of the R package affy
+    m = np.median(x)
+    s = np.median(np.absolute(x - m))
+    u = (x - m) / (c * s + eps)
+    w = np.where(np.absolute(u) <= 1, (1 - u**2)**2, 0)
+    return np.sum(w * x) / np.sum(w)
+
+
+def _trimmed_mean(x, trim):
+    cut = int(trim * x.size)
+    return np.mean(np.sort(x)[cut:(x.size - cut)])
+
+
+def test_summarize():
+    Y, offsets = _get_data(5, seed = 3)
+    funcs = {
+        'median': np.median,
+        'mean': np.mean,
+        'trimmed_mean': lambda x: _trimmed_mean(x, 0.2),
+        'biweight': _biweight,
+    }
+    for method, func in funcs.items():
+        X = summarize_batch(Y, offsets, method = method, trim = 0.2,
+                            num_threads = 2)
+        for i in range(offsets.size - 1):
+            for j in range(Y.shape[1]):
+                y = Y[offsets[i]:offsets[i+1], j].astype(np.float64)
+                assert np.isclose(X[i, j], func(y), rtol = 1e-5, atol = 1e-5)
+
+
+def test_summarize_missing():
+    Y, offsets = _get_data(4, seed = 4)
+    Y[offsets[2], 1] = np.nan
+    for method in ['median', 'mean', 'trimmed_mean', 'biweight']:
+        X = summarize_batch(Y, offsets, method = method)
+        assert np.isnan(X[2, 1])
+        assert np.sum(np.isnan(X)) == 1
@@ -0,0 +1,96 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+from math import floor
+
+import numpy as np
+from scipy.stats import norm
+import pytest
+
+from pyaffy.background import rma_bg_correct
+
+
+def _bg_correct_reference(y):
+    """The (NumPy-based) reference implementation for a single sample."""
+    num_bins = 100
+    lower = np.amin(y)
+    upper = np.percentile(y, 75.0)
+    bin_width = max(floor((upper - lower) / num_bins), 1.0)
+    bin_edges = np.arange(lower, upper, bin_width)
+    num_bins = bin_edges.size - 1
+    binned = np.digitize(y, bins = bin_edges) - 1
+    binned = binned[binned < num_bins]
+    amax = np.argmax(np.bincount(binned))
+    mu = lower + (amax + 0.5) * bin_width
+
+    y_low = y[y < mu]
+    sigma = pow(np.sum(np.power(y_low - mu, 2.0)) / (y_low.size - 1), 0.5)
+    sigma *= pow(2.0, 0.5)
+
+    a = y - mu - 0.03 * pow(sigma, 2.0)
+    y_adj = a + sigma * np.exp(norm.logpdf(a / sigma) - norm.logcdf(a / sigma))
+    return y_adj, mu, sigma
+
+
+@pytest.fixture
+def intensities():
+    rng = np.random.RandomState(0)
+    Y = rng.normal(100, 20, size = (5000, 6)) + \
+            rng.exponential(500, size = (5000, 6))
+    Y = np.maximum(Y, 1.0).astype(np.float32)
+    Y[:,::2] = np.round(Y[:,::2])
+    Y[rng.rand(*Y.shape) < 0.01] = np.nan
+    return Y
+
+
+def test_bg_correct(intensities):
+    Y = intensities
+    Y_adj, mu, sigma = rma_bg_correct(Y, make_copy = True, num_threads = 2,
+                                      full_output = True)
+    assert Y_adj.dtype == np.float32
+    assert np.array_equal(np.isnan(Y_adj), np.isnan(Y))
+    for j in range(Y.shape[1]):
+        missing = np.isnan(Y[:,j])
+        y_ref, mu_ref, sigma_ref = _bg_correct_reference(Y[~missing,j])
+        assert mu[j] == mu_ref
+        assert sigma[j] == pytest.approx(sigma_ref, rel = 1e-14)
+        assert np.allclose(Y_adj[~missing,j], y_ref, rtol = 1e-6, atol = 0)
+
+
+def test_bg_correct_one_decimal():
+    # intensities with one decimal (as in CEL files), for which the bin edges
+    # of the histogram (see `np.arange`) differ from lower + k*bin_width
+    rng = np.random.RandomState(0)
+    Y = rng.normal(100, 20, size = (2000, 40)) + \
+            rng.exponential(500, size = (2000, 40))
+    Y = np.round(np.maximum(Y, 1.0), 1).astype(np.float32)
+    Y_adj, mu, sigma = rma_bg_correct(Y, make_copy = True, num_threads = 2,
+                                      full_output = True)
+    for j in range(Y.shape[1]):
+        y_ref, mu_ref, sigma_ref = _bg_correct_reference(Y[:,j])
+        assert mu[j] == mu_ref
+        assert sigma[j] == pytest.approx(sigma_ref, rel = 1e-14)
+        assert np.allclose(Y_adj[:,j], y_ref, rtol = 1e-6, atol = 0)
+
+
+def test_bg_correct_inplace(intensities):
+    Y = intensities
+    Y_adj = rma_bg_correct(Y.copy(), num_threads = 1)
+    rma_bg_correct(Y, num_threads = 3)
+    assert np.array_equal(Y, Y_adj, equal_nan = True)
@@ -0,0 +1,68 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import numpy as np
+import pytest
+
+from pyaffy.normalize import quantile_normalize
+
+
+def _qnorm_reference(X):
+    """The (NumPy-based) reference implementation."""
+    A = np.argsort(X, axis = 0, kind = 'mergesort')
+    S = np.take_along_axis(X, A, axis = 0)
+    target = np.zeros(X.shape[0], dtype = np.float64)
+    for j in range(X.shape[1]):
+        target += S[:,j]
+    target = (target / X.shape[1]).astype(np.float32)
+    ranks = np.argsort(A, axis = 0, kind = 'mergesort')
+    return target[ranks], target
+
+
+@pytest.fixture
+def intensities():
+    rng = np.random.RandomState(0)
+    Y = rng.lognormal(5, 2, size = (3000, 7)).astype(np.float32)
+    # introduce ties
+    Y[::4] = np.round(Y[::4])
+    return Y
+
+
+def test_qnorm(intensities):
+    Y = intensities
+    Y_ref, target_ref = _qnorm_reference(Y)
+    for num_threads in [1, 3]:
+        Y_norm, target = quantile_normalize(Y, make_copy = True,
+                num_threads = num_threads, full_output = True)
+        assert np.array_equal(Y_norm, Y_ref)
+        assert np.array_equal(target, target_ref)
+
+
+def test_qnorm_log2(intensities):
+    Y = intensities
+    Y_ref, _ = _qnorm_reference(Y)
+    quantile_normalize(Y, log2 = True)
+    assert np.array_equal(Y, np.log2(Y_ref))
+
+
+def test_qnorm_missing(intensities):
+    Y = intensities
+    Y[[3, 50, 900], 2] = np.nan
+    Y_norm = quantile_normalize(Y, make_copy = True)
+    assert np.array_equal(np.isnan(Y_norm), np.isnan(Y))
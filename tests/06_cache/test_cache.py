@@ -0,0 +1,134 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import str as text
+
+import os
+import time
+
+import numpy as np
+import pytest
+
+from benchmarks.generators import write_cdf
+from pyaffy import cache
+from pyaffy.cdfparser import parse_cdf
+
+
+@pytest.fixture
+def cel_cache(tmpdir):
+    size = cache._cel_cache_size
+    cache.set_cache_dir(text(tmpdir.join('cache')))
+    yield
+    cache._cel_cache_size = size
+    cache.set_cache_dir(None)
+
+
+def test_store_load(cel_cache):
+    cache.enable_cel_cache(max_size = 10000)
+    y = np.arange(1000, dtype = np.float32)
+    assert cache.load_cel('abc') is None
+    assert cache.store_cel('abc', y)
+    y2 = cache.load_cel('abc')
+    assert y2.dtype == np.float32
+    assert np.array_equal(y, y2)
+
+
+def test_eviction(cel_cache):
+    # each entry requires about 4 KB, so only two fit into the cache
+    cache.enable_cel_cache(max_size = 10000)
+    y = np.zeros(1000, dtype = np.float32)
+    for h in ['a', 'b']:
+        cache.store_cel(h, y)
+        time.sleep(0.05)
+    # using an entry protects it from eviction
+    assert cache.load_cel('a') is not None
+    time.sleep(0.05)
+    cache.store_cel('c', y)
+    assert cache.load_cel('a') is not None
+    assert cache.load_cel('b') is None
+    assert cache.load_cel('c') is not None
+
+    # data larger than the cache is not stored
+    assert not cache.store_cel('d', np.zeros(5000, dtype = np.float32))
+
+
+def test_disabled(cel_cache):
+    cache.disable_cel_cache()
+    assert cache.get_cel_cache_size() is None
+    assert not cache.store_cel('abc', np.zeros(10, dtype = np.float32))
+
+
+def _cdf_entries():
+    cdf_dir = os.path.join(cache.get_cache_dir(), 'cdf')
+    return sorted(n for n in os.listdir(cdf_dir) if not n.startswith('.'))
+
+
+def test_cdf_round_trip(tmpdir):
+    path = text(tmpdir.join('test.cdf'))
+    write_cdf(path, 20, 20)
+    expected = parse_cdf(path, use_cache = False)
+
+    # the first call stores the parsed data, and the second loads it
+    for i in range(2):
+        result = parse_cdf(path)
+        assert result[:3] == expected[:3]
+        probesets = result[3]
+        for attr in ['names', 'offsets', 'indices']:
+            a, b = getattr(probesets, attr), getattr(expected[3], attr)
+            assert a.dtype == b.dtype
+            assert np.array_equal(a, b)
+        assert len(_cdf_entries()) == 1
+
+    # the cached probe indices are memory-mapped (read-only)
+    assert isinstance(probesets.indices.base, np.memmap)
+    assert not probesets.indices.flags.writeable
+
+    # the entries of different probe types are separate
+    _, _, _, mm = parse_cdf(path, probe_type = 'mm')
+    assert len(_cdf_entries()) == 2
+    assert not np.array_equal(mm.indices, probesets.indices)
+    _, _, _, mm_cached = parse_cdf(path, probe_type = 'mm')
+    assert np.array_equal(mm_cached.indices, mm.indices)
+
+
+def test_cdf_invalidation(tmpdir, monkeypatch):
+    path = text(tmpdir.join('test.cdf'))
+    write_cdf(path, 20, 20)
+
+    # store different data in the cache, to check whether it is used
+    file_hash = cache.hash_file(path)
+    names, offsets, indices = ['1_at'], [0, 1], [0]
+    assert cache.store_cdf(file_hash, 'pm', 'CACHED', 20, 20, names,
+                           offsets, indices) is True
+    name, _, _, probesets = parse_cdf(path)
+    assert name == 'CACHED' and list(probesets.keys()) == ['1_at']
+
+    # a new version of the cache format invalidates all entries
+    monkeypatch.setattr(cache, 'CDF_CACHE_VERSION',
+                        cache.CDF_CACHE_VERSION + 1)
+    name, _, _, probesets = parse_cdf(path)
+    assert name == 'SYNTHETIC' and len(probesets) > 1
+    monkeypatch.undo()
+    assert parse_cdf(path)[0] == 'CACHED'
+
+    # modifying the file invalidates its entry
+    write_cdf(path, 20, 20, seed = 1)
+    name, _, _, probesets = parse_cdf(path)
+    assert name == 'SYNTHETIC'
+    expected = parse_cdf(path, use_cache = False)[3]
+    assert np.array_equal(probesets.indices, expected.indices)
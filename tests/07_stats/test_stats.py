@@ -0,0 +1,98 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import json
+
+import numpy as np
+import pytest
+
+from pyaffy.stats import RMAStats
+
+
+def test_stages():
+    events = []
+    def callback(event, stats):
+        events.append(event)
+
+    stats = RMAStats(callback = callback)
+    for i in range(3):
+        with stats.stage('test'):
+            np.ones(1000)
+    with stats.stage('other'):
+        pass
+    stats.finish()
+
+    assert list(stats.stages.keys()) == ['test', 'other']
+    s = stats.stages['test']
+    assert s.num_runs == 3
+    assert s.wall_time >= 0 and s.cpu_time >= 0
+    assert stats.last_stage.name == 'other'
+    assert events == ['stage_start', 'stage_end'] * 4
+    json.dumps(stats.as_dict())
+
+
+def test_stage_error():
+    events = []
+    def callback(event, stats):
+        events.append(event)
+
+    stats = RMAStats(callback = callback)
+    with pytest.raises(ValueError):
+        with stats.stage('test'):
+            raise ValueError()
+
+    s = stats.stages['test']
+    assert s.num_runs == 1
+    assert s.wall_time >= 0 and s.cpu_time >= 0
+    assert stats.current_stage is None
+    assert stats.last_stage is s
+    assert events == ['stage_start', 'stage_end']
+
+
+def test_cel_files(tmpdir):
+    path = str(tmpdir.join('test.CEL'))
+    with open(path, 'wb') as fh:
+        fh.write(b'x' * 100)
+
+    progress = []
+    def callback(event, stats):
+        if event == 'cel_file':
+            progress.append(stats.cel_progress)
+
+    stats = RMAStats(num_cel_files = 4, callback = callback)
+    assert stats.cel_eta is None
+    with stats.stage('cel'):
+        for j in range(2):
+            stats.add_cel_file(j, path, 0.1, 0.1)
+    assert progress == [0.25, 0.5]
+    assert stats.cel_bytes == 200
+    assert stats.cel_eta >= 0
+
+
+def test_medpolish_results():
+    stats = RMAStats()
+    stats.add_medpolish_results(np.array([True, True, False]),
+                                np.array([2, 3, 10], dtype = np.int32))
+    stats.add_medpolish_results(np.array([True]),
+                                np.array([2], dtype = np.int32))
+    assert stats.num_probesets == 4
+    assert stats.num_converged == 3
+    hist = stats.medpolish_iterations
+    assert hist.size == 11
+    assert hist[2] == 2 and hist[3] == 1 and hist[10] == 1
@@ -0,0 +1,381 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import str as text
+
+import gzip
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pytest
+
+from benchmarks.generators import (cel_v3, cel_v4, cel_cc, cdf_gc3,
+                                   generate_intensities, write_cel)
+from pyaffy.celparser import (parse_cel, parse_celfile_v3, parse_celfile_v4,
+                              parse_celfile_cc, read_cel_header,
+                              read_cel_headers, _gather_cells)
+from pyaffy.cdfparser import parse_cdf
+
+
+def _cel_v3(y, newline = '\n'):
+    """Returns a Version 3 CEL file with a single row of cells."""
+    return cel_v3(1, y.size, y, newline = newline)
+
+
+@pytest.mark.parametrize('newline', ['\r\n', '\n'])
+def test_cel_v3(tmpdir, newline):
+    rng = np.random.RandomState(0)
+    y = np.round(rng.lognormal(6, 1.5, 200000), 1).astype(np.float32)
+    data = _cel_v3(y, newline)
+    # the values that `strtof` would return
+    y = np.array(['%.1f' % v for v in y.tolist()], dtype = np.float32)
+
+    path = text(tmpdir.join('test.CEL'))
+    with open(path, 'wb') as fh:
+        fh.write(data)
+    for num_threads in [1, 3]:
+        y2 = parse_celfile_v3(path, compressed = False,
+                              num_threads = num_threads)
+        assert np.array_equal(y, y2)
+
+    with gzip.open(path + '.gz', 'wb') as fh:
+        fh.write(data)
+    assert np.array_equal(y, parse_cel(path + '.gz', use_cache = False))
+
+
+def test_cel_v3_truncated(tmpdir):
+    data = _cel_v3(np.arange(100, dtype = np.float32), '\n')
+    path = text(tmpdir.join('test.CEL'))
+    with open(path, 'wb') as fh:
+        fh.write(data[:(len(data) // 2)])
+    with pytest.raises(IOError):
+        parse_celfile_v3(path, compressed = False)
+
+
+def test_cel_v3_newline_chars(tmpdir):
+    y = np.arange(100, dtype = np.float32)
+    path = text(tmpdir.join('test.CEL'))
+    with open(path, 'wb') as fh:
+        fh.write(_cel_v3(y, '\n'))
+    with pytest.warns(DeprecationWarning):
+        y2 = parse_celfile_v3(path, compressed = False, newline_chars = 2)
+    assert np.array_equal(y, y2)
+
+
+def test_cel_threads(tmpdir):
+    # the parsers can be used from several threads at the same time
+    paths = []
+    for i in range(4):
+        path = text(tmpdir.join('test_%d.CEL' % i))
+        with open(path, 'wb') as fh:
+            fh.write(_cel_v3(np.arange(i, 1000 + i, dtype = np.float32), '\n'))
+        paths.append(path)
+    pool = ThreadPool(4)
+    try:
+        results = pool.map(lambda p: parse_cel(p, use_cache = False),
+                           paths * 5)
+    finally:
+        pool.close()
+        pool.join()
+    for k, y in enumerate(results):
+        i = k % 4
+        assert np.array_equal(y, np.arange(i, 1000 + i, dtype = np.float32))
+
+
+def test_cel_header(tmpdir):
+    data = _cel_v3(np.arange(100, dtype = np.float32), '\r\n')
+    path = text(tmpdir.join('test.CEL'))
+    with open(path, 'wb') as fh:
+        fh.write(data)
+    with gzip.open(path + '.gz', 'wb') as fh:
+        fh.write(data)
+
+    header = read_cel_header(path)
+    assert header.format == 'v3' and header.compression is None
+    assert (header.num_rows, header.num_cols) == (1, 100)
+    assert header.chip_type == 'SYNTHETIC'
+    assert header.algorithm == 'Percentile'
+    assert list(header.algorithm_params.items()) == \
+            [('Percentile', '75'), ('CellMargin', '2'),
+             ('OutlierHigh', '1.500'), ('OutlierLow', '1.004')]
+    assert header.scan_date == '01/01/16 00:00:00'
+    assert header.num_masked_cells == 0
+
+    # the number of masked cells is not read from compressed files
+    headers = read_cel_headers([path + '.gz', path], num_threads = 2)
+    assert [h.path for h in headers] == [path + '.gz', path]
+    assert headers[0].compression == 'gzip'
+    assert headers[0].num_masked_cells is None
+    assert headers[0].chip_type == 'SYNTHETIC'
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_cel_empty(tmpdir, compressed):
+    path = text(tmpdir.join('test.CEL'))
+    if compressed:
+        with gzip.open(path, 'wb') as fh:
+            fh.write(b'')
+    else:
+        open(path, 'wb').close()
+    with pytest.raises(ValueError):
+        parse_cel(path, use_cache = False)
+    with pytest.raises(ValueError):
+        read_cel_header(path)
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_cel_v4(tmpdir, compressed):
+    y = generate_intensities(20, 20)
+    path = text(tmpdir.join('test.CEL'))
+    if compressed:
+        path += '.gz'
+    write_cel(path, 'v4', 20, 20, y, compressed = compressed)
+    assert np.array_equal(parse_cel(path, use_cache = False), y)
+
+    y2, stdev, pixels = parse_celfile_v4(path, compressed = compressed,
+                                         full_output = True)
+    assert y2.dtype == np.float32 and stdev.dtype == np.float32
+    assert pixels.dtype == np.int16
+    assert np.array_equal(y2, y)
+    assert np.array_equal(stdev, np.asarray(y / 10.0, dtype = np.float32))
+    assert np.all(pixels == 16)
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_cel_v4_truncated(tmpdir, compressed):
+    data = cel_v4(20, 20, generate_intensities(20, 20))
+    path = text(tmpdir.join('test.CEL'))
+    if compressed:
+        with gzip.open(path, 'wb') as fh:
+            fh.write(data[:-100])
+    else:
+        with open(path, 'wb') as fh:
+            fh.write(data[:-100])
+    with pytest.raises(IOError):
+        parse_cel(path, use_cache = False)
+
+
+def test_cel_v4_mmap(tmpdir):
+    y = generate_intensities(20, 20)
+    path = text(tmpdir.join('test.CEL'))
+    write_cel(path, 'v4', 20, 20, y)
+
+    # a read-only view on the cell records
+    y_mmap = parse_cel(path, mmap = True, use_cache = False)
+    assert np.array_equal(y_mmap, y)
+    assert not y_mmap.flags.writeable and y_mmap.strides == (10,)
+
+    full = parse_celfile_v4(path, compressed = False, full_output = True)
+    full_mmap = parse_celfile_v4(path, compressed = False, mmap = True,
+                                 full_output = True)
+    for a, a_mmap in zip(full, full_mmap):
+        assert a_mmap.dtype == a.dtype
+        assert np.array_equal(a_mmap, a)
+
+    # selected cells are copied from the mapped records
+    index = np.arange(y.size - 1, 0, -3)
+    Y = np.zeros((index.size, 3), dtype = np.float32)
+    parse_cel(path, mmap = True, use_cache = False, index = index,
+              out = Y[:,1])
+    assert np.array_equal(Y[:,1], y[index])
+    assert np.all(Y[:,0] == 0) and np.all(Y[:,2] == 0)
+
+
+def test_cel_v4_mmap_compressed(tmpdir):
+    # compressed files cannot be memory-mapped
+    y = generate_intensities(20, 20)
+    path = text(tmpdir.join('test.CEL.gz'))
+    write_cel(path, 'v4', 20, 20, y, compressed = True)
+    assert np.array_equal(parse_cel(path, mmap = True, use_cache = False), y)
+    with pytest.raises(ValueError):
+        parse_celfile_v4(path, compressed = True, mmap = True)
+
+
+@pytest.mark.parametrize('byte_order', ['<', '>'])
+@pytest.mark.parametrize('index_dtype', [None, np.uint32, np.int32,
+                                         np.int64, np.int16])
+def test_gather_cells(byte_order, index_dtype):
+    # unaligned, strided floats (as in the cell records of CEL files)
+    rng = np.random.RandomState(0)
+    records = np.zeros(1000, dtype = [('pixels', '<i2'),
+                                      ('intensity', byte_order + 'f4')])
+    records['intensity'] = rng.lognormal(6, 1.5, 1000)
+    y = records['intensity']
+    expected = y.astype(np.float32)
+    index = None
+    if index_dtype is not None:
+        index = rng.randint(0, y.size, 300).astype(index_dtype)
+        expected = expected[index]
+
+    result = _gather_cells(y, index, None)
+    assert result.dtype == np.float32
+    assert np.array_equal(result, expected)
+
+    # write into a (non-contiguous) column of a matrix
+    Y = np.zeros((expected.size, 2), dtype = np.float32)
+    out = Y[:,1]
+    assert _gather_cells(y, index, out) is out
+    assert np.array_equal(Y[:,1], expected)
+    assert np.all(Y[:,0] == 0)
+
+
+def test_gather_cells_errors():
+    y = np.arange(10, dtype = np.float32)
+    with pytest.raises(IndexError):
+        _gather_cells(y, np.array([0, 10]), None)
+    with pytest.raises(IndexError):
+        _gather_cells(y, np.array([-1]), None)
+    with pytest.raises(ValueError):
+        _gather_cells(y, np.array([0, 1]), np.zeros(3, dtype = np.float32))
+    with pytest.raises(ValueError):
+        _gather_cells(y, None, np.zeros(10, dtype = np.float64))
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+@pytest.mark.parametrize('padding', [0, 7])
+def test_cel_cc(tmpdir, compressed, padding):
+    y = generate_intensities(20, 20)
+    path_v4 = text(tmpdir.join('test_v4.CEL'))
+    write_cel(path_v4, 'v4', 20, 20, y)
+    y_v4 = parse_cel(path_v4, use_cache = False)
+
+    # the data sets are found using the positions stored in the file (the
+    # padding after each data set is skipped)
+    data = cel_cc(20, 20, y, padding = padding)
+    path = text(tmpdir.join('test_cc.CEL'))
+    if compressed:
+        with gzip.open(path, 'wb') as fh:
+            fh.write(data)
+    else:
+        with open(path, 'wb') as fh:
+            fh.write(data)
+    y_cc = parse_cel(path, use_cache = False)
+    assert y_cc.dtype == np.float32 and y_cc.dtype.isnative
+    assert np.array_equal(y_cc, y_v4)
+
+    index = np.arange(y.size - 1, 0, -3, dtype = np.uint32)
+    Y = np.zeros((index.size, 2), dtype = np.float32)
+    parse_cel(path, use_cache = False, index = index, out = Y[:,1])
+    assert np.array_equal(Y[:,1], y_v4[index])
+
+
+# the (x, y) coordinates of masked and outlier cells
+MASKED = [(1, 2), (19, 0), (0, 19)]
+OUTLIERS = [(5, 6), (1, 2)]
+
+
+def _set_nan(y, num_cols, cells):
+    y = y.copy()
+    for x, r in cells:
+        y[r * num_cols + x] = np.nan
+    return y
+
+
+@pytest.mark.parametrize('fmt', ['v4', 'cc'])
+@pytest.mark.parametrize('compressed', [False, True])
+def test_cel_masks(tmpdir, fmt, compressed):
+    y = generate_intensities(20, 20)
+    path = text(tmpdir.join('test.CEL'))
+    write_cel(path, fmt, 20, 20, y, compressed = compressed,
+              masked = MASKED, outliers = OUTLIERS)
+    path_v4 = text(tmpdir.join('test_v4.CEL'))
+    write_cel(path_v4, 'v4', 20, 20, y, masked = MASKED, outliers = OUTLIERS)
+
+    header = read_cel_header(path)
+    if not (compressed and fmt == 'cc'):
+        assert header.num_masked_cells == len(MASKED)
+        assert header.num_outlier_cells == len(OUTLIERS)
+
+    parse = parse_celfile_v4 if fmt == 'v4' else parse_celfile_cc
+    # masked and outlier cells are ignored by default
+    assert np.array_equal(parse_cel(path, use_cache = False), y)
+    for ignore_masked, ignore_outliers, cells in [
+            (False, True, MASKED), (True, False, OUTLIERS),
+            (False, False, MASKED + OUTLIERS)]:
+        expected = _set_nan(y, 20, cells)
+        y_v4 = parse_celfile_v4(path_v4, compressed = False,
+                                ignore_masked = ignore_masked,
+                                ignore_outliers = ignore_outliers)
+        assert np.array_equal(y_v4, expected, equal_nan = True)
+        result = parse(path, compressed = compressed,
+                       ignore_masked = ignore_masked,
+                       ignore_outliers = ignore_outliers)
+        assert np.array_equal(result, y_v4, equal_nan = True)
+
+
+def test_cel_masks_mmap(tmpdir):
+    # setting cells to NaN does not modify the memory-mapped file
+    y = generate_intensities(20, 20)
+    path = text(tmpdir.join('test.CEL'))
+    write_cel(path, 'v4', 20, 20, y, masked = MASKED, outliers = OUTLIERS)
+    result = parse_celfile_v4(path, compressed = False, mmap = True,
+                              ignore_masked = False, ignore_outliers = False)
+    assert np.array_equal(result, _set_nan(y, 20, MASKED + OUTLIERS),
+                          equal_nan = True)
+    assert np.array_equal(parse_cel(path, mmap = True, use_cache = False), y)
+
+
+@pytest.mark.parametrize('newline', ['\r\n', '\n'])
+def test_cdf(tmpdir, newline):
+    data, expected = cdf_gc3(10, 10, num_probesets = 3, num_probes = 2,
+                             newline = newline)
+    path = text(tmpdir.join('test.cdf'))
+    with open(path, 'wb') as fh:
+        fh.write(data)
+    name, num_rows, num_cols, probesets = parse_cdf(path, use_cache = False)
+    assert name == 'SYNTHETIC'
+    assert num_rows == 10 and num_cols == 10
+    assert list(probesets.keys()) == [n for n, _ in expected]
+    for n, indices in expected:
+        assert probesets[n].tolist() == indices
+
+
+@pytest.mark.parametrize('num_threads', [1, 3])
+def test_cdf_compressed(tmpdir, num_threads):
+    data, expected = cdf_gc3(10, 10, num_probesets = 3, num_probes = 2,
+                             probe_type = 'mm')
+    path = text(tmpdir.join('test.cdf.gz'))
+    with gzip.open(path, 'wb') as fh:
+        fh.write(data)
+    _, _, _, probesets = parse_cdf(path, probe_type = 'mm', use_cache = False,
+                                   num_threads = num_threads)
+    for n, indices in expected:
+        assert probesets[n].tolist() == indices
+
+
+def test_cdf_truncated(tmpdir):
+    data, _ = cdf_gc3(10, 10, num_probesets = 3, num_probes = 2,
+                      newline = '\n')
+    path = text(tmpdir.join('test.cdf'))
+    with open(path, 'wb') as fh:
+        fh.write(data[:data.index(b'Cell3=')])
+    with pytest.raises(ValueError):
+        parse_cdf(path, use_cache = False)
+
+
+def test_cdf_newline_chars(tmpdir):
+    data, expected = cdf_gc3(10, 10, num_probesets = 3, num_probes = 2,
+                             newline = '\n')
+    path = text(tmpdir.join('test.cdf'))
+    with open(path, 'wb') as fh:
+        fh.write(data)
+    with pytest.warns(DeprecationWarning):
+        _, _, _, probesets = parse_cdf(path, newline_chars = 2,
+                                       use_cache = False)
+    for n, indices in expected:
+        assert probesets[n].tolist() == indices
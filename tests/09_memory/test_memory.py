@@ -0,0 +1,100 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Peak memory regression tests for `pyaffy.rma`.
+
+The peak size of the memory allocated during RMA (measured using
+`tracemalloc`) should not exceed a small multiple of the size of the probe
+matrix (four bytes per probe and sample).
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import str as text
+
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from benchmarks.generators import generate_intensities, write_cel, write_cdf
+from pyaffy import rma
+from pyaffy.output import NpyOutput
+
+tracemalloc = pytest.importorskip('tracemalloc')
+
+NUM_ROWS = 200
+NUM_PROBESETS = 1000
+NUM_PROBES = 11
+NUM_SAMPLES = 60
+
+
+@pytest.fixture(scope = 'module')
+def workload(tmpdir_factory):
+    tmpdir = tmpdir_factory.mktemp('memory')
+    cdf_file = text(tmpdir.join('test.cdf'))
+    write_cdf(cdf_file, NUM_ROWS, NUM_ROWS, num_probesets = NUM_PROBESETS,
+              num_probes = NUM_PROBES)
+    sample_cel_files = OrderedDict()
+    for j in range(NUM_SAMPLES):
+        path = text(tmpdir.join('sample_%d.CEL' % j))
+        y = generate_intensities(NUM_ROWS, NUM_ROWS, sample = j)
+        write_cel(path, 'v4', NUM_ROWS, NUM_ROWS, y)
+        sample_cel_files['Sample %d' % (j + 1)] = path
+    return cdf_file, sample_cel_files
+
+
+def _peak_memory(func, *args, **kwargs):
+    """Returns the peak size of the memory allocated by a function call."""
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def test_rma_memory(workload):
+    cdf_file, sample_cel_files = workload
+    y_size = 4 * NUM_PROBESETS * NUM_PROBES * NUM_SAMPLES
+    peak = _peak_memory(rma, cdf_file, sample_cel_files,
+                        use_cdf_cache = False)
+    assert peak < 1.5 * y_size
+
+
+def test_rma_out_of_core_memory(workload, tmpdir):
+    cdf_file, sample_cel_files = workload
+    y_size = 4 * NUM_PROBESETS * NUM_PROBES * NUM_SAMPLES
+    # process a quarter of the samples at a time
+    peak = _peak_memory(rma, cdf_file, sample_cel_files,
+                        use_cdf_cache = False, scratch_dir = text(tmpdir),
+                        memory_budget = y_size // 4)
+    assert peak < 0.75 * y_size
+
+
+def test_rma_output_memory(workload, tmpdir):
+    cdf_file, sample_cel_files = workload
+    y_size = 4 * NUM_PROBESETS * NUM_PROBES * NUM_SAMPLES
+    _, _, X = rma(cdf_file, sample_cel_files)
+    # the expression matrix is written block by block
+    path = text(tmpdir.join('X.npy'))
+    peak = _peak_memory(rma, cdf_file, sample_cel_files,
+                        use_cdf_cache = False, scratch_dir = text(tmpdir),
+                        memory_budget = y_size // 4,
+                        output = NpyOutput(path))
+    assert peak < 0.75 * y_size
+    assert np.array_equal(np.load(path), X)
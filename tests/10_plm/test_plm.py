@@ -0,0 +1,121 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import numpy as np
+
+from pyaffy.plm import plm_batch
+
+
+def _get_data(num_cols, seed = 0):
+    rng = np.random.RandomState(seed)
+    sizes = rng.randint(1, 16, size = 50)
+    offsets = np.zeros(sizes.size + 1, dtype = np.int64)
+    np.cumsum(sizes, out = offsets[1:])
+    Y = rng.normal(8, 1, size = (offsets[-1], 1)) + \
+            rng.normal(0, 1, size = (1, num_cols)) + \
+            0.3 * rng.standard_t(2, size = (offsets[-1], num_cols))
+    return Y.astype(np.float32), offsets
+
+
+def _fit(Y, k = 1.345, maxiter = 20, eps = 1e-4):
+    # reference implementation, using the full design matrix
+    K, N = Y.shape
+    X = np.zeros((K * N, N + K - 1))
+    for p in range(K):
+        X[(p*N):((p+1)*N), :N] = np.eye(N)
+        if p < K - 1:
+            X[(p*N):((p+1)*N), N + p] = 1
+        else:
+            X[(p*N):((p+1)*N), N:] = -1
+    y = Y.astype(np.float64).ravel()
+
+    def wls(w):
+        sw = np.sqrt(w)
+        return np.linalg.lstsq(X * sw[:, np.newaxis], y * sw, rcond = -1)[0]
+
+    w = np.ones(y.size)
+    b = wls(w)
+    r = y - np.dot(X, b)
+    for _ in range(maxiter):
+        scale = np.median(np.absolute(r)) / 0.6745
+        if scale < 1e-10:
+            break
+        u = np.absolute(r / scale)
+        w = np.where(u <= k, 1.0, k / u)
+        b = wls(w)
+        r_new = y - np.dot(X, b)
+        delta = np.sqrt(np.sum((r_new - r)**2) / max(np.sum(r**2), 1e-20))
+        r = r_new
+        if delta < eps:
+            break
+    df = K * N - (N + K - 1)
+    cov = np.linalg.inv(np.dot(X.T, X * w[:, np.newaxis])) * \
+            np.sum(w * r**2) / df
+    probe_eff = np.r_[b[N:], -np.sum(b[N:])]
+    return b[:N], np.sqrt(np.diag(cov))[:N], probe_eff, w.reshape(K, N)
+
+
+def test_plm():
+    Y, offsets = _get_data(7)
+    X, se, row_eff, weights, converged, _ = plm_batch(Y, offsets,
+            num_threads = 2, full_output = True)
+    assert np.all(converged)
+    for i in range(offsets.size - 1):
+        if offsets[i+1] - offsets[i] == 1:
+            assert np.all(np.isnan(se[i]))
+            continue
+        sel = slice(offsets[i], offsets[i+1])
+        m, s, a, w = _fit(Y[sel])
+        assert np.allclose(X[i], m, atol = 1e-4)
+        assert np.allclose(se[i], s, rtol = 1e-3)
+        assert np.allclose(row_eff[sel], a, atol = 1e-4)
+        assert np.allclose(weights[sel], w, atol = 1e-3)
+
+
+def test_plm_threads():
+    Y, offsets = _get_data(20, seed = 1)
+    res1 = plm_batch(Y, offsets, num_threads = 1)
+    res4 = plm_batch(Y, offsets, num_threads = 4)
+    for A, B in zip(res1, res4):
+        assert np.array_equal(A, B, equal_nan = True)
+
+
+def test_plm_weights():
+    # without the weights, the other results are the same
+    Y, offsets = _get_data(5, seed = 3)
+    Y[offsets[2], 1] = np.nan
+    res = plm_batch(Y, offsets, full_output = True)
+    res_nw = plm_batch(Y, offsets, return_weights = False, full_output = True)
+    assert res_nw[3] is None
+    for i in [0, 1, 2, 4, 5]:
+        assert np.array_equal(res[i], res_nw[i], equal_nan = True)
+
+
+def test_plm_missing():
+    Y, offsets = _get_data(6, seed = 2)
+    Y[offsets[3] + 1, 2] = np.nan
+    offsets = np.insert(offsets, 5, offsets[5])  # an empty probeset
+    X, se, row_eff, weights, converged, _ = plm_batch(Y, offsets,
+            full_output = True)
+    for i in [3, 5]:
+        assert np.all(np.isnan(X[i]))
+        assert not converged[i]
+    assert np.all(np.isnan(row_eff[offsets[3]:offsets[4]]))
+    assert not np.any(np.isnan(np.delete(X, [3, 5], axis = 0)))
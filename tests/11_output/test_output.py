@@ -0,0 +1,74 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import str as text
+
+import io
+
+import numpy as np
+import pytest
+
+from pyaffy.output import NpyOutput, HDF5Output, ZarrOutput
+
+
+def _write(output):
+    genes = ['g%d' % i for i in range(10)]
+    samples = ['Sample 1', 'Sample 2', 'Sample 3']
+    X = np.arange(30, dtype = np.float32).reshape(10, 3)
+    output.open(genes, samples)
+    # out of order, with gaps
+    output.write(np.int64([1, 2, 5, 9]), X[[1, 2, 5, 9]])
+    output.write(np.int64([0, 3, 4, 6, 7, 8]), X[[0, 3, 4, 6, 7, 8]])
+    output.close()
+    assert output.num_written == 10
+    return genes, samples, X
+
+
+def test_npy(tmpdir):
+    path = text(tmpdir.join('X.npy'))
+    genes, samples, X = _write(NpyOutput(path))
+    assert np.array_equal(np.load(path), X)
+    # flushing after every block
+    _write(NpyOutput(path, flush = True))
+    assert np.array_equal(np.load(path), X)
+    with io.open(text(tmpdir.join('X.genes.txt')), encoding = 'utf-8') as fh:
+        assert fh.read().splitlines() == genes
+    with io.open(text(tmpdir.join('X.samples.txt')), encoding = 'utf-8') \
+            as fh:
+        assert fh.read().splitlines() == samples
+
+
+def test_hdf5(tmpdir):
+    h5py = pytest.importorskip('h5py')
+    path = text(tmpdir.join('X.h5'))
+    genes, samples, X = _write(HDF5Output(path, chunks = (4, 3)))
+    with h5py.File(path, 'r') as fh:
+        assert np.array_equal(fh['X'][...], X)
+        assert list(fh['genes'].asstr()[...]) == genes
+        assert list(fh['samples'].asstr()[...]) == samples
+
+
+def test_zarr(tmpdir):
+    zarr = pytest.importorskip('zarr')
+    path = text(tmpdir.join('X.zarr'))
+    genes, samples, X = _write(ZarrOutput(path, chunks = (4, 3)))
+    group = zarr.open_group(path, mode = 'r')
+    assert np.array_equal(group['X'][...], X)
+    assert list(group.attrs['genes']) == genes
+    assert list(group.attrs['samples']) == samples
@@ -0,0 +1,208 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of `pyaffy.rma` on a small synthetic array (see `conftest.py`).
+
+The parallel, memory-mapped, out-of-core and streaming-output code paths
+must all produce the same expression matrix as plain in-memory processing.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import str as text
+
+import numpy as np
+import pytest
+
+from pyaffy import rma
+from pyaffy.cdfparser import parse_cdf
+from pyaffy.output import NpyOutput
+
+# the options that determine the result
+RMA_OPTIONS = [
+    dict(),
+    dict(medianpolish = False, summary_method = 'mean'),
+    dict(bg_correct = False, quantile_normalize = False),
+]
+
+
+def _probe_matrix_size(cdf_file, num_samples):
+    """Returns the size of the probe matrix (in bytes)."""
+    _, _, _, probesets = parse_cdf(cdf_file)
+    return 4 * probesets.indices.size * num_samples
+
+
+def test_rma(synthetic_chip):
+    cdf_file, sample_cel_files = synthetic_chip
+    genes, samples, X = rma(cdf_file, sample_cel_files)
+
+    _, _, _, probesets = parse_cdf(cdf_file)
+    assert genes == sorted(probesets.names.tolist())
+    assert samples == list(sample_cel_files.keys())
+    assert X.shape == (len(genes), len(samples)) and X.dtype == np.float32
+    assert np.all(np.isfinite(X))
+
+    # the results do not depend on the order of the samples
+    reversed_cel_files = type(sample_cel_files)(
+        reversed(list(sample_cel_files.items())))
+    _, samples_rev, X_rev = rma(cdf_file, reversed_cel_files)
+    assert samples_rev == samples[::-1]
+    assert np.allclose(X_rev[:, ::-1], X, atol = 1e-5)
+
+
+@pytest.mark.parametrize('use_threads', [False, True])
+def test_rma_parallel(synthetic_chip, use_threads):
+    cdf_file, sample_cel_files = synthetic_chip
+    genes, samples, X = rma(cdf_file, sample_cel_files)
+    genes_par, samples_par, X_par = rma(cdf_file, sample_cel_files,
+                                        n_jobs = 2, use_threads = use_threads)
+    assert genes_par == genes
+    assert samples_par == samples
+    assert np.array_equal(X_par, X)
+
+
+def test_rma_mmap(synthetic_chip):
+    # the uncompressed Version 4 CEL files are memory-mapped
+    cdf_file, sample_cel_files = synthetic_chip
+    _, _, X = rma(cdf_file, sample_cel_files)
+    _, _, X_mmap = rma(cdf_file, sample_cel_files, mmap = True)
+    assert np.array_equal(X_mmap, X)
+
+
+@pytest.mark.parametrize('options', RMA_OPTIONS)
+def test_rma_out_of_core(synthetic_chip, tmpdir, options):
+    cdf_file, sample_cel_files = synthetic_chip
+    genes, samples, X = rma(cdf_file, sample_cel_files, **options)
+
+    # process two samples at a time (and several blocks of probesets)
+    y_size = _probe_matrix_size(cdf_file, len(sample_cel_files))
+    scratch_dir = text(tmpdir.join('scratch'))
+    tmpdir.mkdir('scratch')
+    for n_jobs in [1, 2]:
+        genes_ooc, samples_ooc, X_ooc = rma(cdf_file, sample_cel_files,
+                scratch_dir = scratch_dir, memory_budget = y_size // 3,
+                n_jobs = n_jobs, **options)
+        assert genes_ooc == genes
+        assert samples_ooc == samples
+        assert np.array_equal(X_ooc, X)
+    assert not tmpdir.join('scratch').listdir()
+
+
+@pytest.mark.parametrize('method', ['median', 'mean', 'trimmed_mean',
+                                    'biweight', 'plm'])
+def test_rma_summary_method(synthetic_chip, tmpdir, method):
+    cdf_file, sample_cel_files = synthetic_chip
+    genes, samples, X = rma(cdf_file, sample_cel_files,
+                            medianpolish = False, summary_method = method)
+    assert np.all(np.isfinite(X))
+    y_size = _probe_matrix_size(cdf_file, len(sample_cel_files))
+    _, _, X_ooc = rma(cdf_file, sample_cel_files, medianpolish = False,
+                      summary_method = method, scratch_dir = text(tmpdir),
+                      memory_budget = y_size // 3)
+    assert np.array_equal(X_ooc, X)
+
+    if method != 'median':
+        # the medians of the probes (without median polish) differ
+        _, _, X_median = rma(cdf_file, sample_cel_files,
+                             medianpolish = False)
+        assert not np.array_equal(X_median, X)
+
+
+@pytest.mark.parametrize('out_of_core', [False, True])
+def test_rma_plm(synthetic_chip, tmpdir, out_of_core):
+    cdf_file, sample_cel_files = synthetic_chip
+    genes, samples, X, stats, se = rma(cdf_file, sample_cel_files,
+                                       medianpolish = False,
+                                       summary_method = 'plm',
+                                       full_output = True)
+    assert se.shape == X.shape and se.dtype == np.float32
+
+    # the standard errors are sorted by gene (like the expression values)
+    _, _, _, probesets = parse_cdf(cdf_file)
+    sizes = probesets.sizes[probesets.sort_order()]
+    assert np.all(np.isnan(se[sizes == 1]))
+    assert np.all(se[sizes > 1] > 0)
+
+    # standard errors are only returned for "plm"
+    assert len(rma(cdf_file, sample_cel_files, summary_method = 'plm',
+                   full_output = True)) == 4
+
+    y_size = _probe_matrix_size(cdf_file, len(sample_cel_files))
+    scratch_dir = text(tmpdir) if out_of_core else None
+    output = NpyOutput(text(tmpdir.join('X.npy')))
+    _, _, result, _, se_out = rma(cdf_file, sample_cel_files,
+                                  medianpolish = False,
+                                  summary_method = 'plm',
+                                  scratch_dir = scratch_dir,
+                                  memory_budget = y_size // 3,
+                                  output = output, full_output = True)
+    assert result is output
+    assert np.array_equal(np.load(output.path), X)
+    assert np.array_equal(se_out, se, equal_nan = True)
+
+
+@pytest.mark.parametrize('out_of_core', [False, True])
+def test_rma_output(synthetic_chip, tmpdir, out_of_core):
+    cdf_file, sample_cel_files = synthetic_chip
+    genes, samples, X = rma(cdf_file, sample_cel_files)
+
+    # write the matrix in several blocks
+    y_size = _probe_matrix_size(cdf_file, len(sample_cel_files))
+    scratch_dir = text(tmpdir) if out_of_core else None
+    path = text(tmpdir.join('X.npy'))
+    output = NpyOutput(path)
+    genes_out, samples_out, result = rma(cdf_file, sample_cel_files,
+                                         scratch_dir = scratch_dir,
+                                         memory_budget = y_size // 3,
+                                         output = output)
+    assert result is output
+    assert genes_out == genes
+    assert samples_out == samples
+    assert output.num_written == len(genes)
+    assert np.array_equal(np.load(path), X)
+    with open(output.genes_path) as fh:
+        assert fh.read().split('\n')[:-1] == genes
+
+
+@pytest.mark.parametrize('out_of_core', [False, True])
+def test_rma_stats(synthetic_chip, tmpdir, out_of_core):
+    cdf_file, sample_cel_files = synthetic_chip
+    events = []
+    def callback(event, stats):
+        events.append(event)
+
+    y_size = _probe_matrix_size(cdf_file, len(sample_cel_files))
+    scratch_dir = text(tmpdir) if out_of_core else None
+    genes, samples, X, stats = rma(cdf_file, sample_cel_files,
+                                   scratch_dir = scratch_dir,
+                                   memory_budget = y_size // 3,
+                                   callback = callback, full_output = True)
+    stages = ['cdf', 'cel_headers', 'cel', 'background', 'normalization']
+    if out_of_core:
+        stages += ['scratch_io']
+    stages += ['summarization']
+    assert list(stats.stages.keys()) == stages
+    if out_of_core:
+        # three chunks of two samples each
+        assert stats.stages['cel'].num_runs == 3
+    assert sorted(f.index for f in stats.cel_files) == \
+            list(range(len(samples)))
+    assert events.count('cel_file') == len(samples)
+    assert events.count('stage_start') == events.count('stage_end')
+    assert stats.cel_progress == 1.0
+    assert stats.num_probesets == len(genes)
+    assert stats.medpolish_iterations.sum() == len(genes)
+    assert 0 < stats.num_converged <= len(genes)
@@ -0,0 +1,117 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from pyaffy.probesets import ProbesetIndex
+
+
+@pytest.fixture
+def probesets():
+    rng = np.random.RandomState(0)
+    names = ['%d_at' % i for i in rng.permutation(20)]
+    # sizes between 0 and 5 (including empty probesets)
+    return OrderedDict(
+        (n, rng.randint(0, 10000, rng.randint(0, 6)).astype(np.uint32))
+        for n in names)
+
+
+def _assert_equal(index, probesets):
+    assert list(index.keys()) == list(probesets.keys())
+    for name, indices in probesets.items():
+        assert index[name].dtype == np.uint32
+        assert np.array_equal(index[name], indices)
+
+
+def test_mapping(probesets):
+    index = ProbesetIndex.from_dict(probesets)
+    assert len(index) == len(probesets)
+    assert index.num_probes == sum(v.size for v in probesets.values())
+    assert index.sizes.tolist() == [v.size for v in probesets.values()]
+    assert index.offsets[0] == 0 and index.offsets[-1] == index.num_probes
+    assert '0_at' in index and 'x_at' not in index
+    with pytest.raises(KeyError):
+        index['x_at']
+    _assert_equal(index, probesets)
+    repr(index)
+
+
+def test_dict_round_trip(probesets):
+    index = ProbesetIndex.from_dict(probesets)
+    d = index.to_dict()
+    assert isinstance(d, OrderedDict)
+    _assert_equal(index, d)
+    index2 = ProbesetIndex.from_dict(d)
+    for attr in ['names', 'offsets', 'indices']:
+        assert np.array_equal(getattr(index2, attr), getattr(index, attr))
+
+    empty = ProbesetIndex.from_dict(OrderedDict())
+    assert len(empty) == 0 and empty.num_probes == 0
+    assert empty.to_dict() == OrderedDict()
+
+
+def test_slice(probesets):
+    index = ProbesetIndex.from_dict(probesets)
+    items = list(probesets.items())
+    for start, stop in [(0, 20), (3, 8), (5, 6), (7, 7), (15, 100),
+                        (-5, 20), (10, 5)]:
+        s = index.slice(start, stop)
+        _assert_equal(s, OrderedDict(items[start:stop]))
+        assert s.offsets[0] == 0
+        if s.num_probes > 0:
+            # the probe indices are not copied
+            assert np.shares_memory(s.indices, index.indices)
+
+
+def test_subset(probesets):
+    index = ProbesetIndex.from_dict(probesets)
+    items = list(probesets.items())
+    # the positions can be in any order, and can be repeated
+    sel = np.array([4, 0, 19, 4, 7])
+    sub = index.subset(sel)
+    assert len(sub) == 5
+    assert np.array_equal(sub.names, index.names[sel])
+    for j, i in enumerate(sel):
+        assert np.array_equal(sub.indices[sub.offsets[j]:sub.offsets[j+1]],
+                              items[i][1])
+
+    mask = np.zeros(len(index), dtype = np.bool_)
+    mask[[1, 2, 11]] = True
+    _assert_equal(index.subset(mask),
+                  OrderedDict([items[i] for i in [1, 2, 11]]))
+
+    empty = index.subset(np.array([], dtype = np.int64))
+    assert len(empty) == 0 and empty.num_probes == 0
+
+
+def test_sorted(probesets):
+    index = ProbesetIndex.from_dict(probesets)
+    a = index.sort_order()
+    assert index.names[a].tolist() == sorted(probesets.keys())
+    _assert_equal(index.sorted(),
+                  OrderedDict(sorted(probesets.items(), key = lambda x: x[0])))
+
+    # the sort is stable
+    names = ['b', 'a', 'b', 'a']
+    dup = ProbesetIndex(names, [0, 1, 2, 3, 4], [0, 1, 2, 3])
+    assert dup.sort_order().tolist() == [1, 3, 0, 2]
+    assert dup.sorted().indices.tolist() == [1, 3, 0, 2]
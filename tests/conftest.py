@@ -0,0 +1,84 @@
+# Copyright (c) 2016 Florian Wagner
+#
+# This file is part of pyAffy.
+#
+# pyAffy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Fixtures shared by all tests.
+
+The synthetic CDF and CEL files are created using the generators of the
+benchmark suite (see `benchmarks.generators`), so these tests do not require
+any downloads.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import str as text
+
+import os
+import sys
+from collections import OrderedDict
+
+import pytest
+
+# make the benchmark suite importable (it is not installed)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks.generators import (CEL_FORMATS, generate_intensities,
+                                   write_cel, write_cdf)
+from pyaffy import cache
+
+# the dimensions of the synthetic array
+NUM_ROWS = 64
+NUM_COLS = 64
+NUM_SAMPLES = 6
+
+
+@pytest.fixture(autouse = True)
+def cache_dir(tmpdir):
+    """Uses a temporary cache directory (instead of ``~/.cache/pyaffy``)."""
+    path = text(tmpdir.join('cache'))
+    cache.set_cache_dir(path)
+    yield path
+    cache.set_cache_dir(None)
+
+
+@pytest.fixture(scope = 'session')
+def synthetic_chip(tmpdir_factory):
+    """Creates a CDF file and CEL files of a small synthetic array.
+
+    The CEL files cycle through all formats, both plain and gzip'ed.
+
+    Returns
+    -------
+    cdf_file: str
+        The path of the CDF file.
+    sample_cel_files: collections.OrderedDict (str => str)
+        The path of the CEL file of each sample.
+    """
+    tmpdir = tmpdir_factory.mktemp('synthetic_chip')
+    cdf_file = text(tmpdir.join('synthetic.cdf'))
+    write_cdf(cdf_file, NUM_ROWS, NUM_COLS)
+
+    sample_cel_files = OrderedDict()
+    for j in range(NUM_SAMPLES):
+        fmt = CEL_FORMATS[j % len(CEL_FORMATS)]
+        compressed = (j // len(CEL_FORMATS)) % 2 == 1
+        path = text(tmpdir.join('sample_%d.CEL' % j))
+        if compressed:
+            path += '.gz'
+        y = generate_intensities(NUM_ROWS, NUM_COLS, sample = j)
+        write_cel(path, fmt, NUM_ROWS, NUM_COLS, y, compressed = compressed)
+        sample_cel_files['Sample %d' % (j + 1)] = path
+    return cdf_file, sample_cel_files